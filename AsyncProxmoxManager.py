@@ -0,0 +1,237 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+import aiohttp
+from ProxmoxManager import ProxmoxManager
+from RateLimiter import RateLimiter
+
+class AsyncProxmoxManager:
+    def __init__(self, host, user, password, verify_ssl=False, port=8006, scheme='https', max_concurrency=16, requests_per_second=50, ticket_renew_age=3600):
+        """
+        Initialize an asyncio counterpart to ProxmoxManager.
+
+        The client keeps one keep-alive connection pool for its lifetime and only logs in again
+        once the ticket is older than ticket_renew_age. Use it as an async context manager:
+
+            async with AsyncProxmoxManager(host, user, password) as manager:
+                buckets = await manager.get_buckets()
+
+        :param host: Proxmox host to connect to.
+        :param user: API user, e.g. 'root@pam'.
+        :param password: Password of the API user.
+        :param verify_ssl: Whether to verify the TLS certificate of the host.
+        :param port: API port of the host.
+        :param scheme: 'https' for a real cluster, 'http' for a local fake API server.
+        :param max_concurrency: Maximum number of requests in flight at once.
+        :param requests_per_second: Maximum sustained request rate, None to disable.
+        :param ticket_renew_age: Seconds after which the login ticket is renewed (PVE tickets expire after 7200).
+        """
+        self.base_url = f"{scheme}://{host}:{port}/api2/json"
+        self.user = user
+        self.password = password
+        self.verify_ssl = verify_ssl
+        self.max_concurrency = max_concurrency
+        self.ticket_renew_age = ticket_renew_age
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.auth_lock = asyncio.Lock()
+        self.session = None
+        self.ticket = None
+        self.csrf_token = None
+        self.ticket_time = 0
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """Create the pooled HTTP session."""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60, ssl=None if self.verify_ssl else False)
+            self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        """Close the HTTP session and its connections."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def authenticate(self):
+        """Request a new login ticket and CSRF prevention token."""
+        await self.rate_limiter.acquire()
+        async with self.semaphore:
+            async with self.session.post(f"{self.base_url}/access/ticket", data={'username': self.user, 'password': self.password}) as response:
+                response.raise_for_status()
+                data = (await response.json())['data']
+        self.ticket = data['ticket']
+        self.csrf_token = data['CSRFPreventionToken']
+        self.ticket_time = time.monotonic()
+
+    async def ensure_ticket(self, force=False):
+        """Log in if there is no ticket yet or the current one is due for renewal."""
+        async with self.auth_lock:
+            if force or self.ticket is None or time.monotonic() - self.ticket_time > self.ticket_renew_age:
+                await self.authenticate()
+
+    async def request(self, method, path, data=None, params=None):
+        """
+        Send an authenticated API request and return its 'data' field.
+
+        :param method: HTTP method.
+        :param path: API path below /api2/json, e.g. '/nodes'.
+        :param data: Form data for POST/PUT requests.
+        :param params: Query parameters.
+        """
+        await self.open()
+        await self.ensure_ticket()
+
+        for attempt in range(2):
+            headers = {'Cookie': f"PVEAuthCookie={self.ticket}"}
+            if method != 'GET':
+                headers['CSRFPreventionToken'] = self.csrf_token
+
+            await self.rate_limiter.acquire()
+            async with self.semaphore:
+                async with self.session.request(method, f"{self.base_url}{path}", data=data, params=params, headers=headers) as response:
+                    if response.status != 401 or attempt > 0:
+                        response.raise_for_status()
+                        return (await response.json())['data']
+
+            # The ticket was rejected, log in again once and retry
+            await self.ensure_ticket(force=True)
+
+    async def get(self, path, **params):
+        """Send an authenticated GET request."""
+        return await self.request('GET', path, params=params or None)
+
+    async def get_cluster_resources(self):
+        """Retrieve the node and guest resources of the whole cluster in a single request."""
+        return await self.get('/cluster/resources')
+
+    async def get_node_stats(self, node_name):
+        """Retrieve memory and CPU usage for a single node in GB."""
+        status = await self.get(f"/nodes/{node_name}/status")
+        return ProxmoxManager.parse_node_status(node_name, status)
+
+    async def get_node_usage(self):
+        """Retrieve memory and CPU usage for each node in GB, querying all nodes concurrently."""
+        node_names = [node['node'] for node in await self.get('/nodes')]
+        results = await asyncio.gather(*(self.get_node_stats(node) for node in node_names))
+        return dict(zip(node_names, results))
+
+    async def get_vm_status(self, node, vmid):
+        """Retrieve the current status of a VM, or None if the request fails."""
+        try:
+            return await self.get(f"/nodes/{node}/qemu/{vmid}/status/current")
+        except Exception as e:
+            print(f"Failed to retrieve status for VM {vmid} on node {node}: {e}")
+            return None
+
+    async def get_powered_on_vms(self, node):
+        """Retrieve a list of powered-on VMs on the node with their memory and CPU usage, querying all VMs concurrently."""
+        try:
+            vms = await self.get(f"/nodes/{node}/qemu")
+        except Exception as e:
+            print(f"Failed to retrieve VMs for node {node}: {e}")
+            return []
+
+        vmids = [vm['vmid'] for vm in vms]
+        statuses = await asyncio.gather(*(self.get_vm_status(node, vmid) for vmid in vmids))
+
+        # Only consider powered-on (running) VMs
+        return [
+            {
+                'vmid': vmid,
+                'memory_used': vm_status['mem'] / 1073741824,  # Convert from bytes to GB
+                'cpu_used': ProxmoxManager.get_cpu_cores_used(vm_status)
+            }
+            for vmid, vm_status in zip(vmids, statuses)
+            if vm_status and vm_status['status'] == 'running'
+        ]
+
+    async def get_inventory_per_node(self, node_names):
+        """Collect node usage and powered-on VMs with per-node queries fanned out concurrently."""
+        async def collect(node):
+            try:
+                return await asyncio.gather(self.get_node_stats(node), self.get_powered_on_vms(node))
+            except Exception as e:
+                print(f"Failed to retrieve status for node {node}: {e}")
+                return None
+
+        results = await asyncio.gather(*(collect(node) for node in node_names))
+
+        node_stats = {}
+        vms_by_node = {}
+        for node, result in zip(node_names, results):
+            if result is not None:
+                node_stats[node], vms_by_node[node] = result
+        return node_stats, vms_by_node
+
+    async def fill_cpu_info(self, node_stats):
+        """Fill in the CPU details that a /cluster/resources response lacks, such as the CPU model, from concurrent node status requests."""
+        async def get_cpu_info(node):
+            try:
+                return (await self.get_node_stats(node))['cpu_info']
+            except Exception as e:
+                print(f"Failed to retrieve status for node {node}: {e}")
+                return None
+
+        node_names = list(node_stats)
+        for node, cpu_info in zip(node_names, await asyncio.gather(*(get_cpu_info(node) for node in node_names))):
+            if cpu_info is not None:
+                node_stats[node]['cpu_info'] = cpu_info
+
+    async def get_inventory(self, host_names=None, use_cluster_resources=True):
+        """
+        Collect node usage and powered-on VMs for the cluster.
+
+        :param host_names: List of host names to include. If None, include all hosts.
+        :param use_cluster_resources: Whether to try the /cluster/resources endpoint first.
+        :return: Tuple of (node_stats, vms_by_node).
+        """
+        if use_cluster_resources:
+            try:
+                resources = await self.get_cluster_resources()
+                node_stats = ProxmoxManager.get_node_usage_from_resources(resources)
+                vms_by_node = ProxmoxManager.get_powered_on_vms_from_resources(resources)
+                if host_names:
+                    node_stats = {node: stats for node, stats in node_stats.items() if node in host_names}
+                await self.fill_cpu_info(node_stats)
+                return node_stats, {node: vms_by_node.get(node, []) for node in node_stats}
+            except Exception as e:
+                print(f"Failed to retrieve cluster resources, falling back to per-node queries: {e}")
+
+        node_names = [node['node'] for node in await self.get('/nodes')]
+        if host_names:
+            node_names = [node for node in node_names if node in host_names]
+        return await self.get_inventory_per_node(node_names)
+
+    async def get_buckets(self, host_names=None, use_cluster_resources=True):
+        """
+        Get buckets for the specified host names, sorted by node name.
+
+        Produces the same buckets and items as ProxmoxManager.get_buckets.
+
+        :param host_names: List of host names to include. If None, include all hosts.
+        :param use_cluster_resources: Whether to collect the inventory from the single /cluster/resources request.
+        :return: List of buckets with VMs and static items.
+        """
+        node_stats, vms_by_node = await self.get_inventory(host_names, use_cluster_resources)
+        return ProxmoxManager.build_buckets(node_stats, vms_by_node)
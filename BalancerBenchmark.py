@@ -0,0 +1,232 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import contextlib
+import csv
+import importlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import time
+import tracemalloc
+from BucketSimulator import BucketSimulator
+from LoadStatistics import LoadStatistics
+
+# Balancer name -> module that defines a BucketBalancer class
+BALANCERS = {
+    'BucketBalancer': 'BucketBalancer',
+    'Greedy1': 'TestAlgorithms.BuckBal_Greedy1',
+    'Greedy2': 'TestAlgorithms.BuckBal_Greedy2',
+    'Greedy3': 'TestAlgorithms.BuckBal_Greedy3',
+    'BinPack': 'TestAlgorithms.BuckBal_BinPack',
+    'Genetic': 'TestAlgorithms.BuckBal_Genetic',
+    'SimulatedAnnealing': 'TestAlgorithms.BuckBal_SimulatedAnnealing',
+    'ParallelAnnealing': 'TestAlgorithms.BuckBal_ParallelAnnealing',
+    'MinCostMaxFlow': 'TestAlgorithms.BuckBal_MinCostMaxFlow',
+}
+
+# (bucket count, item count) pairs from small homelab clusters to very large ones
+DEFAULT_SIZES = [(10, 100), (50, 1000), (200, 10000), (1000, 50000), (2000, 100000)]
+
+BASE_CAPACITIES = [768, 656, 384, 384, 384, 384, 384, 384, 240, 240, 240, 240, 192]
+AVERAGE_BLOCK_SIZE = 30.6  # Mean of the BucketSimulator block sizes
+AVERAGE_FILL = 0.455  # Mean of the BucketSimulator load percentage range
+
+RESULT_FIELDS = [
+    'balancer', 'buckets', 'items', 'seed', 'status', 'wall_time_s', 'peak_memory_mb', 'moves',
+    'load_migrated', 'bytes_migrated', 'unplaced_items', 'std_dev_before', 'std_dev_after', 'std_dev_improvement_pct', 'error'
+]
+
+class BalancerBenchmark:
+    def __init__(self, balancers=None, sizes=None, seeds=(0,), time_limit=60, kill_grace=10):
+        """
+        Initialize a benchmark of the balancers over seeded simulated clusters.
+
+        :param balancers: Names from BALANCERS to run. If None, run all of them.
+        :param sizes: List of (bucket count, item count) pairs to generate.
+        :param seeds: Seeds to generate a cluster with for every size.
+        :param time_limit: Seconds each run may take; it is passed to the balancer as its deadline.
+        :param kill_grace: Seconds past the time limit after which a run that ignores its deadline is killed.
+        """
+        self.balancers = list(balancers) if balancers else list(BALANCERS)
+        self.sizes = sizes if sizes else DEFAULT_SIZES
+        self.seeds = seeds
+        self.time_limit = time_limit
+        self.kill_grace = kill_grace
+
+    @staticmethod
+    def generate_cluster(bucket_count, item_count, seed):
+        """Generate a reproducible simulated cluster of roughly the requested number of items."""
+        rng = random.Random(seed)
+        capacities = [rng.choice(BASE_CAPACITIES) for _ in range(bucket_count)]
+
+        # Scale the capacities so the simulator's random fill produces about item_count items
+        scale = item_count * AVERAGE_BLOCK_SIZE / (AVERAGE_FILL * sum(capacities))
+        capacities = [max(1, int(capacity * scale)) for capacity in capacities]
+
+        random.seed(seed)
+        return BucketSimulator(capacities).simulate()
+
+    @staticmethod
+    def run_balancer(module_name, buckets, time_limit=None):
+        """Run a balancer on the buckets through the balance() entry point every balancer shares, with a deadline time_limit seconds from now."""
+        balancer = importlib.import_module(module_name).BucketBalancer(buckets)
+        return balancer.balance(deadline=time.monotonic() + time_limit if time_limit is not None else None)
+
+    @staticmethod
+    def measure(name, bucket_count, item_count, seed, time_limit=None):
+        """Generate a cluster, run one balancer on it and return the result row without the peak memory."""
+        buckets = BalancerBenchmark.generate_cluster(bucket_count, item_count, seed)
+        item_loads = {item.id: item.load for bucket in buckets for item in bucket.items}
+        initial_assignment = {item.id: bucket.id for bucket in buckets for item in bucket.items}
+        std_dev_before = LoadStatistics(buckets).calculate_standard_deviation()
+
+        start = time.perf_counter()
+        BalancerBenchmark.run_balancer(BALANCERS[name], buckets, time_limit)
+        wall_time = time.perf_counter() - start
+
+        # Compare the final placement with the initial one instead of trusting each balancer's move format
+        final_assignment = {item.id: bucket.id for bucket in buckets for item in bucket.items}
+        moved = [item_id for item_id, bucket_id in final_assignment.items() if initial_assignment[item_id] != bucket_id]
+        load_migrated = sum(item_loads[item_id] for item_id in moved)
+        std_dev_after = LoadStatistics(buckets).calculate_standard_deviation()
+
+        return {
+            'status': 'ok',
+            'items': len(item_loads),
+            'wall_time_s': round(wall_time, 6),
+            'moves': len(moved),
+            'load_migrated': load_migrated,
+            'bytes_migrated': int(load_migrated * 1073741824),  # Loads are in GB
+            'unplaced_items': len(initial_assignment) - len(final_assignment),
+            'std_dev_before': round(std_dev_before, 6),
+            'std_dev_after': round(std_dev_after, 6),
+            'std_dev_improvement_pct': round((std_dev_before - std_dev_after) / std_dev_before * 100, 3) if std_dev_before else 0.0,
+        }
+
+    @staticmethod
+    def measure_peak_memory(name, bucket_count, item_count, seed, time_limit=None):
+        """Run one balancer on a freshly generated copy of the cluster under tracemalloc and return its peak traced memory in MB."""
+        buckets = BalancerBenchmark.generate_cluster(bucket_count, item_count, seed)
+        tracemalloc.start()
+        try:
+            BalancerBenchmark.run_balancer(BALANCERS[name], buckets, time_limit)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return round(peak_memory / 1048576, 3)
+
+    @staticmethod
+    def measure_worker(result_queue, name, bucket_count, item_count, seed, time_limit=None):
+        """Process entry point that reports the timed measurement and then the peak memory, or the error, through a queue."""
+        try:
+            # Discard the balancers' progress output so it does not mix with the result table
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                # tracemalloc slows down every allocation, so the timed run and the memory run are separate
+                result_queue.put(BalancerBenchmark.measure(name, bucket_count, item_count, seed, time_limit))
+                result_queue.put({'peak_memory_mb': BalancerBenchmark.measure_peak_memory(name, bucket_count, item_count, seed, time_limit)})
+        except Exception as e:
+            result_queue.put({'status': 'error', 'error': f"{type(e).__name__}: {e}"})
+
+    def run_one(self, name, bucket_count, item_count, seed):
+        """
+        Run one measurement in its own process. The timed and the memory run each get the time limit as their deadline;
+        a run still going kill_grace seconds later, e.g. a balancer that does not check its deadline, is killed.
+        """
+        row = {field: '' for field in RESULT_FIELDS}
+        row.update({'balancer': name, 'buckets': bucket_count, 'items': item_count, 'seed': seed})
+
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+        result_queue = context.Queue()
+        process = context.Process(target=BalancerBenchmark.measure_worker, args=(result_queue, name, bucket_count, item_count, seed, self.time_limit))
+        process.start()
+        try:
+            row.update(result_queue.get(timeout=self.time_limit + self.kill_grace))
+        except queue.Empty:
+            row['status'] = 'timeout'
+            process.terminate()
+        else:
+            if row['status'] == 'ok':
+                try:
+                    row.update(result_queue.get(timeout=self.time_limit + self.kill_grace))
+                except queue.Empty:
+                    row['error'] = 'peak memory run timed out'
+                    process.terminate()
+        process.join()
+        return row
+
+    def run(self, writer=None):
+        """
+        Run every balancer over every size and seed.
+
+        :param writer: Optional callable invoked with each result row as soon as it is available.
+        :return: List of result rows.
+        """
+        rows = []
+        for bucket_count, item_count in self.sizes:
+            for seed in self.seeds:
+                for name in self.balancers:
+                    row = self.run_one(name, bucket_count, item_count, seed)
+                    rows.append(row)
+                    if writer:
+                        writer(row)
+        return rows
+
+
+def parse_sizes(text):
+    """Parse 'buckets:items,buckets:items' into a list of pairs."""
+    return [tuple(int(value) for value in size.split(':')) for size in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the load balancing algorithms on seeded simulated clusters.")
+    parser.add_argument('--balancers', help=f"Comma separated balancers to run (default: all of {', '.join(BALANCERS)})")
+    parser.add_argument('--sizes', type=parse_sizes, help="Comma separated buckets:items pairs (default: 10:100,50:1000,200:10000,1000:50000,2000:100000)")
+    parser.add_argument('--seeds', default='0', help="Comma separated seeds (default: 0)")
+    parser.add_argument('--time-limit', type=float, default=60, help="Deadline in seconds passed to every run (default: 60)")
+    parser.add_argument('--kill-grace', type=float, default=10, help="Seconds past the time limit before a run is killed (default: 10)")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help="Output format (default: csv)")
+    parser.add_argument('--output', help="File to write the results to (default: stdout)")
+    args = parser.parse_args()
+
+    benchmark = BalancerBenchmark(
+        balancers=args.balancers.split(',') if args.balancers else None,
+        sizes=args.sizes,
+        seeds=[int(seed) for seed in args.seeds.split(',')],
+        time_limit=args.time_limit,
+        kill_grace=args.kill_grace
+    )
+
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'csv':
+            csv_writer = csv.DictWriter(output, fieldnames=RESULT_FIELDS)
+            csv_writer.writeheader()
+            write_row = csv_writer.writerow
+        else:
+            write_row = lambda row: output.write(json.dumps(row) + '\n')
+
+        def write_and_flush(row):
+            write_row(row)
+            output.flush()
+
+        benchmark.run(write_and_flush)
+    finally:
+        if output is not sys.stdout:
+            output.close()
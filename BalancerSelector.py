@@ -0,0 +1,87 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+from BucketBalancer import BucketBalancer
+from HierarchicalBalancer import HierarchicalBalancer
+from PartitionedBalancer import PartitionedBalancer
+from SwapBalancer import SwapBalancer
+from VectorBalancer import VectorBalancer
+
+class BalancerSelector:
+    def __init__(self, cpu_weight=None, partition=None, cross_partition=False, zones=None, swap_threshold=80):
+        """
+        Initialize the choice of balancer shared by LoadBalancer.py and LoadBalancerDaemon.py.
+
+        :param cpu_weight: Weight of CPU against memory to balance both with VectorBalancer, or None.
+        :param partition: 'cpu' to balance per CPU model and core count with PartitionedBalancer, or None.
+        :param cross_partition: Whether the partitioned balancer also moves VMs without the 'host' CPU type between groups.
+        :param zones: 'auto' or a list of hostname lists to balance between and then within zones with HierarchicalBalancer, or None.
+        :param swap_threshold: Average load percentage above which BucketBalancer is replaced by SwapBalancer.
+        """
+        self.cpu_weight = cpu_weight
+        self.partition = partition
+        self.cross_partition = cross_partition
+        self.zones = zones
+        self.swap_threshold = swap_threshold
+
+    @classmethod
+    def from_environment(cls, environ=os.environ):
+        """Read PROXMOX_CPU_WEIGHT, PROXMOX_PARTITION, PROXMOX_CROSS_PARTITION and PROXMOX_ZONES, e.g. 'pve01,pve02;pve03,pve04' or 'auto'."""
+        return cls(cpu_weight=float(environ['PROXMOX_CPU_WEIGHT']) if environ.get('PROXMOX_CPU_WEIGHT') else None,
+                   partition=environ.get('PROXMOX_PARTITION') or None,
+                   cross_partition=environ.get('PROXMOX_CROSS_PARTITION') == '1',
+                   zones=cls.parse_zones(environ.get('PROXMOX_ZONES')))
+
+    @staticmethod
+    def parse_zones(value):
+        """Parse zones given as 'pve01,pve02;pve03,pve04' or 'auto', returning None when no zones are given."""
+        if not value or value == 'auto':
+            return value or None
+        return [zone.split(',') for zone in value.split(';') if zone]
+
+    def select(self, buckets, proxmox_manager, node_stats, vms_by_node, cost_model=None, history=None):
+        """
+        Create the balancer for the buckets: VectorBalancer with a CPU weight, else PartitionedBalancer per CPU group,
+        else HierarchicalBalancer with zones, else BucketBalancer, or SwapBalancer when the cluster is too full for one-way moves.
+
+        :param buckets: List of buckets to balance.
+        :param proxmox_manager: ProxmoxManager used to group the nodes by CPU and to find the portable VMs.
+        :param node_stats: Node statistics keyed by node name, as returned by get_inventory().
+        :param vms_by_node: Powered-on VMs keyed by node name, as returned by get_inventory().
+        :param cost_model: Optional MigrationCostModel for BucketBalancer.
+        :param history: Optional MoveHistoryStore passed to every balancer.
+        :return: The balancer, ready for balance().
+        """
+        if self.cpu_weight is not None:
+            return VectorBalancer(buckets, weights={'memory': 1.0, 'cpu': self.cpu_weight}, history=history)
+        if self.partition == 'cpu':
+            cpu_groups = proxmox_manager.group_nodes_by_cpu(node_stats)
+            unknown = sorted(node for (model, cpus), group in cpu_groups.items() if not model for node in group)
+            if unknown:
+                # Grouping by core count alone could pair nodes whose CPUs cannot live-migrate between each other
+                raise ValueError(f"Refusing to partition by CPU: the CPU model of {', '.join(unknown)} is unknown")
+            for (model, cpus), group in cpu_groups.items():
+                print(f"CPU group {model} ({cpus} cores): {', '.join(sorted(group))}, average memory usage {proxmox_manager.calculate_group_avg(group, node_stats):.2f}%")
+            portable = proxmox_manager.get_portable_vms(vms_by_node) if self.cross_partition else None
+            return PartitionedBalancer(buckets, cpu_groups.values(), portable=portable, history=history)
+        if self.zones is not None:
+            return HierarchicalBalancer(buckets, zones=None if self.zones == 'auto' else self.zones, history=history)
+
+        balancer = BucketBalancer(buckets, cost_model=cost_model, history=history)
+        if balancer.get_average_load_percentage() > self.swap_threshold:
+            # Too full for one-way moves, so exchange VMs between nodes instead; WaveScheduler keeps every exchange within capacity
+            balancer = SwapBalancer(buckets, history=history)
+        return balancer
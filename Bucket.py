@@ -14,27 +14,84 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 class Bucket:
-    def __init__(self, id, capacity, hostname=""):
+    def __init__(self, id, capacity, hostname="", resource_capacities=None):
         self.id = id
         self.capacity = capacity
-        self.items = []
         self.hostname = hostname
+        self.resource_capacities = resource_capacities or {}  # Capacities of resources other than memory, e.g. {'cpu': 64}
+        self.items = []
+
+    @property
+    def items(self):
+        """List of items currently held by the bucket."""
+        return self._items
+
+    @items.setter
+    def items(self, items):
+        """Replace the bucket contents and rebuild the cached running totals."""
+        self._items = list(items)
+        self._item_positions = {}  # Item id -> index in self._items for constant time removal
+        self._total_load = 0
+        self._movable_load = 0
+        for position, item in enumerate(self._items):
+            self._item_positions[item.id] = position
+            self._total_load += item.load
+            if item.movable:
+                self._movable_load += item.load
+
+    def get_resource_capacity(self, name):
+        """Return the bucket's capacity of a resource, where 'memory' is the capacity and missing resources are unlimited."""
+        return self.capacity if name == 'memory' else self.resource_capacities.get(name, float('inf'))
 
     def add_item(self, item):
         """Add an item to the bucket."""
-        if self.get_total_load() + item.load <= self.capacity:
-            self.items.append(item)
+        if self._total_load + item.load <= self.capacity:
+            self._item_positions[item.id] = len(self._items)
+            self._items.append(item)
+            self._total_load += item.load
+            if item.movable:
+                self._movable_load += item.load
         else:
             raise ValueError("Item exceeds bucket capacity.")
 
     def remove_item(self, item):
         """Remove an item from the bucket."""
-        if item in self.items:
-            self.items.remove(item)
+        position = self._item_positions.get(item.id)
+        if position is None or self._items[position] is not item:
+            return
+
+        # Swap the last item into the freed slot so removal does not shift the list
+        last_item = self._items.pop()
+        del self._item_positions[item.id]
+        if last_item is not item:
+            self._items[position] = last_item
+            self._item_positions[last_item.id] = position
+
+        self._total_load -= item.load
+        if item.movable:
+            self._movable_load -= item.load
+
+        # Reset the running totals once empty so floating point drift cannot accumulate
+        if not self._items:
+            self._total_load = 0
+            self._movable_load = 0
+
+    def contains_item(self, item):
+        """Check if the item is held by this bucket."""
+        position = self._item_positions.get(item.id)
+        return position is not None and self._items[position] is item
 
     def get_total_load(self):
-        """Calculate the total load in the bucket from its items."""
-        return sum(item.load for item in self.items)
+        """Return the total load in the bucket from its items."""
+        return self._total_load
+
+    def get_movable_load(self):
+        """Return the load of the items in the bucket that are allowed to move."""
+        return self._movable_load
+
+    def get_item_count(self):
+        """Return the number of items in the bucket."""
+        return len(self._items)
 
     def __repr__(self):
         return f"Bucket(id={self.id}, capacity={self.capacity}, total_load={self.get_total_load()}, items={len(self.items)})"
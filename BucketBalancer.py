@@ -13,11 +13,36 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import math
+from IndexedPriorityQueue import IndexedPriorityQueue
+from ItemLoadIndex import ItemLoadIndex
+from SolverBudget import SolverBudget
+
 class BucketBalancer:
-    def __init__(self, buckets):
+    def __init__(self, buckets, cost_model=None, target_improvement=None, max_iterations=1000, selection='best_fit', candidate_buckets=4, history=None, origins=None):
+        """
+        Initialize the balancer.
+
+        :param buckets: List of buckets to balance.
+        :param cost_model: Optional MigrationCostModel; when set, each move takes the item that removes the most imbalance per estimated migration second instead of the smallest item.
+        :param target_improvement: Optional fraction (e.g. 0.8) by which the standard deviation of the buckets' distances from their targets has to shrink before balancing stops.
+        :param max_iterations: Maximum number of moves to consider, which guards against endless loops.
+        :param selection: 'best_fit' to move the item whose load best matches the gap between the source's excess and the destination's deficit, or 'smallest' to move the smallest item.
+        :param candidate_buckets: Number of most overfilled sources and least underfilled destinations to fall back to when the best pair has no allowed move.
+        :param history: Optional MoveHistoryStore whose cool-downs and migration limits from earlier runs the moves have to respect.
+        :param origins: Optional dict of item id to the hostname the item started on, for items an earlier pass of the same plan already moved.
+        """
         self.buckets = buckets
+        self.cost_model = cost_model
+        self.target_improvement = target_improvement
+        self.max_iterations = max_iterations
+        self.selection = selection
+        self.candidate_buckets = candidate_buckets
+        self.history = history
+        self.origins = dict(origins or {})  # The history vets the net move of an item, from where it started the plan
         self.tolerance = 0.01  # +/- 5% tolerance
         self.move_history = {}  # Track recent moves to avoid oscillation
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
 
     def get_total_load(self):
         """Calculate the total load across all buckets."""
@@ -46,15 +71,74 @@ class BucketBalancer:
         # Ensure the move doesn't exceed the destination bucket's capacity
         if destination.get_total_load() + item.load > destination.capacity:
             return False  # Skip the move if it would exceed capacity
+        if self.history is not None:
+            origin = self.origins.get(item.id, source.hostname)
+            if destination.hostname != origin and not self.history.may_move(item.id, origin, destination.hostname):
+                return False  # Moved too recently or too often in earlier runs
         last_move = self.move_history.get(item.id)
         return last_move != (destination.id, source.id) and item.movable  # Ensure we don't undo the last move
 
+    def select_item_by_cost(self, source, destination, source_target, destination_target):
+        """Pick the item whose move removes the most imbalance per estimated migration second, or None if no move helps."""
+        source_load = source.get_total_load()
+        destination_load = destination.get_total_load()
+        imbalance = abs(source_load - source_target) + abs(destination_load - destination_target)
+
+        best_item, best_key = None, None
+        for item in source.items:
+            if not self.move_allowed(item, source, destination):
+                continue
+            reduction = imbalance - abs(source_load - item.load - source_target) - abs(destination_load + item.load - destination_target)
+            if reduction <= 0:
+                continue
+            cost = self.cost_model.get_migration_time(item, source.id, destination.id)
+            key = (reduction / cost if cost > 0 else float('inf'), reduction)  # On equal value per second, prefer the bigger step
+            if best_key is None or key > best_key:
+                best_item, best_key = item, key
+        return best_item
+
+    def select_item_best_fit(self, item_index, source, destination, source_target, destination_target):
+        """Pick the allowed item whose load is closest to half the source's excess plus the destination's deficit, or None if no move lowers the squared distance from the targets."""
+        gap = (source.get_total_load() - source_target + destination_target - destination.get_total_load()) / 2
+        for item in item_index.nearest(gap):
+            if abs(item.load - gap) >= gap:
+                return None  # Moving this or any further item would not bring the two buckets closer to their targets
+            if self.move_allowed(item, source, destination):
+                return item
+        return None
+
+    def select_item(self, item_index, source, destination, source_target, destination_target):
+        """Pick the item to move from source to destination with the configured selection, or None if no allowed move helps."""
+        if self.cost_model is not None:
+            return self.select_item_by_cost(source, destination, source_target, destination_target)
+        if self.selection == 'best_fit':
+            return self.select_item_best_fit(item_index, source, destination, source_target, destination_target)
+        item = item_index.smallest()
+        return item if item is not None and self.move_allowed(item, source, destination) else None
+
     def record_move(self, item, source, destination):
         """Record a move in the move history to prevent immediate reversal."""
         self.move_history[item.id] = (source.id, destination.id)
+        self.origins.setdefault(item.id, source.hostname)
+
+    def update_bucket_queues(self, bucket, target, position, overfilled, underfilled):
+        """Place a bucket in the overfilled or underfilled queue depending on its load, or in neither if it is within tolerance."""
+        bucket_load = bucket.get_total_load()
+        overfilled.remove(bucket.id)
+        underfilled.remove(bucket.id)
+
+        if self.is_within_tolerance(bucket_load, target):
+            return
+
+        # The most overfilled bucket is at the top of its queue, while the underfilled queue keeps the original
+        # ascending deficit order, so the least underfilled bucket outside the tolerance is at the top; ties go to the earliest bucket
+        if bucket_load > target:
+            overfilled.push(bucket.id, (target - bucket_load, position))
+        elif bucket_load < target:
+            underfilled.push(bucket.id, (target - bucket_load, position))
 
     def balance_buckets(self):
-        """Balance the load between buckets by moving the smallest item from the most overfilled bucket to the most underfilled bucket."""
+        """Balance the load between buckets by moving the best fitting (or smallest, or with a cost model the cheapest) item from the most overfilled bucket to the least underfilled bucket outside the tolerance."""
         # Check if the average load is over 80%. If it is, return without balancing.
         average_load_percentage = self.get_average_load_percentage()
         if average_load_percentage > 80:
@@ -67,40 +151,83 @@ class BucketBalancer:
         # Calculate the target load for each bucket
         targets = {bucket.id: self.target_load(bucket.capacity, total_capacity, total_load) for bucket in self.buckets}
 
-        moves = []
-        for _ in range(1000):  # Max iterations to avoid infinite loops
-            # Cache the load for each bucket
-            bucket_loads = {bucket.id: bucket.get_total_load() for bucket in self.buckets}
+        # Index buckets by id and keep each bucket's movable items ordered by load, so a small unmovable item cannot block its bucket
+        buckets_by_id = {bucket.id: bucket for bucket in self.buckets}
+        positions = {bucket.id: position for position, bucket in enumerate(self.buckets)}
+        item_indexes = {bucket.id: ItemLoadIndex([item for item in bucket.items if item.movable]) for bucket in self.buckets}
 
-            # Find overfilled and underfilled buckets outside the +/- 5% tolerance
-            overfilled = [bucket for bucket in self.buckets if not self.is_within_tolerance(bucket_loads[bucket.id], targets[bucket.id]) and bucket_loads[bucket.id] > targets[bucket.id]]
-            underfilled = [bucket for bucket in self.buckets if not self.is_within_tolerance(bucket_loads[bucket.id], targets[bucket.id]) and bucket_loads[bucket.id] < targets[bucket.id]]
+        # Keep the overfilled and underfilled buckets outside the tolerance in priority queues
+        overfilled = IndexedPriorityQueue()
+        underfilled = IndexedPriorityQueue()
+        for bucket in self.buckets:
+            self.update_bucket_queues(bucket, targets[bucket.id], positions[bucket.id], overfilled, underfilled)
 
+        # Track the distance from the targets and the standard deviation incrementally so they can be checked cheaply
+        imbalance = sum(abs(bucket.get_total_load() - targets[bucket.id]) for bucket in self.buckets)
+        # The distances from the targets sum to zero, so their standard deviation is their root mean square
+        squared_distance_sum = sum((bucket.get_total_load() - targets[bucket.id]) ** 2 for bucket in self.buckets)
+        initial_std_dev = math.sqrt(squared_distance_sum / len(self.buckets))
+
+        moves = []
+        for _ in range(self.max_iterations):  # Max iterations to avoid infinite loops
             if not overfilled or not underfilled:
                 break  # No more buckets to balance
-
-            # Sort overfilled by most overfilled and underfilled by most underfilled
-            overfilled.sort(key=lambda b: bucket_loads[b.id] - targets[b.id], reverse=True)
-            underfilled.sort(key=lambda b: targets[b.id] - bucket_loads[b.id])
-
-            source = overfilled[0]  # The most overfilled bucket
-            destination = underfilled[0]  # The most underfilled bucket
-
-            # Find the smallest item in the source bucket that can fit in the destination bucket
-            smallest_item = min(source.items, key=lambda item: item.load)
-            if self.move_allowed(smallest_item, source, destination):
-                # Simulate the move
-                moves.append({'from': source.id, 'to': destination.id, 'items': [smallest_item]})
-
-                # Remove item from source and add to destination
-                source.remove_item(smallest_item)
-                destination.add_item(smallest_item)
-
-                # Record the move to prevent immediate reversal
-                self.record_move(smallest_item, source, destination)
-
-                # Update cached load values after the move
-                bucket_loads[source.id] -= smallest_item.load
-                bucket_loads[destination.id] += smallest_item.load
+            if self.budget.should_stop(len(moves)):
+                break  # Every prefix of the plan is feasible, so the moves so far are returned
+            if self.target_improvement is not None and initial_std_dev > 0:
+                std_dev = math.sqrt(max(0.0, squared_distance_sum) / len(self.buckets))
+                if (initial_std_dev - std_dev) / initial_std_dev >= self.target_improvement:
+                    break  # Good enough; further moves would only add migration time
+
+            # Start with the most overfilled and least underfilled buckets and fall back to the next ones when their move is blocked
+            item = None
+            for source_id, _ in overfilled.smallest(self.candidate_buckets):
+                source = buckets_by_id[source_id]
+                for destination_id, _ in underfilled.smallest(self.candidate_buckets):
+                    destination = buckets_by_id[destination_id]
+                    item = self.select_item(item_indexes[source.id], source, destination, targets[source.id], targets[destination.id])
+                    if item is not None:
+                        break
+                if item is not None:
+                    break
+            if item is None:
+                break  # Nothing changed, so every remaining iteration would reject the same moves
+
+            # Simulate the move
+            moves.append({'from': source.id, 'to': destination.id, 'items': [item]})
+
+            # Remove item from source and add to destination
+            imbalance -= abs(source.get_total_load() - targets[source.id]) + abs(destination.get_total_load() - targets[destination.id])
+            squared_distance_sum -= (source.get_total_load() - targets[source.id]) ** 2 + (destination.get_total_load() - targets[destination.id]) ** 2
+            source.remove_item(item)
+            destination.add_item(item)
+            imbalance += abs(source.get_total_load() - targets[source.id]) + abs(destination.get_total_load() - targets[destination.id])
+            squared_distance_sum += (source.get_total_load() - targets[source.id]) ** 2 + (destination.get_total_load() - targets[destination.id]) ** 2
+            item_indexes[source.id].remove(item)
+            item_indexes[destination.id].add(item)
+
+            # Record the move to prevent immediate reversal
+            self.record_move(item, source, destination)
+
+            # Only the two buckets touched by the move change position in the queues
+            for bucket in (source, destination):
+                self.update_bucket_queues(bucket, targets[bucket.id], positions[bucket.id], overfilled, underfilled)
+
+            self.budget.report(imbalance, len(moves))
 
         return moves
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """
+        Anytime entry point: balance the buckets within a deadline and move limit.
+
+        :param deadline: time.monotonic() timestamp by which the plan must be returned, or None.
+        :param max_moves: Maximum number of moves in the returned plan, or None.
+        :param progress: Optional callable invoked as progress(score, move_count), where score is the summed distance from the targets.
+        :return: The moves found before the deadline or move limit was reached.
+        """
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
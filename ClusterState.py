@@ -0,0 +1,198 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+from Bucket import Bucket
+from Item import Item
+
+class ClusterState:
+    def __init__(self, bucket_ids, capacities, hostnames, items, item_loads, item_movable, assignment, dimensions=None, item_resources=None, resource_capacities=None):
+        """
+        Initialize a compact array-backed view of the cluster.
+
+        :param bucket_ids: Bucket ids in bucket index order.
+        :param capacities: Array of bucket capacities, indexed by bucket index.
+        :param hostnames: Bucket hostnames in bucket index order.
+        :param items: Item objects in item index order, used when converting back to buckets and moves.
+        :param item_loads: Array of item loads, indexed by item index.
+        :param item_movable: Boolean array marking which items may be moved.
+        :param assignment: Integer array mapping each item index to the bucket index holding it.
+        :param dimensions: Optional resource names, e.g. ('memory', 'cpu'), for multi-dimensional balancing.
+        :param item_resources: (items x dimensions) array of resource usage, required with dimensions.
+        :param resource_capacities: (buckets x dimensions) array of resource capacities, inf where unlimited, required with dimensions.
+        """
+        self.bucket_ids = list(bucket_ids)
+        self.capacities = np.asarray(capacities, dtype=np.float64)
+        self.hostnames = list(hostnames)
+        self.items = list(items)
+        self.item_loads = np.asarray(item_loads, dtype=np.float64)
+        self.item_movable = np.asarray(item_movable, dtype=bool)
+        self.assignment = np.asarray(assignment, dtype=np.int64)
+        self.bucket_indexes = {bucket_id: index for index, bucket_id in enumerate(self.bucket_ids)}
+        self.item_indexes = {item.id: index for index, item in enumerate(self.items)}
+        self.dimensions = list(dimensions) if dimensions else None
+        self.item_resources = None if item_resources is None else np.asarray(item_resources, dtype=np.float64)
+        self.resource_capacities = None if resource_capacities is None else np.asarray(resource_capacities, dtype=np.float64)
+
+    @classmethod
+    def from_buckets(cls, buckets, dimensions=None):
+        """
+        Build a cluster state from a list of buckets, such as the output of ProxmoxManager.get_buckets() or BucketSimulator.simulate().
+
+        :param dimensions: Optional resource names, e.g. ('memory', 'cpu'), to also build the resource matrices.
+        """
+        items = []
+        assignment = []
+        for index, bucket in enumerate(buckets):
+            items.extend(bucket.items)
+            assignment.extend([index] * len(bucket.items))
+
+        item_resources = resource_capacities = None
+        if dimensions:
+            item_resources = [[item.get_resource(name) for name in dimensions] for item in items]
+            resource_capacities = [[bucket.get_resource_capacity(name) for name in dimensions] for bucket in buckets]
+
+        return cls(
+            [bucket.id for bucket in buckets],
+            [bucket.capacity for bucket in buckets],
+            [bucket.hostname for bucket in buckets],
+            items,
+            [item.load for item in items],
+            [item.movable for item in items],
+            assignment,
+            dimensions,
+            item_resources,
+            resource_capacities
+        )
+
+    @property
+    def bucket_count(self):
+        return len(self.bucket_ids)
+
+    @property
+    def item_count(self):
+        return len(self.items)
+
+    def copy(self):
+        """Return a copy of the state with its own assignment vector."""
+        state = ClusterState.__new__(ClusterState)
+        state.__dict__.update(self.__dict__)
+        state.assignment = self.assignment.copy()
+        return state
+
+    def get_bucket_loads(self, assignment=None):
+        """Return the total load of every bucket in one vectorized pass."""
+        assignment = self.assignment if assignment is None else assignment
+        return np.bincount(assignment, weights=self.item_loads, minlength=self.bucket_count)
+
+    def get_movable_loads(self, assignment=None):
+        """Return the load of the movable items in every bucket."""
+        assignment = self.assignment if assignment is None else assignment
+        return np.bincount(assignment, weights=self.item_loads * self.item_movable, minlength=self.bucket_count)
+
+    def get_resource_loads(self, assignment=None):
+        """Return the (buckets x dimensions) usage of every resource with a single bincount over all dimensions."""
+        assignment = self.assignment if assignment is None else assignment
+        dimension_count = len(self.dimensions)
+        flat_indexes = (assignment[:, None] * dimension_count + np.arange(dimension_count)).ravel()
+        flat_loads = np.bincount(flat_indexes, weights=self.item_resources.ravel(), minlength=self.bucket_count * dimension_count)
+        return flat_loads.reshape(self.bucket_count, dimension_count)
+
+    def get_item_counts(self, assignment=None):
+        """Return the number of items in every bucket."""
+        assignment = self.assignment if assignment is None else assignment
+        return np.bincount(assignment, minlength=self.bucket_count)
+
+    def get_targets(self):
+        """Return the capacity-proportional target load of every bucket."""
+        return self.capacities / self.capacities.sum() * self.item_loads.sum()
+
+    def is_feasible(self, assignment=None):
+        """Check that no bucket exceeds its capacity and that unmovable items have not moved."""
+        assignment = self.assignment if assignment is None else assignment
+        if np.any(self.get_bucket_loads(assignment) > self.capacities):
+            return False
+        return bool(np.all(self.item_movable[self.items_moved(assignment)]))
+
+    def items_moved(self, assignment, initial_assignment=None):
+        """Return the indexes of the items whose bucket differs between two assignments."""
+        initial_assignment = self.assignment if initial_assignment is None else initial_assignment
+        return np.flatnonzero(np.asarray(assignment) != initial_assignment)
+
+    def move_item(self, item_index, bucket_index):
+        """Reassign one item to another bucket."""
+        self.assignment[item_index] = bucket_index
+
+    def get_moves(self, initial_assignment):
+        """
+        Convert the difference between an initial assignment and the current one into balancer moves.
+
+        :param initial_assignment: Assignment vector the moves start from.
+        :return: List of moves in the balancer format ({'from', 'to', 'items'}).
+        """
+        return [
+            {'from': self.bucket_ids[initial_assignment[index]], 'to': self.bucket_ids[self.assignment[index]], 'items': [self.items[index]]}
+            for index in self.items_moved(self.assignment, initial_assignment)
+        ]
+
+    def get_optimized_moves(self, initial_assignment):
+        """
+        Return the direct moves from an initial assignment to the current one.
+
+        This matches the output of MoveOptimizer.optimize() for the same moves without replaying them.
+
+        :param initial_assignment: Assignment vector the moves start from.
+        :return: List of moves in the optimizer format ({'item_id', 'from', 'to'}).
+        """
+        return [
+            {'item_id': self.items[index].id, 'from': self.bucket_ids[initial_assignment[index]], 'to': self.bucket_ids[self.assignment[index]]}
+            for index in self.items_moved(self.assignment, initial_assignment)
+        ]
+
+    def apply_moves(self, moves):
+        """Replay balancer moves ({'from', 'to', 'items'}) onto the assignment vector."""
+        for move in moves:
+            bucket_index = self.bucket_indexes[move['to']]
+            for item in move['items']:
+                self.assignment[self.item_indexes[item.id]] = bucket_index
+
+    def apply_to_buckets(self, buckets):
+        """Move the items of an existing bucket list so it matches the current assignment."""
+        buckets_by_id = {bucket.id: bucket for bucket in buckets}
+        moved = []
+        for bucket in buckets:
+            for item in list(bucket.items):
+                destination_id = self.bucket_ids[self.assignment[self.item_indexes[item.id]]]
+                if destination_id != bucket.id:
+                    bucket.remove_item(item)
+                    moved.append((item, buckets_by_id[destination_id]))
+
+        # Add after all removals so a full destination can first release its own outgoing items
+        for item, destination in moved:
+            destination.add_item(item)
+
+    def to_buckets(self):
+        """Create new Bucket and Item objects that reflect the current assignment."""
+        buckets = [Bucket(bucket_id, capacity, hostname=hostname) for bucket_id, capacity, hostname in zip(self.bucket_ids, self.capacities.tolist(), self.hostnames)]
+        if self.dimensions:
+            for bucket, capacities in zip(buckets, self.resource_capacities.tolist()):
+                bucket.resource_capacities = {name: capacity for name, capacity in zip(self.dimensions, capacities) if name != 'memory' and capacity != float('inf')}
+        for item, load, movable, bucket_index in zip(self.items, self.item_loads.tolist(), self.item_movable.tolist(), self.assignment.tolist()):
+            bucket = buckets[bucket_index]
+            bucket.add_item(Item(item.id, bucket, load, movable=movable, color=item.color, resources=item.resources))
+        return buckets
+
+    def __repr__(self):
+        return f"ClusterState(buckets={self.bucket_count}, items={self.item_count}, total_load={self.item_loads.sum()})"
@@ -0,0 +1,444 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import heapq
+import json
+import random
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+GB = 1073741824
+
+CPU_MODELS = [
+    ('Intel(R) Xeon(R) Gold 6248R CPU @ 3.00GHz', 96),
+    ('AMD EPYC 7543 32-Core Processor', 64),
+    ('Intel(R) Xeon(R) E-2288G CPU @ 3.70GHz', 16),
+]
+
+STORAGES = {'local-lvm': {'shared': 0}, 'ceph': {'shared': 1}}  # Storage name -> whether every node sees it
+
+class FakeProxmoxServer:
+    def __init__(self, cluster=None, host='127.0.0.1', port=0, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 migration_bandwidth=1.25 * GB, migration_failure_rate=0.0, certfile=None, keyfile=None, seed=None):
+        """
+        Initialize a self-contained fake PVE REST API server backed by a synthetic cluster.
+
+        :param cluster: Cluster definition as returned by generate_cluster(). Defaults to a small generated cluster.
+        :param host: Address to listen on.
+        :param port: Port to listen on, 0 to pick a free port.
+        :param latency: Seconds added to every request.
+        :param latency_jitter: Maximum random seconds added on top of the latency.
+        :param error_rate: Probability that a request fails with HTTP 500.
+        :param migration_bandwidth: Bytes per second used to derive how long a migration task runs.
+        :param migration_failure_rate: Probability that a migration task ends with an error.
+        :param certfile: TLS certificate to serve HTTPS (required by proxmoxer), or None for plain HTTP.
+        :param keyfile: TLS private key matching certfile.
+        :param seed: Seed for the latency, error and failure injection.
+        """
+        self.cluster = cluster if cluster is not None else self.generate_cluster()
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.migration_bandwidth = migration_bandwidth
+        self.migration_failure_rate = migration_failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()  # Guards changes to the cluster and the tasks, and the request counters
+        self.tasks = {}  # UPID -> task dict
+        self.running_tasks = []  # Heap of (end time, UPID) of the tasks still running
+        self.used_memory = {name: node['system_mem'] for name, node in self.cluster['nodes'].items()}
+        for vm in self.cluster['vms'].values():
+            self.add_vm_memory(vm, 1)
+        self.task_counter = 0
+        self.ticket = 'PVE:fake@pve:00000000::fake-ticket'
+        self.csrf_token = '00000000:fake-csrf-token'
+        self.request_count = 0
+        self.path_counts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.scheme = 'http'
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+            self.scheme = 'https'
+        self.thread = None
+
+    @staticmethod
+    def generate_cluster(node_count=4, vms_per_node=20, seed=0):
+        """
+        Generate a synthetic cluster definition.
+
+        :return: Dict with 'nodes' (name -> node facts) and 'vms' (vmid -> VM facts), sizes in bytes.
+        """
+        rng = random.Random(seed)
+        disk_rng = random.Random(f"{seed}-disks")  # Separate stream so the disks do not change the rest of the cluster
+        cluster = {'nodes': {}, 'vms': {}}
+        vmid = 100
+        for index in range(node_count):
+            name = f"pve{index + 1:02d}"
+            model, cpus = rng.choice(CPU_MODELS)
+            cluster['nodes'][name] = {
+                'maxmem': rng.choice([128, 256, 384, 512]) * GB,
+                'system_mem': rng.randint(2, 8) * GB,
+                'maxcpu': cpus,
+                'cpu_model': model,
+                'status': 'online',
+            }
+            for _ in range(vms_per_node):
+                maxmem = rng.choice([1, 2, 4, 8, 16]) * GB
+                cluster['vms'][vmid] = {
+                    'node': name,
+                    'name': f"vm{vmid}",
+                    'status': 'running' if rng.random() < 0.9 else 'stopped',
+                    'maxmem': maxmem,
+                    'mem': int(maxmem * rng.uniform(0.2, 0.9)),
+                    'cpus': rng.choice([1, 2, 4, 8]),
+                    'cpu': rng.uniform(0.0, 0.5),
+                    'disks': {'scsi0': ('local-lvm' if disk_rng.random() < 0.3 else 'ceph', disk_rng.choice([16, 32, 64, 128]))},
+                }
+                vmid += 1
+        return cluster
+
+    @property
+    def url(self):
+        """Base URL of the API, e.g. 'http://127.0.0.1:8006/api2/json'."""
+        host, port = self.server.server_address[:2]
+        return f"{self.scheme}://{host}:{port}/api2/json"
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        """Serve requests on a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def add_vm_memory(self, vm, sign):
+        """Add (sign 1) or remove (sign -1) the memory of a running VM on its node and on the node it is migrating to."""
+        if vm['status'] != 'running':
+            return
+        self.used_memory[vm['node']] += sign * vm['mem']
+        if vm.get('migrating_to'):
+            self.used_memory[vm['migrating_to']] += sign * vm['mem']
+
+    def node_used_memory(self, node):
+        """Used memory of a node, including VMs that are migrating onto it."""
+        return self.used_memory[node]
+
+    def node_resource(self, name):
+        node = self.cluster['nodes'][name]
+        return {
+            'type': 'node', 'id': f"node/{name}", 'node': name, 'status': node['status'],
+            'maxmem': node['maxmem'], 'mem': self.node_used_memory(name),
+            'maxcpu': node['maxcpu'], 'cpu': self.random.uniform(0.05, 0.6),
+        }
+
+    def vm_resource(self, vmid):
+        vm = self.cluster['vms'][vmid]
+        running = vm['status'] == 'running'
+        return {
+            'type': 'qemu', 'id': f"qemu/{vmid}", 'vmid': vmid, 'name': vm['name'], 'node': vm['node'],
+            'status': vm['status'], 'maxmem': vm['maxmem'], 'mem': vm['mem'] if running else 0,
+            'maxcpu': vm['cpus'], 'cpus': vm['cpus'], 'cpu': vm['cpu'] if running else 0, 'template': 0,
+        }
+
+    def find_vm(self, node, vmid):
+        vm = self.cluster['vms'].get(int(vmid))
+        if vm is None or vm['node'] != node:
+            raise LookupError(f"Configuration file 'nodes/{node}/qemu-server/{vmid}.conf' does not exist")
+        return vm
+
+    def advance_tasks(self):
+        """Complete the migration tasks whose time has passed."""
+        now = time.time()
+        with self.lock:
+            while self.running_tasks and self.running_tasks[0][0] <= now:
+                _, upid = heapq.heappop(self.running_tasks)
+                task = self.tasks[upid]
+                vm = self.cluster['vms'][task['vmid']]
+                self.add_vm_memory(vm, -1)
+                vm.pop('migrating_to', None)
+                if task['fail']:
+                    task['exitstatus'] = 'migration aborted'
+                else:
+                    vm['node'] = task['target']
+                    task['exitstatus'] = 'OK'
+                self.add_vm_memory(vm, 1)
+                task['status'] = 'stopped'
+
+    def create_task(self, node, vmid, task_type, start, endtime):
+        """Create a task for a VM, running until endtime, and return it."""
+        self.task_counter += 1
+        upid = f"UPID:{node}:{self.task_counter:08X}:{self.task_counter:08X}:{int(start):08X}:{task_type}:{vmid}:fake@pve:"
+        task = {
+            'upid': upid, 'node': node, 'type': task_type, 'id': str(vmid), 'user': 'fake@pve',
+            'vmid': int(vmid), 'target': node, 'starttime': int(start), 'endtime': endtime, 'status': 'running', 'fail': False,
+        }
+        self.tasks[upid] = task
+        return task
+
+    def start_migration(self, node, vmid, form):
+        """Create a migration task for a VM and return its UPID."""
+        with self.lock:
+            vm = self.find_vm(node, vmid)
+            target = form.get('target')
+            if target not in self.cluster['nodes'] or target == node:
+                raise ValueError(f"invalid target node '{target}'")
+            if vm.get('migrating_to'):
+                raise ValueError(f"VM {vmid} is locked (migrate)")
+            if vm['status'] == 'running' and str(form.get('online', '0')) != '1':
+                raise ValueError("can't migrate running VM without --online")
+
+            start = time.time()
+            task = self.create_task(node, vmid, 'qmigrate', start, start + vm['mem'] / self.migration_bandwidth)
+            task['target'] = target
+            task['fail'] = self.random.random() < self.migration_failure_rate
+            heapq.heappush(self.running_tasks, (task['endtime'], task['upid']))
+            # A running VM occupies memory on both nodes while it migrates
+            self.add_vm_memory(vm, -1)
+            vm['migrating_to'] = target
+            self.add_vm_memory(vm, 1)
+            return task['upid']
+
+    def set_vm_status(self, node, vmid, status):
+        """Start ('running') or stop ('stopped') a VM at once and return the UPID of the finished task."""
+        with self.lock:
+            vm = self.find_vm(node, vmid)
+            if vm.get('migrating_to'):
+                raise ValueError(f"VM {vmid} is locked (migrate)")
+            self.add_vm_memory(vm, -1)
+            vm['status'] = status
+            self.add_vm_memory(vm, 1)
+
+            now = time.time()
+            task = self.create_task(node, vmid, 'qmstart' if status == 'running' else 'qmstop', now, now)
+            task['exitstatus'] = 'OK'
+            task['status'] = 'stopped'
+            return task['upid']
+
+    def task_entry(self, task):
+        """Task as listed by /cluster/tasks: finished tasks carry their exit status and end time."""
+        entry = {key: task[key] for key in ('upid', 'node', 'type', 'id', 'user', 'starttime')}
+        if task['status'] == 'stopped':
+            entry['status'] = task['exitstatus']
+            entry['endtime'] = int(task['endtime'])
+        return entry
+
+    def route(self, method, path, query, form):
+        """Dispatch a request to the synthetic cluster and return the response data."""
+        nodes = self.cluster['nodes']
+        vms = self.cluster['vms']
+        self.advance_tasks()
+
+        if method == 'GET' and path == '/nodes':
+            return [self.node_resource(name) for name in nodes]
+
+        if method == 'GET' and path == '/cluster/resources':
+            resource_type = query.get('type')
+            resources = []
+            if resource_type in (None, 'node'):
+                resources.extend(self.node_resource(name) for name in nodes)
+            if resource_type in (None, 'vm'):
+                resources.extend(self.vm_resource(vmid) for vmid in vms)
+            if resource_type in (None, 'storage'):
+                resources.extend({'type': 'storage', 'id': f"storage/{name}/{storage}", 'storage': storage, 'node': name, 'shared': facts['shared'],
+                                  'status': 'available'} for name in nodes for storage, facts in STORAGES.items())
+            return resources
+
+        if method == 'GET' and path == '/cluster/tasks':
+            with self.lock:
+                tasks = list(self.tasks.values())
+            return [self.task_entry(task) for task in tasks]
+
+        match = re.fullmatch(r'/nodes/([^/]+)(/.*)?', path)
+        if not match or match.group(1) not in nodes:
+            raise LookupError(f"no such resource '{path}'")
+        node, rest = match.group(1), match.group(2) or ''
+
+        if method == 'GET' and rest == '/status':
+            used = self.node_used_memory(node)
+            return {
+                'cpu': self.random.uniform(0.05, 0.6),
+                'memory': {'total': nodes[node]['maxmem'], 'used': used, 'free': nodes[node]['maxmem'] - used},
+                'cpuinfo': {'model': nodes[node]['cpu_model'], 'cpus': nodes[node]['maxcpu'], 'sockets': 2, 'cores': nodes[node]['maxcpu'] // 4},
+            }
+
+        if method == 'GET' and rest == '/qemu':
+            return [self.vm_resource(vmid) for vmid, vm in vms.items() if vm['node'] == node]
+
+        match = re.fullmatch(r'/qemu/(\d+)/status/current', rest)
+        if method == 'GET' and match:
+            self.find_vm(node, match.group(1))
+            return self.vm_resource(int(match.group(1)))
+
+        match = re.fullmatch(r'/qemu/(\d+)/config', rest)
+        if method == 'GET' and match:
+            vm = self.find_vm(node, match.group(1))
+            config = {'name': vm['name'], 'memory': vm['maxmem'] // 1048576, 'cores': vm['cpus']}
+            for key, (storage, size) in vm.get('disks', {}).items():
+                config[key] = f"{storage}:vm-{match.group(1)}-disk-0,size={size}G"
+            return config
+
+        match = re.fullmatch(r'/qemu/(\d+)/migrate', rest)
+        if method == 'POST' and match:
+            return self.start_migration(node, match.group(1), form)
+
+        match = re.fullmatch(r'/qemu/(\d+)/status/(start|stop)', rest)
+        if method == 'POST' and match:
+            return self.set_vm_status(node, match.group(1), 'running' if match.group(2) == 'start' else 'stopped')
+
+        match = re.fullmatch(r'/tasks/([^/]+)/status', rest)
+        if method == 'GET' and match:
+            task = self.tasks.get(match.group(1))
+            if task is None or task['node'] != node:
+                raise LookupError(f"no such task '{match.group(1)}'")
+            status = {'upid': task['upid'], 'node': node, 'type': task['type'], 'id': task['id'], 'status': task['status']}
+            if task['status'] == 'stopped':
+                status['exitstatus'] = task['exitstatus']
+            return status
+
+        raise LookupError(f"no such resource '{path}'")
+
+    def make_handler(self):
+        """Create the request handler class bound to this server."""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, so clients can pool connections
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json;charset=UTF-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_form(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode() if length else ''
+                if 'json' in (self.headers.get('Content-Type') or ''):
+                    return json.loads(body or '{}')
+                return {key: values[-1] for key, values in parse_qs(body).items()}
+
+            def authenticated(self):
+                return f"PVEAuthCookie={fake.ticket}" in (self.headers.get('Cookie') or '') or self.headers.get('Authorization', '').startswith('PVEAPIToken=')
+
+            def handle_request(self, method):
+                parsed = urlparse(self.path)
+                form = self.read_form() if method in ('POST', 'PUT') else {}
+                query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+                path = parsed.path[len('/api2/json'):] if parsed.path.startswith('/api2/json') else parsed.path
+
+                with fake.lock:
+                    fake.request_count += 1
+                    fake.path_counts[path] = fake.path_counts.get(path, 0) + 1
+                    fake.in_flight += 1
+                    fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                    delay = fake.latency + fake.random.uniform(0, fake.latency_jitter)
+                    inject_error = fake.random.random() < fake.error_rate
+                try:
+                    if delay:
+                        time.sleep(delay)
+
+                    if method == 'POST' and path == '/access/ticket':
+                        self.send_json(200, {'data': {'ticket': fake.ticket, 'CSRFPreventionToken': fake.csrf_token, 'username': form.get('username')}})
+                        return
+                    if not self.authenticated():
+                        self.send_json(401, {'data': None, 'message': 'authentication failure'})
+                        return
+                    if inject_error:
+                        self.send_json(500, {'data': None, 'message': 'injected error'})
+                        return
+
+                    # route() only takes the lock for the changes, so reads do not wait for each other
+                    try:
+                        data = fake.route(method, path, query, form)
+                        status = 200
+                    except LookupError as e:
+                        data, status = str(e), 404
+                    except ValueError as e:
+                        data, status = str(e), 400
+                    if status == 200:
+                        self.send_json(200, {'data': data})
+                    else:
+                        self.send_json(status, {'data': None, 'message': data})
+                finally:
+                    with fake.lock:
+                        fake.in_flight -= 1
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a fake Proxmox VE API backed by a synthetic cluster.")
+    parser.add_argument('--nodes', type=int, default=4, help="Number of nodes (default: 4)")
+    parser.add_argument('--vms-per-node', type=int, default=20, help="Number of VMs per node (default: 20)")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8006, help="Port to listen on (default: 8006)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help="Maximum random seconds added on top of the latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Probability that a request fails with HTTP 500")
+    parser.add_argument('--migration-failure-rate', type=float, default=0.0, help="Probability that a migration task fails")
+    parser.add_argument('--certfile', help="TLS certificate, required for proxmoxer clients")
+    parser.add_argument('--keyfile', help="TLS private key")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the cluster and the injected faults")
+    args = parser.parse_args()
+
+    server = FakeProxmoxServer(
+        FakeProxmoxServer.generate_cluster(args.nodes, args.vms_per_node, args.seed),
+        host=args.host, port=args.port, latency=args.latency, latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate, migration_failure_rate=args.migration_failure_rate,
+        certfile=args.certfile, keyfile=args.keyfile, seed=args.seed
+    )
+    print(f"Serving fake Proxmox API for {args.nodes} nodes and {args.nodes * args.vms_per_node} VMs at {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
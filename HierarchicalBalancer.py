@@ -0,0 +1,134 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+from Bucket import Bucket
+from BucketBalancer import BucketBalancer
+from Item import Item
+from PartitionedBalancer import PartitionedBalancer
+from SolverBudget import SolverBudget
+
+class HierarchicalBalancer:
+    def __init__(self, buckets, zones=None, zone_size=None, max_workers=None, history=None):
+        """
+        Initialize a two-level balancer that first evens out the load between zones of nodes and then balances within each zone.
+
+        :param buckets: List of buckets to balance.
+        :param zones: Optional iterable of hostname lists, e.g. racks or ProxmoxManager.group_nodes_by_cpu(node_stats).values(); by default the buckets are split into zones of zone_size by hostname.
+        :param zone_size: Number of buckets per automatic zone, by default the square root of the bucket count.
+        :param max_workers: Maximum number of worker processes for the zones, or None for one per zone up to the CPU count.
+        :param history: Optional MoveHistoryStore whose cool-downs and migration limits from earlier runs the moves have to respect.
+        """
+        self.buckets = buckets
+        self.max_workers = max_workers
+        self.history = history
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
+
+        if zones is None:
+            zone_size = zone_size or max(2, round(math.sqrt(len(buckets))))
+            hostnames = sorted(bucket.hostname for bucket in buckets)
+            zones = [hostnames[start:start + zone_size] for start in range(0, len(hostnames), zone_size)]
+
+        # PartitionedBalancer resolves the hostnames and collects the buckets in no zone into one more zone
+        self.zone_balancer = PartitionedBalancer(buckets, zones, max_workers=max_workers, history=history)
+        self.zones = self.zone_balancer.partitions
+
+    def get_zone_buckets(self, pinned=()):
+        """
+        Build one bucket per zone holding the zone's movable items, with all other load folded into one unmovable item.
+
+        :param pinned: Ids of movable items that have to stay in their zone and are folded into the unmovable item as well.
+        """
+        zone_buckets = []
+        for index, zone in enumerate(self.zones):
+            zone_bucket = Bucket(index, sum(bucket.capacity for bucket in zone), hostname=f"zone{index}")
+            movable_items = [item for bucket in zone for item in bucket.items if item.movable and item.id not in pinned]
+            fixed_load = sum(bucket.get_total_load() - bucket.get_movable_load() for bucket in zone)
+            fixed_load += sum(item.load for bucket in zone for item in bucket.items if item.movable and item.id in pinned)
+            zone_bucket.items = [Item(f"zone{index}-fixed", zone_bucket, fixed_load, movable=False)] + movable_items
+            zone_buckets.append(zone_bucket)
+        return zone_buckets
+
+    def find_destination(self, zone, item, source):
+        """Return the least utilized bucket of a zone that has room for the item and that it may move to from its source, or None if none has."""
+        candidates = [bucket for bucket in zone if bucket.get_total_load() + item.load <= bucket.capacity
+                      and (self.history is None or self.history.may_move(item.id, source.hostname, bucket.hostname))]
+        return min(candidates, key=lambda bucket: bucket.get_total_load() / bucket.capacity, default=None)
+
+    def balance_zones(self):
+        """
+        Balance the aggregate load between zones and place every item that changes zones on the least utilized node of its new zone.
+
+        A zone move that no single node of the new zone can take is skipped. The zone buckets are then rebuilt from the actual
+        placement with the skipped items pinned, and the zones are balanced again, so later zone moves never rely on a skipped one.
+
+        :return: List of balancer moves between buckets of different zones.
+        """
+        bucket_by_item = {item.id: bucket for bucket in self.buckets for item in bucket.items}
+        pinned = set()
+        moves = []
+        while not self.budget.should_stop(len(moves)):
+            # Zones aggregate many nodes, so evening them out can take more moves than the default iteration limit
+            zone_buckets = self.get_zone_buckets(pinned)
+            zone_balancer = BucketBalancer(zone_buckets, max_iterations=sum(bucket.get_item_count() for bucket in zone_buckets), history=self.history)
+            zone_moves = zone_balancer.balance(deadline=self.budget.deadline, max_moves=self.budget.moves_left(len(moves)))
+
+            skipped = False
+            for zone_move in zone_moves:
+                for item in zone_move['items']:
+                    source = bucket_by_item[item.id]
+                    destination = self.find_destination(self.zones[zone_move['to']], item, source)
+                    if destination is None:
+                        # The zone has room in total but no single node can take the item, or the item may not move to any of them
+                        pinned.add(item.id)
+                        skipped = True
+                        continue
+                    source.remove_item(item)
+                    destination.add_item(item)
+                    bucket_by_item[item.id] = destination
+                    moves.append({'from': source.id, 'to': destination.id, 'items': [item]})
+            if not skipped:
+                break
+        return moves
+
+    def balance_buckets(self):
+        """
+        Balance the zones against each other, then balance inside every zone in parallel.
+
+        :return: List of balancer moves; MoveOptimizer merges the moves of the two levels into one direct move per item.
+        """
+        moves = self.balance_zones() if len(self.zones) > 1 else []
+        if not self.budget.should_stop(len(moves)):
+            # Items that changed zones are checked against the history from the node they started on
+            hostnames = {bucket.id: bucket.hostname for bucket in self.buckets}
+            self.zone_balancer.origins = {item.id: hostnames[move['from']] for move in moves for item in move['items']}
+            moves.extend(self.zone_balancer.balance(deadline=self.budget.deadline, max_moves=self.budget.moves_left(len(moves))))
+        self.budget.report(self.zone_balancer.get_imbalance(), len(moves))
+        return moves
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """
+        Anytime entry point: balance the buckets within a deadline and move limit.
+
+        :param deadline: time.monotonic() timestamp by which the plan must be returned, or None.
+        :param max_moves: Maximum number of moves in the returned plan, or None.
+        :param progress: Optional callable invoked as progress(score, move_count) once the plan is complete, where score is the summed distance from the cluster-wide targets.
+        :return: The moves found before the deadline or move limit was reached.
+        """
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
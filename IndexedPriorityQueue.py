@@ -0,0 +1,113 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+
+class IndexedPriorityQueue:
+    def __init__(self):
+        """
+        Initialize an empty min-priority queue whose entries can be updated or removed by key.
+
+        Entries are kept in a binary heap alongside a key -> heap position map, so
+        push, update and remove are O(log n) and peek is O(1).
+        """
+        self.heap = []  # List of (priority, key) pairs
+        self.positions = {}  # Key -> index in self.heap
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def push(self, key, priority):
+        """Insert a key with the given priority, or update its priority if it is already queued."""
+        if key in self.positions:
+            self.update(key, priority)
+            return
+
+        self.heap.append((priority, key))
+        self.positions[key] = len(self.heap) - 1
+        self.sift_up(len(self.heap) - 1)
+
+    def update(self, key, priority):
+        """Change the priority of a queued key."""
+        position = self.positions[key]
+        old_priority = self.heap[position][0]
+        self.heap[position] = (priority, key)
+        if priority < old_priority:
+            self.sift_up(position)
+        else:
+            self.sift_down(position)
+
+    def remove(self, key):
+        """Remove a key from the queue if it is present."""
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+
+        last_entry = self.heap.pop()
+        if position < len(self.heap):
+            self.heap[position] = last_entry
+            self.positions[last_entry[1]] = position
+            self.sift_up(position)
+            self.sift_down(self.positions[last_entry[1]])
+
+    def peek(self):
+        """Return the (key, priority) pair with the lowest priority without removing it."""
+        priority, key = self.heap[0]
+        return key, priority
+
+    def smallest(self, count):
+        """Return up to count (key, priority) pairs with the lowest priorities, lowest first, without removing them."""
+        return [(key, priority) for priority, key in heapq.nsmallest(count, self.heap)]
+
+    def pop(self):
+        """Remove and return the (key, priority) pair with the lowest priority."""
+        key, priority = self.peek()
+        self.remove(key)
+        return key, priority
+
+    def swap(self, i, j):
+        """Swap two heap entries and keep the position map in sync."""
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.positions[self.heap[i][1]] = i
+        self.positions[self.heap[j][1]] = j
+
+    def sift_up(self, position):
+        """Move an entry towards the root until the heap property holds."""
+        while position > 0:
+            parent = (position - 1) // 2
+            if self.heap[position][0] < self.heap[parent][0]:
+                self.swap(position, parent)
+                position = parent
+            else:
+                break
+
+    def sift_down(self, position):
+        """Move an entry towards the leaves until the heap property holds."""
+        size = len(self.heap)
+        while True:
+            smallest = position
+            left = 2 * position + 1
+            right = left + 1
+            if left < size and self.heap[left][0] < self.heap[smallest][0]:
+                smallest = left
+            if right < size and self.heap[right][0] < self.heap[smallest][0]:
+                smallest = right
+            if smallest == position:
+                break
+            self.swap(position, smallest)
+            position = smallest
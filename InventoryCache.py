@@ -0,0 +1,95 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+
+class InventoryCache:
+    def __init__(self, path, static_ttl=86400, guest_list_ttl=3600):
+        """
+        Initialize an on-disk snapshot of the slowly changing parts of the cluster inventory.
+
+        Static node facts (total memory, CPU info) and the VM list of each node are stored with the
+        time they were fetched. Volatile fields (used memory, VM running state) are never cached.
+
+        :param path: Path of the JSON snapshot file.
+        :param static_ttl: Seconds before static node facts are fetched again.
+        :param guest_list_ttl: Seconds before a node's VM list is fully refreshed again.
+        """
+        self.path = path
+        self.static_ttl = static_ttl
+        self.guest_list_ttl = guest_list_ttl
+        self.snapshot = {'version': 1, 'nodes': {}, 'guests': {}}
+        self.load()
+
+    def load(self):
+        """Load the snapshot from disk, starting empty if it is missing or unreadable."""
+        try:
+            with open(self.path, 'r') as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') == 1:
+                self.snapshot = snapshot
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable inventory cache {self.path}: {e}")
+
+    def save(self):
+        """Write the snapshot to disk atomically."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.snapshot, f)
+        os.replace(temp_path, self.path)
+
+    def is_fresh(self, entry, ttl, now=None):
+        """Check if a cache entry exists and is younger than its time to live."""
+        now = time.time() if now is None else now
+        return entry is not None and now - entry['updated'] <= ttl
+
+    def get_static(self, node):
+        """Return the cached static facts of a node ({'max_memory', 'cpu_info'}), or None if missing or expired."""
+        entry = self.snapshot['nodes'].get(node)
+        return entry if self.is_fresh(entry, self.static_ttl) else None
+
+    def put_static(self, node, max_memory, cpu_info):
+        """Store the static facts of a node."""
+        self.snapshot['nodes'][node] = {'max_memory': max_memory, 'cpu_info': cpu_info, 'updated': time.time()}
+
+    def get_guests(self, node):
+        """Return the cached VM ids of a node, or None if missing or expired."""
+        entry = self.snapshot['guests'].get(node)
+        return entry['vmids'] if self.is_fresh(entry, self.guest_list_ttl) else None
+
+    def put_guests(self, node, vmids):
+        """Store the VM ids of a node after a full refresh."""
+        self.snapshot['guests'][node] = {'vmids': sorted(vmids), 'updated': time.time()}
+
+    def update_guests(self, node, vmids):
+        """
+        Replace the VM ids of a node after a delta refresh, keeping the time of the last full refresh.
+
+        :return: Tuple of (added, removed) VM id sets compared to the cached list.
+        """
+        entry = self.snapshot['guests'].get(node)
+        cached = set(entry['vmids']) if entry else set()
+        current = set(vmids)
+        if entry:
+            entry['vmids'] = sorted(current)
+        else:
+            self.put_guests(node, current)
+        return current - cached, cached - current
@@ -14,7 +14,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 class Item:
-    def __init__(self, id, bucket, load, movable=True, color=None):
+    def __init__(self, id, bucket, load, movable=True, color=None, resources=None):
         """
         Initialize an item in the bucket.
 
@@ -22,12 +22,18 @@ class Item:
         :param bucket: The bucket to which this item belongs.
         :param load: The load (memory usage) of the item.
         :param movable: Whether the item can be moved (True for dynamic, False for static).
+        :param resources: Optional usage of other resources by name, e.g. {'cpu': 1.5} in cores; the load is the 'memory' resource.
         """
         self.id = id
         self.bucket = bucket
         self.load = load
         self.movable = movable  # True if the item can be moved, False otherwise
         self.color = color
+        self.resources = resources or {}
+
+    def get_resource(self, name):
+        """Return the item's usage of a resource, where 'memory' is the load and missing resources are zero."""
+        return self.load if name == 'memory' else self.resources.get(name, 0)
 
     def __repr__(self):
         return f"Item(id={self.id}, load={self.load}, movable={self.movable})"
\ No newline at end of file
@@ -0,0 +1,81 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import itertools
+
+class ItemLoadIndex:
+    def __init__(self, items=()):
+        """
+        Initialize a per-bucket index that keeps items ordered by load.
+
+        :param items: Items to index initially.
+        """
+        self.keys = []  # Sorted list of (load, sequence) pairs
+        self.items = []  # Items in the same order as self.keys
+        self.item_keys = {}  # Item id -> key in self.keys
+        self.sequence = itertools.count()  # Tie-breaker so equal loads keep insertion order
+
+        for item in sorted(items, key=lambda item: item.load):
+            key = (item.load, next(self.sequence))
+            self.keys.append(key)
+            self.items.append(item)
+            self.item_keys[item.id] = key
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item.id in self.item_keys
+
+    def add(self, item):
+        """Insert an item at its load-ordered position."""
+        key = (item.load, next(self.sequence))
+        position = bisect.bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.items.insert(position, item)
+        self.item_keys[item.id] = key
+
+    def remove(self, item):
+        """Remove an item from the index if it is present."""
+        key = self.item_keys.pop(item.id, None)
+        if key is None:
+            return
+        position = bisect.bisect_left(self.keys, key)
+        del self.keys[position]
+        del self.items[position]
+
+    def smallest(self):
+        """Return the item with the smallest load, or None if the index is empty."""
+        return self.items[0] if self.items else None
+
+    def spread(self, count):
+        """Return up to count items at evenly spaced positions of the load order, from the smallest to the largest."""
+        if len(self.items) <= count:
+            return list(self.items)
+        step = (len(self.items) - 1) / (count - 1) if count > 1 else 0
+        return [self.items[round(position * step)] for position in range(count)]
+
+    def nearest(self, load):
+        """Yield the items in order of increasing distance between their load and the given load, starting from a bisection."""
+        right = bisect.bisect_left(self.keys, (load,))
+        left = right - 1
+        while left >= 0 or right < len(self.items):
+            if right >= len(self.items) or (left >= 0 and load - self.keys[left][0] <= self.keys[right][0] - load):
+                yield self.items[left]
+                left -= 1
+            else:
+                yield self.items[right]
+                right += 1
@@ -13,23 +13,40 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import sys
 from ProxmoxManager import ProxmoxManager
-from BucketBalancer import BucketBalancer
+from BalancerSelector import BalancerSelector
 from BucketVisualizer import BucketVisualizer
+from LoadEstimator import LoadEstimator
 from LoadStatistics import LoadStatistics
+from MetricsHistory import MetricsHistory
+from MoveHistoryStore import MoveHistoryStore
 from MoveOptimizer import MoveOptimizer
+from MigrationCostModel import MigrationCostModel
+from MigrationExecutor import MigrationExecutor
+from WaveScheduler import WaveScheduler
 
-# Proxmox API connection details
-host = '192.168.1.10'
-user = 'xxxxxx@pve'
-password = 'ASecurePassword123'
+# Proxmox API connection details, which can be overridden from the environment (e.g. to point at FakeProxmoxServer)
+host = os.environ.get('PROXMOX_HOST', '192.168.1.10')
+user = os.environ.get('PROXMOX_USER', 'xxxxxx@pve')
+password = os.environ.get('PROXMOX_PASSWORD', 'ASecurePassword123')
 
 # Initialize ProxmoxManager to manage Proxmox information
 proxmox_manager = ProxmoxManager(host, user, password)
 
 # Create buckets with initial loads
 specific_hosts = ['pve01', 'pve02', 'pve03', 'pve04']
-buckets_initial = proxmox_manager.get_buckets(host_names=specific_hosts)
+if 'PROXMOX_HOSTS' in os.environ:
+    specific_hosts = [name for name in os.environ['PROXMOX_HOSTS'].split(',') if name] or None  # Empty selects every host
+# Optionally smooth the VM loads over the history recorded by the daemon, e.g. PROXMOX_ESTIMATOR=percentile
+estimator = None
+if os.environ.get('PROXMOX_ESTIMATOR'):
+    history = MetricsHistory(os.environ['PROXMOX_HISTORY']) if os.environ.get('PROXMOX_HISTORY') else None
+    estimator = LoadEstimator(os.environ['PROXMOX_ESTIMATOR'], history=history)
+node_stats, vms_by_node = proxmox_manager.get_inventory(host_names=specific_hosts)
+estimated_loads = estimator.update_inventory(vms_by_node) if estimator is not None else None
+buckets_initial = proxmox_manager.build_buckets(node_stats, vms_by_node, estimated_loads)
 
 # Visualize the initial state of the buckets
 visualizer = BucketVisualizer(buckets_initial, "Initial Bucket Loads")
@@ -38,9 +55,30 @@ visualizer.visualize()
 load_stats = LoadStatistics(buckets_initial)
 std_dev_init = load_stats.calculate_standard_deviation()
 
-# Balance the buckets based on the real node usage
-balancer = BucketBalancer(buckets_initial)
-moves = balancer.balance_buckets()
+# Optionally weigh moves by their estimated migration time, from VM memory, local disks and the link bandwidth (GB/s)
+cost_model = None
+if os.environ.get('PROXMOX_COST_AWARE') == '1':
+    cost_model = MigrationCostModel(bandwidth=float(os.environ.get('PROXMOX_MIGRATION_BANDWIDTH', 1.25)),
+                                    local_disks=proxmox_manager.get_local_disk_sizes(vms_by_node))
+
+# Remember executed migrations across runs, so a VM is not moved again within PROXMOX_COOLDOWN seconds, moved back within PROXMOX_REVERSE_COOLDOWN
+# or migrated more than PROXMOX_MAX_MIGRATIONS times a day
+move_history = None
+if os.environ.get('PROXMOX_MOVE_HISTORY'):
+    move_history = MoveHistoryStore(os.environ['PROXMOX_MOVE_HISTORY'], cooldown=float(os.environ.get('PROXMOX_COOLDOWN', 3600)),
+                                    reverse_cooldown=float(os.environ.get('PROXMOX_REVERSE_COOLDOWN', 86400)),
+                                    max_migrations=int(os.environ['PROXMOX_MAX_MIGRATIONS']) if os.environ.get('PROXMOX_MAX_MIGRATIONS') else None)
+migration_budget = int(os.environ['PROXMOX_MIGRATION_BUDGET']) if os.environ.get('PROXMOX_MIGRATION_BUDGET') else None  # Maximum moves per run
+
+# Balance the buckets based on the real node usage, optionally across memory and CPU with PROXMOX_CPU_WEIGHT (e.g. 0.5)
+# or per CPU model and core count with PROXMOX_PARTITION=cpu, where PROXMOX_CROSS_PARTITION=1 also moves VMs without the 'host' CPU type between groups,
+# or between and then within zones of nodes with PROXMOX_ZONES ('auto' or e.g. 'pve01,pve02;pve03,pve04')
+try:
+    balancer = BalancerSelector.from_environment().select(buckets_initial, proxmox_manager, node_stats, vms_by_node, cost_model=cost_model, history=move_history)
+except ValueError as e:
+    print(e)
+    sys.exit(1)
+moves = balancer.balance(max_moves=migration_budget)
 
 # Visualize the final state after balancing
 visualizer = BucketVisualizer(buckets_initial, "Final Bucket Loads After Balancing")
@@ -51,9 +89,32 @@ std_dev_post = load_stats.calculate_standard_deviation()
 print(f"Initial Std Dev: {std_dev_init}, Post-Balancing Std Dev: {std_dev_post}")
 print(f"Improvement: {(std_dev_init - std_dev_post) / std_dev_init * 100:.2f}%")
 
-optimizer = MoveOptimizer(moves)
+optimizer = MoveOptimizer(moves, cost_model=cost_model)
 optimized_moves = optimizer.optimize()
+if cost_model is not None:
+    transfer, seconds = optimizer.get_total_cost(optimized_moves)
+    print(f"Estimated migration cost: {transfer:.1f} GB, {seconds:.1f}s of transfer")
+
+# Order the moves into waves that keep every node within its capacity while the VMs are in flight
+scheduler = WaveScheduler(buckets_initial, optimized_moves, cost_model=cost_model)
+waves = scheduler.schedule()
 
 # Print the final moves
-for move in optimized_moves:
-    print(f"Move item {move['item_id']} from Bucket {move['from']} to Bucket {move['to']}")
+for wave_number, wave in enumerate(waves, 1):
+    print(f"Wave {wave_number} (~{scheduler.get_wave_duration(wave):.1f}s):")
+    for move in wave:
+        print(f"Move item {move['item_id']} from Bucket {move['from']} to Bucket {move['to']}")
+print(f"Estimated migration time: {scheduler.get_makespan(waves):.1f}s")
+
+# Live-migrate the VMs when asked to, one wave after another; otherwise the moves are only printed
+if os.environ.get('PROXMOX_EXECUTE') == '1':
+    executor = MigrationExecutor(proxmox_manager)
+    for wave_number, wave in enumerate(waves, 1):
+        results = executor.execute(MigrationExecutor.from_optimized_moves(wave, buckets_initial))
+        if move_history is not None:
+            move_history.record_migrations(results)
+        failed = [result for result in results if result['status'] != 'ok']
+        if failed:
+            # The later waves were planned assuming these VMs had moved, so they could overload a node; re-plan on the next run instead
+            print(f"Stopping after wave {wave_number}: {len(failed)} migrations failed, {len(waves) - wave_number} waves not started")
+            break
@@ -0,0 +1,322 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from BalancerSelector import BalancerSelector
+from BucketBalancer import BucketBalancer
+from InventoryCache import InventoryCache
+from LoadEstimator import LoadEstimator
+from LoadStatistics import LoadStatistics
+from MetricsHistory import MetricsHistory
+from MigrationCostModel import MigrationCostModel
+from MigrationExecutor import MigrationExecutor
+from MoveHistoryStore import MoveHistoryStore
+from MoveOptimizer import MoveOptimizer
+from ProxmoxManager import ProxmoxManager
+from WaveScheduler import WaveScheduler
+
+class LoadBalancerDaemon:
+    def __init__(self, host, user, password, host_names=None, interval=900, socket_path='/run/proxmox-loadbalancer/daemon.sock',
+                 cache_path='/var/cache/proxmox-loadbalancer/inventory.json', execute=False, cost_aware=False, history_path=None, sample_interval=60, estimator=None,
+                 move_history_path=None, cooldown=3600, reverse_cooldown=86400, max_migrations=None, migration_budget=None,
+                 selector=None):
+        """
+        Initialize a resident load balancer that keeps its API session, inventory cache and balancer state between cycles.
+
+        :param host: Proxmox host to connect to.
+        :param user: API user, e.g. 'root@pam'.
+        :param password: Password of the API user.
+        :param host_names: List of host names to balance. If None, balance all hosts.
+        :param interval: Seconds between planning cycles.
+        :param socket_path: Path of the unix socket serving status queries and triggers, or None to disable it.
+        :param cache_path: Path of the inventory cache snapshot.
+        :param execute: Whether to live-migrate the planned moves.
+        :param cost_aware: Whether to weigh moves by their estimated migration time.
+        :param history_path: Optional directory of a MetricsHistory that records node and VM memory between cycles.
+        :param sample_interval: Seconds between history samples.
+        :param estimator: Optional LoadEstimator method ('ewma', 'percentile' or 'forecast') smoothing the VM loads the plans use.
+        :param move_history_path: Optional path of a MoveHistoryStore that keeps executed migrations and cool-downs across restarts.
+        :param cooldown: Seconds after a migration during which the VM is not moved again, with a move history.
+        :param reverse_cooldown: Seconds after a migration during which the VM is not moved back to the node it came from, with a move history.
+        :param max_migrations: Maximum number of migrations of a VM within a day, with a move history, or None for no limit.
+        :param migration_budget: Maximum number of moves per plan, or None.
+        :param selector: BalancerSelector choosing the balancer each cycle, by default BucketBalancer or SwapBalancer on a full cluster.
+        """
+        self.host = host
+        self.user = user
+        self.password = password
+        self.host_names = host_names
+        self.interval = interval
+        self.socket_path = socket_path
+        self.execute = execute
+        self.cost_aware = cost_aware
+        self.cache = InventoryCache(cache_path)
+        self.history = MetricsHistory(history_path, interval=sample_interval) if history_path else None
+        self.sample_interval = sample_interval
+        self.estimator = LoadEstimator(estimator, history=self.history) if estimator else None
+        self.proxmox_manager = None  # Connected on the first cycle and kept while it works
+        self.move_history = {}  # VM id -> (source hostname, target hostname) of its last executed migration, so VMs are not moved straight back
+        self.move_history_store = MoveHistoryStore(move_history_path, cooldown=cooldown, reverse_cooldown=reverse_cooldown,
+                                                   max_migrations=max_migrations) if move_history_path else None
+        self.migration_budget = migration_budget
+        self.selector = selector or BalancerSelector()
+        self.last_fingerprint = None
+        self.last_plan = None
+        self.health = {'status': 'starting', 'started': time.time(), 'cycles': 0, 'last_cycle': None, 'last_duration': None, 'last_error': None}
+        self.trigger_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()  # Guards last_plan and health, which the socket threads read
+        self.server = None
+
+    def connect(self):
+        """Return the API connection, logging in only if there is none yet."""
+        if self.proxmox_manager is None:
+            self.proxmox_manager = ProxmoxManager(self.host, self.user, self.password, cache=self.cache)
+        return self.proxmox_manager
+
+    def collect_buckets(self, proxmox_manager):
+        """Collect the inventory, record it in the history and return it with buckets built from the estimated VM loads."""
+        node_stats, vms_by_node = proxmox_manager.get_inventory(self.host_names)
+        timestamp = time.time()
+        if self.history is not None:
+            self.history.record_inventory(node_stats, vms_by_node, timestamp)
+        estimated_loads = self.estimator.update_inventory(vms_by_node, timestamp) if self.estimator is not None else None
+        return node_stats, vms_by_node, proxmox_manager.build_buckets(node_stats, vms_by_node, estimated_loads)
+
+    @staticmethod
+    def get_fingerprint(buckets):
+        """Summarize the placement and rounded loads, so an unchanged cluster can reuse the last plan."""
+        return tuple((bucket.hostname, round(bucket.capacity, 1), tuple(sorted((str(item.id), round(item.load, 1)) for item in bucket.items)))
+                     for bucket in buckets)
+
+    def plan(self, proxmox_manager, buckets, node_stats, vms_by_node):
+        """Balance the buckets with the selected balancer and return the plan with the moves ordered into waves."""
+        std_dev_init = LoadStatistics(buckets).calculate_standard_deviation()
+
+        cost_model = None
+        if self.cost_aware:
+            vms_by_node = {bucket.hostname: [{'vmid': item.id} for item in bucket.items if item.movable] for bucket in buckets}
+            cost_model = MigrationCostModel(local_disks=proxmox_manager.get_local_disk_sizes(vms_by_node))
+
+        # Bucket ids are positions that change between cycles, so the executed moves are kept by hostname and mapped onto this cycle's buckets
+        balancer = self.selector.select(buckets, proxmox_manager, node_stats, vms_by_node, cost_model=cost_model, history=self.move_history_store)
+        if isinstance(balancer, BucketBalancer):
+            bucket_ids = {bucket.hostname: bucket.id for bucket in buckets}
+            balancer.move_history = {vmid: (bucket_ids[source], bucket_ids[target]) for vmid, (source, target) in self.move_history.items()
+                                     if source in bucket_ids and target in bucket_ids}
+        moves = balancer.balance(max_moves=self.migration_budget)
+        std_dev_post = LoadStatistics(buckets).calculate_standard_deviation()
+
+        optimized_moves = MoveOptimizer(moves, cost_model=cost_model).optimize()
+        scheduler = WaveScheduler(buckets, optimized_moves, cost_model=cost_model)
+        waves = scheduler.schedule()
+
+        hostnames = {bucket.id: bucket.hostname for bucket in buckets}
+        return {
+            'created': time.time(),
+            'std_dev_before': std_dev_init,
+            'std_dev_after': std_dev_post,
+            'estimated_seconds': scheduler.get_makespan(waves),
+            'waves': [[{'vmid': move['item_id'], 'from': hostnames[move['from']], 'to': hostnames[move['to']]} for move in wave] for wave in waves],
+            'migrations': None,
+        }
+
+    def run_cycle(self):
+        """Collect the inventory, re-plan if the cluster changed and optionally apply the plan."""
+        start = time.monotonic()
+        try:
+            proxmox_manager = self.connect()
+            node_stats, vms_by_node, buckets = self.collect_buckets(proxmox_manager)
+            self.cache.save()
+
+            fingerprint = self.get_fingerprint(buckets)
+            if fingerprint == self.last_fingerprint and self.last_plan is not None:
+                print("Cluster unchanged since the last cycle, keeping the last plan.")
+                plan = self.last_plan
+            else:
+                plan = self.plan(proxmox_manager, buckets, node_stats, vms_by_node)
+                print(f"Planned {sum(len(wave) for wave in plan['waves'])} moves in {len(plan['waves'])} waves "
+                      f"(std dev {plan['std_dev_before']:.2f} -> {plan['std_dev_after']:.2f})")
+
+                if self.execute and plan['waves']:
+                    executor = MigrationExecutor(proxmox_manager)
+                    plan['migrations'] = []
+                    for wave_number, wave in enumerate(plan['waves'], 1):
+                        results = executor.execute(wave)
+                        plan['migrations'].extend(results)
+                        failed = [result for result in results if result['status'] != 'ok']
+                        if failed:
+                            # The later waves assume these VMs moved, so leave them to the re-plan on the next cycle
+                            print(f"Stopping after wave {wave_number}: {len(failed)} migrations failed, {len(plan['waves']) - wave_number} waves not started")
+                            break
+                    self.move_history.update((result['vmid'], (result['from'], result['to'])) for result in plan['migrations'] if result['status'] == 'ok')
+                    if self.move_history_store is not None:
+                        self.move_history_store.record_migrations(plan['migrations'])
+                    fingerprint = None  # The VMs moved, so the next cycle has to look again
+
+            self.last_fingerprint = fingerprint
+            with self.lock:
+                self.last_plan = plan
+                self.health.update(status='ok', last_error=None)
+        except Exception as e:
+            print(f"Load balancing cycle failed: {e}")
+            self.proxmox_manager = None  # Log in again next cycle in case the session or ticket went bad
+            with self.lock:
+                self.health.update(status='error', last_error=str(e))
+        finally:
+            with self.lock:
+                self.health['cycles'] += 1
+                self.health['last_cycle'] = time.time()
+                self.health['last_duration'] = time.monotonic() - start
+
+    def sample(self):
+        """Record the current node and VM memory in the history and the estimator without planning."""
+        try:
+            self.collect_buckets(self.connect())
+        except Exception as e:
+            print(f"Failed to sample the cluster: {e}")
+            self.proxmox_manager = None
+
+    def handle_command(self, command):
+        """Answer a socket command: 'health', 'status', 'plan' or 'trigger'."""
+        with self.lock:
+            if command == 'health':
+                return {'status': self.health['status'], 'last_error': self.health['last_error']}
+            if command == 'status':
+                return dict(self.health, interval=self.interval, uptime=time.time() - self.health['started'])
+            if command == 'plan':
+                return self.last_plan
+        if command == 'trigger':
+            self.trigger_event.set()
+            return {'triggered': True}
+        return {'error': f"unknown command '{command}'"}
+
+    def start_server(self):
+        """Serve commands on the unix socket in a background thread, one JSON reply per command line."""
+        daemon = self
+
+        class CommandHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    reply = daemon.handle_command(line.decode().strip())
+                    self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)  # Left over from a previous run
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, CommandHandler)
+        self.server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Ask the main loop to exit after the current cycle."""
+        self.stop_event.set()
+        self.trigger_event.set()
+
+    def run(self):
+        """Run cycles every interval, or sooner when triggered, until stopped."""
+        if self.socket_path:
+            self.start_server()
+        try:
+            next_cycle = time.monotonic()
+            while not self.stop_event.is_set():
+                if time.monotonic() >= next_cycle:
+                    self.run_cycle()
+                    next_cycle = time.monotonic() + self.interval
+                elif self.history is not None:
+                    self.sample()
+
+                # Wake up for the next cycle, the next history sample or a trigger, whichever comes first
+                wait = next_cycle - time.monotonic()
+                if self.history is not None:
+                    wait = min(wait, self.sample_interval)
+                if self.trigger_event.wait(max(0.0, wait)):
+                    next_cycle = time.monotonic()
+                self.trigger_event.clear()
+        finally:
+            if self.history is not None:
+                self.history.close()
+            if self.server is not None:
+                self.server.shutdown()
+                self.server.server_close()
+                os.unlink(self.socket_path)
+
+def query(socket_path, command):
+    """Send one command to a running daemon and return its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(command.encode() + b'\n')
+        return json.loads(client.makefile().readline())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the load balancer as a resident daemon, or query a running one.")
+    parser.add_argument('--interval', type=float, default=900, help="Seconds between planning cycles (default: 900)")
+    parser.add_argument('--socket', default='/run/proxmox-loadbalancer/daemon.sock', help="Unix socket for status queries and triggers")
+    parser.add_argument('--cache', default='/var/cache/proxmox-loadbalancer/inventory.json', help="Inventory cache snapshot path")
+    parser.add_argument('--hosts', help="Comma separated host names to balance (default: all hosts)")
+    parser.add_argument('--execute', action='store_true', help="Live-migrate the planned moves")
+    parser.add_argument('--cost-aware', action='store_true', help="Weigh moves by their estimated migration time")
+    parser.add_argument('--history', help="Directory to record node and VM memory history in (default: no history)")
+    parser.add_argument('--sample-interval', type=float, default=60, help="Seconds between history samples (default: 60)")
+    parser.add_argument('--estimator', choices=sorted(LoadEstimator.METHODS), help="Smooth the VM loads with this estimator (default: current samples)")
+    parser.add_argument('--move-history', help="File to keep executed migrations and cool-downs in across restarts (default: none)")
+    parser.add_argument('--cooldown', type=float, default=3600, help="Seconds before a migrated VM may move again, with --move-history (default: 3600)")
+    parser.add_argument('--reverse-cooldown', type=float, default=86400, help="Seconds before a migrated VM may move back to its previous node, with --move-history (default: 86400)")
+    parser.add_argument('--max-migrations', type=int, help="Maximum number of migrations of a VM per day, with --move-history (default: no limit)")
+    parser.add_argument('--migration-budget', type=int, help="Maximum number of moves per plan (default: no limit)")
+    parser.add_argument('--cpu-weight', type=float, help="Balance memory and CPU with VectorBalancer, weighing CPU by this factor (default: memory only)")
+    parser.add_argument('--partition', choices=['cpu'], help="Balance per CPU model and core count with PartitionedBalancer")
+    parser.add_argument('--cross-partition', action='store_true', help="With --partition, also move VMs without the 'host' CPU type between groups")
+    parser.add_argument('--zones', help="Balance between and then within zones with HierarchicalBalancer, 'auto' or e.g. 'pve01,pve02;pve03,pve04'")
+    parser.add_argument('--query', choices=['health', 'status', 'plan', 'trigger'], help="Query a running daemon instead of starting one")
+    args = parser.parse_args()
+
+    if args.query:
+        print(json.dumps(query(args.socket, args.query), indent=2))
+    else:
+        # Proxmox API connection details, taken from the environment like LoadBalancer.py
+        daemon = LoadBalancerDaemon(
+            os.environ.get('PROXMOX_HOST', '192.168.1.10'),
+            os.environ.get('PROXMOX_USER', 'xxxxxx@pve'),
+            os.environ.get('PROXMOX_PASSWORD', 'ASecurePassword123'),
+            host_names=args.hosts.split(',') if args.hosts else None,
+            interval=args.interval,
+            socket_path=args.socket,
+            cache_path=args.cache,
+            execute=args.execute,
+            cost_aware=args.cost_aware,
+            history_path=args.history,
+            sample_interval=args.sample_interval,
+            estimator=args.estimator,
+            move_history_path=args.move_history,
+            cooldown=args.cooldown,
+            reverse_cooldown=args.reverse_cooldown,
+            max_migrations=args.max_migrations,
+            migration_budget=args.migration_budget,
+            selector=BalancerSelector(cpu_weight=args.cpu_weight, partition=args.partition, cross_partition=args.cross_partition,
+                                      zones=BalancerSelector.parse_zones(args.zones))
+        )
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+        signal.signal(signal.SIGHUP, lambda signum, frame: daemon.trigger_event.set())
+        daemon.run()
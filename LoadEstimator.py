@@ -0,0 +1,218 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+class EwmaEstimator:
+    def __init__(self, alpha=0.3):
+        """Exponentially weighted moving average; higher alpha follows new samples faster."""
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, sample):
+        """Add a sample in O(1)."""
+        self.value = sample if self.value is None else self.alpha * sample + (1 - self.alpha) * self.value
+
+    def estimate(self):
+        """Return the smoothed value, or None before the first sample."""
+        return self.value
+
+class P2QuantileEstimator:
+    def __init__(self, quantile=0.95):
+        """
+        Streaming quantile estimate with the P-square algorithm (Jain and Chlamtac), using five markers in O(1) per sample.
+
+        :param quantile: Quantile to estimate, between 0 and 1.
+        """
+        self.quantile = quantile
+        self.count = 0
+        self.heights = []  # Marker heights, the first five samples until they are sorted
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * quantile, 4 * quantile, 2 + 2 * quantile, 4]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def update(self, sample):
+        """Add a sample in O(1)."""
+        self.count += 1
+        if self.count <= 5:
+            self.heights.append(sample)
+            if self.count == 5:
+                self.heights.sort()
+            return
+
+        heights, positions = self.heights, self.positions
+        # Find the cell of the sample, widening the outer markers if it falls outside them
+        if sample < heights[0]:
+            heights[0] = sample
+            cell = 0
+        elif sample >= heights[4]:
+            heights[4] = sample
+            cell = 3
+        else:
+            cell = next(index for index in range(4) if heights[index] <= sample < heights[index + 1])
+
+        for index in range(cell + 1, 5):
+            positions[index] += 1
+        for index in range(5):
+            self.desired[index] += self.increments[index]
+
+        # Move the middle markers towards their desired positions
+        for index in range(1, 4):
+            offset = self.desired[index] - positions[index]
+            if (offset >= 1 and positions[index + 1] - positions[index] > 1) or (offset <= -1 and positions[index - 1] - positions[index] < -1):
+                step = 1 if offset > 0 else -1
+                height = self.parabolic(index, step)
+                if not heights[index - 1] < height < heights[index + 1]:
+                    height = heights[index] + step * (heights[index + step] - heights[index]) / (positions[index + step] - positions[index])
+                heights[index] = height
+                positions[index] += step
+
+    def parabolic(self, index, step):
+        """Piecewise-parabolic prediction of a marker's height after moving it by one position."""
+        heights, positions = self.heights, self.positions
+        return heights[index] + step / (positions[index + 1] - positions[index - 1]) * (
+            (positions[index] - positions[index - 1] + step) * (heights[index + 1] - heights[index]) / (positions[index + 1] - positions[index])
+            + (positions[index + 1] - positions[index] - step) * (heights[index] - heights[index - 1]) / (positions[index] - positions[index - 1]))
+
+    def estimate(self):
+        """Return the estimated quantile, or None before the first sample."""
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            ordered = sorted(self.heights)
+            return ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+        return self.heights[2]
+
+class WindowedQuantileEstimator:
+    def __init__(self, quantile=0.95, window=360):
+        """
+        Quantile over roughly the last window samples, kept in O(1) per sample with two alternating P-square estimators.
+
+        The estimate is the larger quantile of the current and the previous window, so it covers between one and two
+        windows of samples and errs on the high side, which is the safe side for memory.
+
+        :param quantile: Quantile to estimate, between 0 and 1.
+        :param window: Number of samples per window.
+        """
+        self.quantile = quantile
+        self.window = window
+        self.current = P2QuantileEstimator(quantile)
+        self.previous = None
+
+    def update(self, sample):
+        """Add a sample in O(1), starting a new window once the current one is full."""
+        if self.current.count >= self.window:
+            self.previous, self.current = self.current, P2QuantileEstimator(self.quantile)
+        self.current.update(sample)
+
+    def estimate(self):
+        """Return the estimated quantile, or None before the first sample."""
+        estimates = [estimator.estimate() for estimator in (self.current, self.previous) if estimator is not None and estimator.count]
+        return max(estimates) if estimates else None
+
+class HoltEstimator:
+    def __init__(self, alpha=0.3, beta=0.1, horizon=15):
+        """
+        Holt's linear trend smoothing, forecasting a few samples ahead in O(1) per sample.
+
+        :param alpha: Smoothing of the level.
+        :param beta: Smoothing of the trend.
+        :param horizon: Number of samples ahead to forecast.
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.horizon = horizon
+        self.level = None
+        self.trend = 0.0
+
+    def update(self, sample):
+        """Add a sample in O(1)."""
+        if self.level is None:
+            self.level = sample
+            return
+        previous_level = self.level
+        self.level = self.alpha * sample + (1 - self.alpha) * (self.level + self.trend)
+        self.trend = self.beta * (self.level - previous_level) + (1 - self.beta) * self.trend
+
+    def estimate(self):
+        """Return the forecast, never below zero, or None before the first sample."""
+        return None if self.level is None else max(0.0, self.level + self.horizon * self.trend)
+
+class LoadEstimator:
+    METHODS = {
+        'ewma': lambda options: EwmaEstimator(options.get('alpha', 0.3)),
+        'percentile': lambda options: WindowedQuantileEstimator(options.get('quantile', 0.95), options.get('window', 360)),
+        'forecast': lambda options: HoltEstimator(options.get('alpha', 0.3), options.get('beta', 0.1), options.get('horizon', 15)),
+    }
+
+    def __init__(self, method='ewma', history=None, history_window=6 * 3600, **options):
+        """
+        Initialize per-VM load estimators that smooth the memory samples used as item loads.
+
+        :param method: 'ewma', 'percentile' (p95 over a window of samples by default) or 'forecast' (Holt's linear trend).
+        :param history: Optional MetricsHistory to seed the estimator of a VM the first time it is seen.
+        :param history_window: Seconds of history replayed into a new estimator.
+        :param options: Estimator parameters: alpha, quantile, window, beta and horizon.
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown load estimation method '{method}'")
+        self.method = method
+        self.history = history
+        self.history_window = history_window
+        self.options = options
+        self.estimators = {}  # VM id -> estimator
+
+    def get_estimator(self, vmid, timestamp=None):
+        """
+        Return the estimator of a VM, creating it and replaying its recorded history on first use.
+
+        :param timestamp: Time of the sample about to be added. The history is only replayed up to the slot before it,
+                          so a sample that was already recorded is not counted twice.
+        """
+        estimator = self.estimators.get(vmid)
+        if estimator is None:
+            estimator = self.METHODS[self.method](self.options)
+            if self.history is not None:
+                timestamp = time.time() if timestamp is None else timestamp
+                samples = self.history.window('vm', vmid, self.history_window, now=timestamp - self.history.interval)
+                for sample in samples[samples == samples]:  # NaN marks missing samples
+                    estimator.update(float(sample))
+            self.estimators[vmid] = estimator
+        return estimator
+
+    def update(self, vmid, sample, timestamp=None):
+        """Add a memory sample of a VM, taken at timestamp (default now), in O(1) and return its new estimate."""
+        estimator = self.get_estimator(vmid, timestamp)
+        estimator.update(sample)
+        return estimator.estimate()
+
+    def estimate(self, vmid):
+        """Return the current estimate of a VM, or None if it has no samples."""
+        estimator = self.estimators.get(vmid)
+        return estimator.estimate() if estimator is not None else None
+
+    def update_inventory(self, vms_by_node, timestamp=None):
+        """
+        Add the samples of an inventory and return the estimated loads, forgetting VMs that are no longer powered on.
+
+        :param vms_by_node: Powered-on VMs keyed by node name, as returned by ProxmoxManager.get_inventory().
+        :param timestamp: Time the inventory was taken, the same as passed to MetricsHistory.record_inventory() (default now).
+        :return: Dict of vmid -> estimated memory in GB.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        estimates = {vm['vmid']: self.update(vm['vmid'], vm['memory_used'], timestamp) for vms in vms_by_node.values() for vm in vms}
+        for vmid in set(self.estimators) - set(estimates):
+            del self.estimators[vmid]
+        return estimates
@@ -14,28 +14,41 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import math
+import numpy as np
+from ClusterState import ClusterState
 
 class LoadStatistics:
     def __init__(self, buckets):
+        """
+        Initialize the statistics for a cluster.
+
+        :param buckets: List of buckets, or a ClusterState to compute the statistics vectorized.
+        """
         self.buckets = buckets
 
+    def get_bucket_loads(self):
+        """Return the total load of every bucket as an array."""
+        if isinstance(self.buckets, ClusterState):
+            return self.buckets.get_bucket_loads()
+        return np.array([bucket.get_total_load() for bucket in self.buckets], dtype=np.float64)
+
     def calculate_mean_load(self):
         """Calculate the mean load across all buckets."""
-        total_load = sum(bucket.get_total_load() for bucket in self.buckets)
-        num_buckets = len(self.buckets)
-        return total_load / num_buckets if num_buckets > 0 else 0
+        bucket_loads = self.get_bucket_loads()
+        num_buckets = len(bucket_loads)
+        return float(bucket_loads.sum()) / num_buckets if num_buckets > 0 else 0
 
     def calculate_load_differences(self, mean):
         """Calculate the differences between each bucket's load and the mean load."""
-        return [(bucket.get_total_load() - mean) for bucket in self.buckets]
+        return self.get_bucket_loads() - mean
 
     def calculate_variance(self, load_differences):
         """Calculate the variance of the load differences."""
         num_buckets = len(load_differences)
         if num_buckets == 0:
             return 0
-        
-        squared_diff_sum = sum(diff ** 2 for diff in load_differences)
+
+        squared_diff_sum = float(np.dot(load_differences, load_differences))
         return squared_diff_sum / num_buckets
 
     def calculate_standard_deviation(self):
@@ -0,0 +1,224 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import re
+import struct
+import time
+import numpy as np
+
+try:
+    import resource  # Unix only, used to size the number of open series
+except ImportError:
+    resource = None
+
+class SeriesBuffer:
+    """A fixed-size ring buffer of uint16-quantized samples stored in a memory-mapped file."""
+
+    MAGIC = b'PLBHIST1'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIIIdq')  # magic, version, slot count, interval, full scale, index of the newest slot
+    HEADER_SIZE = 64  # The header is padded so the samples start aligned
+    MISSING = 0xFFFF  # Slots without a sample
+    MAX_LEVEL = 0xFFFE  # Quantization level of the full scale value
+
+    def __init__(self, path, slot_count, interval, scale):
+        """
+        Open a series file, creating it if it does not exist.
+
+        A sample taken at time t lives in slot (t // interval) % slot_count, so the file never grows and old samples
+        are overwritten once the buffer wraps around. The slot count, interval and scale of an existing file win
+        over the arguments.
+
+        :param path: Path of the series file.
+        :param slot_count: Number of samples the buffer holds.
+        :param interval: Seconds covered by one slot.
+        :param scale: Largest value that can be stored; values are quantized to scale / 65534 steps.
+        """
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION, slot_count, interval, float(scale), -1).ljust(self.HEADER_SIZE, b'\0'))
+                f.write(np.full(slot_count, self.MISSING, dtype='<u2').tobytes())
+
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, version, self.slot_count, self.interval, self.scale, self.last_index = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a metrics history series")
+        self.samples = np.frombuffer(self.map, dtype='<u2', count=self.slot_count, offset=self.HEADER_SIZE)
+
+    def write_last_index(self):
+        """Store the index of the newest slot in the header."""
+        struct.pack_into('<q', self.map, self.HEADER.size - 8, self.last_index)
+
+    def record(self, timestamp, value):
+        """Store a sample in the slot of its timestamp; slots skipped since the previous sample are marked missing."""
+        index = int(timestamp // self.interval)
+        if self.last_index >= 0 and index > self.last_index + 1:
+            # Clear the slots of the gap, which at most wraps around the whole buffer once
+            gap = np.arange(self.last_index + 1, min(index, self.last_index + 1 + self.slot_count)) % self.slot_count
+            self.samples[gap] = self.MISSING
+        elif self.last_index >= 0 and index <= self.last_index - self.slot_count:
+            return  # Older than anything the buffer still holds
+
+        level = round(min(max(value, 0.0), self.scale) / self.scale * self.MAX_LEVEL) if self.scale > 0 else 0
+        self.samples[index % self.slot_count] = level
+        if index > self.last_index:
+            self.last_index = index
+            self.write_last_index()
+
+    def window(self, seconds, now=None):
+        """
+        Return the samples of the last given seconds, oldest first, as floats with NaN for missing samples.
+
+        The slots are read straight from the memory map with one vectorized gather.
+        """
+        end = int((time.time() if now is None else now) // self.interval)
+        count = min(max(int(seconds // self.interval), 1), self.slot_count)
+        indexes = np.arange(end - count + 1, end + 1)
+
+        levels = self.samples[indexes % self.slot_count]
+        # Slots newer than the newest sample or already overwritten hold no sample of this window
+        valid = (levels != self.MISSING) & (indexes <= self.last_index) & (indexes > self.last_index - self.slot_count)
+        return np.where(valid, levels * (self.scale / self.MAX_LEVEL), np.nan)
+
+    def flush(self):
+        """Write the changed pages back to the file."""
+        self.map.flush()
+
+    def close(self):
+        """Flush and unmap the file."""
+        self.samples = None
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+class MetricsHistory:
+    MAX_OPEN_LIMIT = 32768  # Every open series is one memory map, so stay well below the default vm.max_map_count of 65530
+
+    def __init__(self, directory, retention=14 * 86400, interval=60, max_open=None):
+        """
+        Initialize an on-disk history of node and VM memory usage.
+
+        Every node and VM gets its own fixed-size SeriesBuffer file, e.g. two weeks of 1-minute samples take
+        about 40 KB per series.
+
+        :param directory: Directory holding the series files.
+        :param retention: Seconds of history kept per series.
+        :param interval: Seconds between samples.
+        :param max_open: Maximum number of series files kept open; the least recently used one is closed beyond that. Defaults to half
+                         the open file limit, so every node and VM of a large cluster stays mapped instead of being reopened every sample.
+        """
+        self.directory = directory
+        self.retention = retention
+        self.interval = max(1, int(interval))
+        self.max_open = max_open if max_open is not None else self.get_default_max_open()
+        self.series = {}  # (kind, key) -> open SeriesBuffer, least recently used first
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def get_default_max_open(cls):
+        """Raise the soft open file limit to the hard limit where allowed and return half of it, up to MAX_OPEN_LIMIT."""
+        if resource is None:
+            return 512
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = cls.MAX_OPEN_LIMIT * 2 + 256  # Leave room for the sockets and files the daemon opens itself
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            raised = wanted if hard == resource.RLIM_INFINITY else min(hard, wanted)
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (raised, hard))
+                soft = raised
+            except (ValueError, OSError):
+                pass  # Keep the current limit
+        if soft == resource.RLIM_INFINITY:
+            return cls.MAX_OPEN_LIMIT
+        return max(1, min(soft // 2, cls.MAX_OPEN_LIMIT))
+
+    def get_series(self, kind, key, scale=None):
+        """
+        Return the series of a node ('node') or VM ('vm'), opening it on first use.
+
+        :param scale: Largest value the series can store, needed to create a new series.
+        :return: The SeriesBuffer, or None if it does not exist and no scale was given.
+        """
+        series = self.series.pop((kind, key), None)
+        if series is None:
+            path = os.path.join(self.directory, f"{kind}-{re.sub(r'[^A-Za-z0-9_.-]', '_', str(key))}.bin")
+            if scale is None and not os.path.exists(path):
+                return None
+            series = SeriesBuffer(path, max(1, self.retention // self.interval), self.interval, scale or 0)
+            if len(self.series) >= self.max_open:
+                self.series.pop(next(iter(self.series))).close()
+        self.series[(kind, key)] = series  # Reinserted to mark it as the most recently used
+        return series
+
+    def record(self, kind, key, value, scale, timestamp=None):
+        """Record one sample of a node or VM."""
+        self.get_series(kind, key, scale).record(time.time() if timestamp is None else timestamp, value)
+
+    def record_buckets(self, buckets, timestamp=None):
+        """
+        Record the memory used by every node and powered-on VM of a bucket list.
+
+        Nodes are scaled to their capacity and VMs to the largest node, which no VM can outgrow.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        vm_scale = max((bucket.capacity for bucket in buckets), default=0)
+        for bucket in buckets:
+            self.record('node', bucket.hostname or bucket.id, bucket.get_total_load(), bucket.capacity, timestamp)
+            for item in bucket.items:
+                if item.movable:
+                    self.record('vm', item.id, item.load, vm_scale, timestamp)
+
+    def record_inventory(self, node_stats, vms_by_node, timestamp=None):
+        """Record the memory used by every node and powered-on VM of a ProxmoxManager.get_inventory() result."""
+        timestamp = time.time() if timestamp is None else timestamp
+        vm_scale = max((stats['max_memory'] for stats in node_stats.values()), default=0)
+        for node, stats in node_stats.items():
+            self.record('node', node, stats['memory_used'], stats['max_memory'], timestamp)
+        for vms in vms_by_node.values():
+            for vm in vms:
+                self.record('vm', vm['vmid'], vm['memory_used'], vm_scale, timestamp)
+
+    def window(self, kind, key, seconds, now=None):
+        """Return the samples of the last given seconds (NaN where missing), or an empty array for an unknown series."""
+        series = self.get_series(kind, key)
+        return series.window(seconds, now) if series is not None else np.empty(0)
+
+    def percentile(self, kind, key, q, seconds, now=None):
+        """Return the q-th percentile of the samples of the last given seconds, or None without samples."""
+        samples = self.window(kind, key, seconds, now)
+        samples = samples[~np.isnan(samples)]
+        return float(np.percentile(samples, q)) if samples.size else None
+
+    def mean(self, kind, key, seconds, now=None):
+        """Return the mean of the samples of the last given seconds, or None without samples."""
+        samples = self.window(kind, key, seconds, now)
+        samples = samples[~np.isnan(samples)]
+        return float(samples.mean()) if samples.size else None
+
+    def flush(self):
+        """Write every open series back to disk."""
+        for series in self.series.values():
+            series.flush()
+
+    def close(self):
+        """Close every open series."""
+        for series in self.series.values():
+            series.close()
+        self.series = {}
@@ -0,0 +1,54 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+class MigrationCostModel:
+    def __init__(self, bandwidth=1.25, link_bandwidth=None, local_disks=None, dirty_rate=0.0, dirty_rates=None, max_rounds=30):
+        """
+        Initialize an estimate of how expensive it is to live-migrate a VM between two nodes.
+
+        Memory is copied in pre-copy rounds: every round resends the pages dirtied while the previous round was
+        copied, so a VM that dirties memory at rate d over a link of bandwidth b sends its memory about 1 / (1 - d / b)
+        times. Disks on local (non-shared) storage are copied in full.
+
+        :param bandwidth: Default migration bandwidth between two nodes, in GB per second (10GbE is about 1.25).
+        :param link_bandwidth: Optional (from bucket id, to bucket id) -> bandwidth overriding the default per link.
+        :param local_disks: Optional item id -> GB of disks on local storage, e.g. from ProxmoxManager.get_local_disk_sizes().
+        :param dirty_rate: Default rate at which a VM dirties memory, in GB per second.
+        :param dirty_rates: Optional item id -> dirty rate overriding the default per VM.
+        :param max_rounds: Pre-copy rounds after which a migration that does not converge is assumed to stop.
+        """
+        self.bandwidth = bandwidth
+        self.link_bandwidth = link_bandwidth or {}
+        self.local_disks = local_disks or {}
+        self.dirty_rate = dirty_rate
+        self.dirty_rates = dirty_rates or {}
+        self.max_rounds = max_rounds
+
+    def get_bandwidth(self, source_id, target_id):
+        """Return the migration bandwidth between two buckets."""
+        return self.link_bandwidth.get((source_id, target_id), self.bandwidth)
+
+    def get_transfer_size(self, item, source_id, target_id):
+        """Estimate the GB sent to migrate an item: its memory over all pre-copy rounds plus its local disks."""
+        ratio = self.dirty_rates.get(item.id, self.dirty_rate) / self.get_bandwidth(source_id, target_id)
+        if ratio < 1:
+            memory_factor = (1 - ratio ** (self.max_rounds + 1)) / (1 - ratio)
+        else:
+            memory_factor = self.max_rounds + 1  # Never converges, every round resends everything
+        return item.load * memory_factor + self.local_disks.get(item.id, 0)
+
+    def get_migration_time(self, item, source_id, target_id):
+        """Estimate the seconds needed to migrate an item between two buckets."""
+        return self.get_transfer_size(item, source_id, target_id) / self.get_bandwidth(source_id, target_id)
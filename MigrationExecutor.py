@@ -0,0 +1,200 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+import time
+from collections import deque
+from proxmoxer.core import ResourceException
+from requests.exceptions import ConnectionError, Timeout
+
+class MigrationExecutor:
+    def __init__(self, proxmox_manager, max_parallel=4, max_per_source=2, max_per_target=2, max_retries=3,
+                 backoff=5.0, max_backoff=60.0, poll_interval=2.0, online=True, seed=None):
+        """
+        Initialize an executor that applies a migration plan through the Proxmox API.
+
+        Migrations run in parallel within the concurrency caps. Their tasks are tracked by a single poller that
+        reads /cluster/tasks once per interval instead of querying every task separately.
+
+        :param proxmox_manager: ProxmoxManager whose API connection is used.
+        :param max_parallel: Maximum number of migrations running in the whole cluster.
+        :param max_per_source: Maximum number of migrations leaving a node at once.
+        :param max_per_target: Maximum number of migrations arriving at a node at once.
+        :param max_retries: Number of times a failed migration is retried before it is given up.
+        :param backoff: Seconds to wait before the first retry; doubles with every further attempt.
+        :param max_backoff: Upper limit of the wait between retries.
+        :param poll_interval: Seconds between task status polls.
+        :param online: Whether to live-migrate running VMs (online=1).
+        :param seed: Seed for the retry jitter.
+        """
+        self.proxmox = proxmox_manager.proxmox
+        self.max_parallel = max_parallel
+        self.max_per_source = max_per_source
+        self.max_per_target = max_per_target
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.online = online
+        self.random = random.Random(seed)
+
+    @staticmethod
+    def from_optimized_moves(optimized_moves, buckets):
+        """
+        Convert MoveOptimizer output, which refers to buckets by id, into migrations between node names.
+
+        :param optimized_moves: List of {'item_id', 'from', 'to'} moves.
+        :param buckets: Buckets the moves were planned on, with their hostnames set.
+        :return: List of {'vmid', 'from', 'to'} migrations.
+        """
+        hostnames = {bucket.id: bucket.hostname for bucket in buckets}
+        return [{'vmid': move['item_id'], 'from': hostnames[move['from']], 'to': hostnames[move['to']]} for move in optimized_moves]
+
+    @staticmethod
+    def is_transient(error):
+        """Check if an API error is worth retrying: server errors and connection problems, but not rejected requests."""
+        if isinstance(error, ResourceException):
+            return error.status_code >= 500
+        return isinstance(error, (ConnectionError, Timeout))
+
+    def get_retry_delay(self, attempts):
+        """Exponential backoff with jitter for the given number of failed attempts."""
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        return delay * self.random.uniform(0.5, 1.0)
+
+    def can_start(self, job, running_from, running_to, now):
+        """Check if a job may start now without exceeding a concurrency cap or cutting its backoff short."""
+        return (job['not_before'] <= now
+                and running_from.get(job['from'], 0) < self.max_per_source
+                and running_to.get(job['to'], 0) < self.max_per_target)
+
+    def start_migration(self, job):
+        """Submit the migration of a job's VM and return the task UPID."""
+        params = {'target': job['to']}
+        if self.online:
+            params['online'] = 1
+        return self.proxmox.nodes(job['from']).qemu(job['vmid']).migrate.post(**params)
+
+    def poll_tasks(self, running):
+        """
+        Return the finished tasks among the running ones as UPID -> exit status.
+
+        One /cluster/tasks request covers every task; only tasks missing from that list are queried on their node.
+        """
+        finished = {}
+        tasks = {task['upid']: task for task in self.proxmox.cluster.tasks.get()}
+        for upid, job in running.items():
+            task = tasks.get(upid)
+            if task is None:
+                status = self.proxmox.nodes(job['from']).tasks(upid).status.get()
+                if status.get('status') == 'stopped':
+                    finished[upid] = status.get('exitstatus', 'unknown')
+            elif 'status' in task:
+                finished[upid] = task['status']
+        return finished
+
+    def fail_attempt(self, job, error, now):
+        """Schedule a failed job for another attempt, or give it up once it has no retries left."""
+        job['error'] = error
+        if job['attempts'] > self.max_retries:
+            job['status'] = 'failed'
+            job['duration'] = now - job['submitted']
+            print(f"Migration of VM {job['vmid']} from {job['from']} to {job['to']} failed: {error}")
+            return False
+
+        delay = self.get_retry_delay(job['attempts'])
+        job['not_before'] = now + delay
+        print(f"Migration of VM {job['vmid']} from {job['from']} to {job['to']} failed ({error}), retrying in {delay:.1f}s")
+        return True
+
+    def execute(self, migrations):
+        """
+        Apply a list of migrations and wait for all of them to finish.
+
+        :param migrations: List of {'vmid', 'from', 'to'} migrations, e.g. from from_optimized_moves().
+        :return: One result per migration, in order, with its status ('ok' or 'failed'), attempts, UPID, error and duration.
+        """
+        start = time.monotonic()
+        jobs = [dict(migration, status='pending', attempts=0, upid=None, error=None, duration=None, not_before=start, submitted=start)
+                for migration in migrations]
+        pending = deque(jobs)
+        running = {}  # UPID -> job
+        running_from = {}  # Node -> migrations leaving it
+        running_to = {}  # Node -> migrations arriving at it
+        next_poll = start
+
+        while pending or running:
+            now = time.monotonic()
+
+            # Start every pending job the caps allow, keeping the plan order among the ones that are ready
+            for job in list(pending):
+                if len(running) >= self.max_parallel:
+                    break
+                if not self.can_start(job, running_from, running_to, now):
+                    continue
+
+                pending.remove(job)
+                job['attempts'] += 1
+                try:
+                    upid = self.start_migration(job)
+                except Exception as e:
+                    if not self.is_transient(e):
+                        job['status'], job['error'] = 'failed', str(e)
+                        print(f"Migration of VM {job['vmid']} from {job['from']} to {job['to']} was rejected: {e}")
+                    elif self.fail_attempt(job, str(e), now):
+                        pending.append(job)
+                    continue
+
+                if job['attempts'] == 1:
+                    job['submitted'] = now
+                job['upid'], job['status'] = upid, 'running'
+                running[upid] = job
+                running_from[job['from']] = running_from.get(job['from'], 0) + 1
+                running_to[job['to']] = running_to.get(job['to'], 0) + 1
+
+            # Poll all running tasks at once
+            if running and now >= next_poll:
+                next_poll = now + self.poll_interval
+                try:
+                    finished = self.poll_tasks(running)
+                except Exception as e:
+                    print(f"Failed to poll migration tasks: {e}")
+                    finished = {}
+
+                now = time.monotonic()
+                for upid, exit_status in finished.items():
+                    job = running.pop(upid)
+                    running_from[job['from']] -= 1
+                    running_to[job['to']] -= 1
+                    if exit_status == 'OK':
+                        job['status'], job['error'] = 'ok', None
+                        job['duration'] = now - job['submitted']
+                        print(f"Migrated VM {job['vmid']} from {job['from']} to {job['to']} in {job['duration']:.1f}s")
+                    elif self.fail_attempt(job, exit_status, now):
+                        job['status'] = 'pending'
+                        pending.append(job)
+
+                if finished:
+                    continue  # Capacity was freed, so start the next jobs right away
+
+            # Sleep until the next poll or until the first job in backoff is ready
+            wake_up = [job['not_before'] for job in pending if job['not_before'] > now]
+            if running:
+                wake_up.append(next_poll)
+            if wake_up:
+                time.sleep(max(0.0, min(wake_up) - time.monotonic()))
+
+        print(f"Applied {sum(job['status'] == 'ok' for job in jobs)}/{len(jobs)} migrations in {time.monotonic() - start:.1f}s")
+        return [{key: job[key] for key in ('vmid', 'from', 'to', 'status', 'attempts', 'upid', 'error', 'duration')} for job in jobs]
@@ -0,0 +1,118 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+
+class MoveHistoryStore:
+    def __init__(self, path, cooldown=3600, reverse_cooldown=86400, max_migrations=None, window=86400, retention=30 * 86400):
+        """
+        Initialize an on-disk record of past migrations, so runs of the oneshot service do not undo each other's moves.
+
+        For every VM it stores its last move (source and target hostname and time), the times of its migrations within
+        the window and its total number of migrations. Hostnames are stored instead of bucket ids, which change between runs.
+
+        :param path: Path of the JSON snapshot file.
+        :param cooldown: Seconds after a migration during which the VM is not moved at all.
+        :param reverse_cooldown: Seconds after a migration during which the VM is not moved back to the node it came from.
+        :param max_migrations: Maximum number of migrations of a VM within the window, or None for no limit.
+        :param window: Seconds over which max_migrations is counted.
+        :param retention: Seconds after its last migration before a VM is dropped from the store.
+        """
+        self.path = path
+        self.cooldown = cooldown
+        self.reverse_cooldown = reverse_cooldown
+        self.max_migrations = max_migrations
+        self.window = window
+        self.retention = retention
+        self.snapshot = {'version': 1, 'vms': {}}
+        self.load()
+
+    def load(self):
+        """Load the snapshot from disk, starting empty if it is missing or unreadable."""
+        try:
+            with open(self.path, 'r') as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') == 1:
+                self.snapshot = snapshot
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable move history {self.path}: {e}")
+
+    def save(self):
+        """Drop VMs that have not moved within the retention and write the snapshot to disk atomically."""
+        now = time.time()
+        self.snapshot['vms'] = {vmid: entry for vmid, entry in self.snapshot['vms'].items() if now - entry['moved'] <= self.retention}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.snapshot, f, separators=(',', ':'))
+        os.replace(temp_path, self.path)
+
+    def get_entry(self, vmid):
+        """Return the stored history of a VM ({'from', 'to', 'moved', 'recent', 'count'}), or None if it has not moved."""
+        return self.snapshot['vms'].get(str(vmid))
+
+    def get_recent_count(self, vmid, now=None):
+        """Return how many times a VM migrated within the window."""
+        now = time.time() if now is None else now
+        entry = self.get_entry(vmid)
+        return sum(1 for moved in entry['recent'] if now - moved <= self.window) if entry else 0
+
+    def get_count(self, vmid):
+        """Return how many migrations of a VM have been recorded in total."""
+        entry = self.get_entry(vmid)
+        return entry['count'] if entry else 0
+
+    def in_cooldown(self, vmid, now=None):
+        """Check if a VM migrated less than the cool-down ago."""
+        now = time.time() if now is None else now
+        entry = self.get_entry(vmid)
+        return entry is not None and now - entry['moved'] < self.cooldown
+
+    def may_move(self, vmid, from_host, to_host, now=None):
+        """Check if a VM may migrate between two nodes given its cool-down, its last move and its migrations within the window."""
+        now = time.time() if now is None else now
+        entry = self.get_entry(vmid)
+        if entry is None:
+            return True
+        if now - entry['moved'] < self.cooldown:
+            return False
+        if (entry['from'], entry['to']) == (to_host, from_host) and now - entry['moved'] < self.reverse_cooldown:
+            return False  # Moving back would undo the last run's move
+        return self.max_migrations is None or self.get_recent_count(vmid, now) < self.max_migrations
+
+    def record_move(self, vmid, from_host, to_host, now=None):
+        """Record a completed migration of a VM."""
+        now = time.time() if now is None else now
+        entry = self.get_entry(vmid) or {'count': 0, 'recent': []}
+        entry.update({
+            'from': from_host,
+            'to': to_host,
+            'moved': now,
+            'recent': [moved for moved in entry['recent'] if now - moved <= self.window] + [now],
+            'count': entry['count'] + 1,
+        })
+        self.snapshot['vms'][str(vmid)] = entry
+
+    def record_migrations(self, results):
+        """Record the successful migrations of MigrationExecutor.execute() results and save the store."""
+        for result in results:
+            if result['status'] == 'ok':
+                self.record_move(result['vmid'], result['from'], result['to'])
+        self.save()
@@ -14,13 +14,15 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 class MoveOptimizer:
-    def __init__(self, moves):
+    def __init__(self, moves, cost_model=None):
         """
         Initialize the MoveOptimizer with a list of moves.
 
         :param moves: List of moves returned from the balancer.
+        :param cost_model: Optional MigrationCostModel used to annotate every optimized move with its estimated cost.
         """
         self.moves = moves
+        self.cost_model = cost_model
         self.optimized_moves = {}
 
     def optimize(self):
@@ -42,16 +44,30 @@ class MoveOptimizer:
                     self.optimized_moves[item_id]['to'] = to_bucket
                 else:
                     # If this is the first time we're seeing the item, store its initial move
-                    self.optimized_moves[item_id] = {'from': from_bucket, 'to': to_bucket}
+                    self.optimized_moves[item_id] = {'from': from_bucket, 'to': to_bucket, 'item': item}
 
         # Convert the optimized move dictionary back to a list of moves
         result = []
         for item_id, move in self.optimized_moves.items():
             if move['from'] != move['to']:
-                result.append({
+                optimized_move = {
                     'item_id': item_id,
                     'from': move['from'],
                     'to': move['to']
-                })
+                }
+                if self.cost_model is not None:
+                    # A direct move transfers the VM once, so its cost is a single migration regardless of the chain it replaced
+                    optimized_move['transfer'] = self.cost_model.get_transfer_size(move['item'], move['from'], move['to'])
+                    optimized_move['seconds'] = self.cost_model.get_migration_time(move['item'], move['from'], move['to'])
+                result.append(optimized_move)
 
         return result
+
+    def get_total_cost(self, optimized_moves):
+        """
+        Sum the estimated cost of a list of optimized moves.
+
+        :return: Tuple of (GB transferred, migration seconds if the moves ran one after another).
+        """
+        return (sum(move.get('transfer', 0) for move in optimized_moves),
+                sum(move.get('seconds', 0) for move in optimized_moves))
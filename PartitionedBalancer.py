@@ -0,0 +1,165 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from Bucket import Bucket
+from BucketBalancer import BucketBalancer
+from Item import Item
+from SolverBudget import SolverBudget
+
+def balance_partition(partition, deadline=None, max_moves=None, history=None, origins=None):
+    """
+    Balance one partition with BucketBalancer in a worker process.
+
+    The buckets are rebuilt from plain tuples, since pickling the Item objects would also pickle the buckets they were created in.
+
+    :param partition: List of (bucket id, capacity, hostname, [(item id, load, movable), ...]) tuples.
+    :param history: Optional MoveHistoryStore whose cool-downs and migration limits the moves have to respect.
+    :param origins: Optional dict of item id to the hostname the item started the plan on.
+    :return: List of (item id, source bucket id, destination bucket id) tuples in plan order.
+    """
+    buckets = []
+    for bucket_id, capacity, hostname, items in partition:
+        bucket = Bucket(bucket_id, capacity, hostname=hostname)
+        bucket.items = [Item(item_id, bucket, load, movable=movable) for item_id, load, movable in items]
+        buckets.append(bucket)
+    moves = BucketBalancer(buckets, history=history, origins=origins).balance(deadline=deadline, max_moves=max_moves)
+    return [(item.id, move['from'], move['to']) for move in moves for item in move['items']]
+
+class PartitionedBalancer:
+    def __init__(self, buckets, partitions, portable=None, max_workers=None, history=None):
+        """
+        Initialize a balancer that balances groups of compatible nodes independently and concurrently.
+
+        :param buckets: List of buckets to balance.
+        :param partitions: Iterable of hostname lists, e.g. ProxmoxManager.group_nodes_by_cpu(node_stats).values(); buckets in no partition form one more partition.
+        :param portable: Optional set of item ids that may also move between partitions in a final cross-partition pass.
+        :param max_workers: Maximum number of worker processes, or None for one per partition up to the CPU count.
+        :param history: Optional MoveHistoryStore whose cool-downs and migration limits from earlier runs the moves have to respect.
+        """
+        self.buckets = buckets
+        self.portable = set(portable or ())
+        self.max_workers = max_workers
+        self.history = history
+        self.origins = {}  # Item id -> hostname the item started the plan on, for items an earlier pass moved
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
+
+        # Map the hostnames to buckets and collect the leftovers into their own partition
+        buckets_by_hostname = {bucket.hostname: bucket for bucket in buckets}
+        self.partitions = []
+        assigned = set()
+        for hostnames in partitions:
+            partition = [buckets_by_hostname[hostname] for hostname in hostnames if hostname in buckets_by_hostname and hostname not in assigned]
+            assigned.update(bucket.hostname for bucket in partition)
+            if partition:
+                self.partitions.append(partition)
+        leftovers = [bucket for bucket in buckets if bucket.hostname not in assigned]
+        if leftovers:
+            self.partitions.append(leftovers)
+
+    def get_imbalance(self):
+        """Return the summed distance of every bucket from its cluster-wide capacity-proportional target."""
+        total_load = sum(bucket.get_total_load() for bucket in self.buckets)
+        total_capacity = sum(bucket.capacity for bucket in self.buckets)
+        return sum(abs(bucket.get_total_load() - bucket.capacity / total_capacity * total_load) for bucket in self.buckets)
+
+    def replay(self, planned_moves):
+        """Apply (item id, source id, destination id) tuples planned on copies of the buckets and return them as balancer moves."""
+        buckets_by_id = {bucket.id: bucket for bucket in self.buckets}
+        items_by_id = {item.id: item for bucket in self.buckets for item in bucket.items}
+        moves = []
+        for item_id, source_id, destination_id in planned_moves:
+            item = items_by_id[item_id]
+            buckets_by_id[source_id].remove_item(item)
+            buckets_by_id[destination_id].add_item(item)
+            moves.append({'from': source_id, 'to': destination_id, 'items': [item]})
+        return moves
+
+    def balance_partitions(self):
+        """Balance every partition on its own, in a process pool when there is more than one, and return the moves."""
+        max_moves = self.budget.max_moves
+        max_workers = self.max_workers or min(len(self.partitions), os.cpu_count() or 1)
+        if len(self.partitions) == 1 or max_workers == 1:
+            moves = []
+            for position, partition in enumerate(self.partitions):
+                # Share the remaining moves evenly between the partitions still to balance
+                moves_left = self.budget.moves_left(len(moves))
+                partition_moves = None if moves_left is None else -(-moves_left // (len(self.partitions) - position))
+                moves.extend(BucketBalancer(partition, history=self.history, origins=self.origins).balance(deadline=self.budget.deadline, max_moves=partition_moves))
+            return moves
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(balance_partition, [(bucket.id, bucket.capacity, bucket.hostname, [(item.id, item.load, item.movable) for item in bucket.items]) for bucket in partition],
+                                self.budget.deadline, max_moves, self.history, self.origins)
+                for partition in self.partitions
+            ]
+            results = [future.result() for future in futures]
+
+        # Partitions share no buckets, so interleaving their plans keeps every plan prefix feasible under a move limit
+        planned_moves = []
+        for position in range(max((len(result) for result in results), default=0)):
+            planned_moves.extend(result[position] for result in results if position < len(result))
+        if max_moves is not None:
+            planned_moves = planned_moves[:max_moves]
+        return self.replay(planned_moves)
+
+    def balance_portable(self, moves):
+        """
+        Move portable items between partitions, with everything else on a bucket folded into one unmovable item.
+
+        :param moves: Moves already planned, counted against the move limit.
+        :return: List of balancer moves.
+        """
+        shadow_buckets = []
+        for bucket in self.buckets:
+            shadow = Bucket(bucket.id, bucket.capacity, hostname=bucket.hostname)
+            fixed_load = sum(item.load for item in bucket.items if item.id not in self.portable or not item.movable)
+            shadow.items = [Item(f"{bucket.hostname or bucket.id}-fixed", shadow, fixed_load, movable=False)] + [item for item in bucket.items if item.id in self.portable and item.movable]
+            shadow_buckets.append(shadow)
+
+        # Items the partitions already moved are checked against the history from the node they started on
+        hostnames = {bucket.id: bucket.hostname for bucket in self.buckets}
+        origins = dict(self.origins)
+        for move in moves:
+            for item in move['items']:
+                origins.setdefault(item.id, hostnames[move['from']])
+
+        portable_moves = BucketBalancer(shadow_buckets, history=self.history, origins=origins).balance(deadline=self.budget.deadline, max_moves=self.budget.moves_left(len(moves)))
+        return self.replay([(item.id, move['from'], move['to']) for move in portable_moves for item in move['items']])
+
+    def balance_buckets(self):
+        """Balance each partition concurrently, then optionally move portable items between partitions."""
+        moves = self.balance_partitions()
+        if self.portable and len(self.partitions) > 1 and not self.budget.should_stop(len(moves)):
+            moves.extend(self.balance_portable(moves))
+        self.budget.report(self.get_imbalance(), len(moves))
+        return moves
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """
+        Anytime entry point: balance the buckets within a deadline and move limit.
+
+        :param deadline: time.monotonic() timestamp by which the plan must be returned, or None.
+        :param max_moves: Maximum number of moves in the returned plan, or None.
+        :param progress: Optional callable invoked as progress(score, move_count) once the plan is complete, where score is the summed distance from the cluster-wide targets.
+        :return: The moves found before the deadline or move limit was reached.
+        """
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
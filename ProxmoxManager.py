@@ -13,13 +13,70 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
 from proxmoxer import ProxmoxAPI
+from requests import Session
+from requests.adapters import HTTPAdapter
 from Bucket import Bucket
 from Item import Item
 
 class ProxmoxManager:
-    def __init__(self, host, user, password, verify_ssl=False):
+    def __init__(self, host, user, password, verify_ssl=False, max_workers=8, cache=None):
+        """
+        Initialize the connection to the Proxmox API.
+
+        :param host: Proxmox host to connect to.
+        :param user: API user, e.g. 'root@pam'.
+        :param password: Password of the API user.
+        :param verify_ssl: Whether to verify the TLS certificate of the host.
+        :param max_workers: Maximum number of concurrent requests when falling back to per-node queries.
+        :param cache: Optional InventoryCache used to skip refetching static node facts and VM lists.
+        """
         self.proxmox = ProxmoxAPI(host, user=user, password=password, verify_ssl=verify_ssl)
+        self.max_workers = max_workers
+        self.cache = cache
+        self.resize_connection_pool()
+
+    def resize_connection_pool(self):
+        """Let the shared API session keep one keep-alive connection per worker thread."""
+        session = getattr(self.proxmox, '_store', {}).get('session')
+        if isinstance(session, Session):
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.max_workers, 1))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+    @staticmethod
+    def parse_node_status(node_name, status):
+        """Convert a node status response into memory and CPU usage in GB."""
+        if 'memory' in status:
+            memory_info = status['memory']
+            memory_total_gb = memory_info['total'] / 1073741824  # Convert from bytes to GB
+            memory_used_gb = memory_info['used'] / 1073741824  # Convert from bytes to GB
+            memory_used_percentage = memory_used_gb / memory_total_gb * 100  # percentage
+            return {
+                'cpu': status['cpu'],
+                'memory_used': memory_used_gb,
+                'memory_used_percentage': memory_used_percentage,
+                'max_memory': memory_total_gb,
+                'memory_free': memory_total_gb - memory_used_gb,
+                'cpu_info': status.get('cpuinfo', {})
+            }
+
+        print(f"Memory information not available for node {node_name}")
+        return {
+            'cpu': status.get('cpu', 0),
+            'memory_used': 0,
+            'memory_used_percentage': 0,
+            'max_memory': 0,
+            'memory_free': 0,
+            'cpu_info': status.get('cpuinfo', {})
+        }
+
+    def get_node_stats(self, node_name):
+        """Retrieve memory and CPU usage for a single node in GB."""
+        status = self.proxmox.nodes(node_name).status.get()
+        return self.parse_node_status(node_name, status)
 
     def get_node_usage(self):
         """Retrieve memory and CPU usage for each node in GB."""
@@ -27,32 +84,52 @@ class ProxmoxManager:
         node_stats = {}
         for node in nodes:
             node_name = node['node']
-            status = self.proxmox.nodes(node_name).status.get()
-            if 'memory' in status:
-                memory_info = status['memory']
-                memory_total_gb = memory_info['total'] / 1073741824  # Convert from bytes to GB
-                memory_used_gb = memory_info['used'] / 1073741824  # Convert from bytes to GB
-                memory_used_percentage = memory_used_gb / memory_total_gb * 100  # percentage
-                node_stats[node_name] = {
-                    'cpu': status['cpu'],
-                    'memory_used': memory_used_gb,
-                    'memory_used_percentage': memory_used_percentage,
-                    'max_memory': memory_total_gb,
-                    'memory_free': memory_total_gb - memory_used_gb,
-                    'cpu_info': status.get('cpuinfo', {})
-                }
-            else:
-                print(f"Memory information not available for node {node_name}")
-                node_stats[node_name] = {
-                    'cpu': status.get('cpu', 0),
-                    'memory_used': 0,
-                    'memory_used_percentage': 0,
-                    'max_memory': 0,
-                    'memory_free': 0,
-                    'cpu_info': status.get('cpuinfo', {})
-                }
+            node_stats[node_name] = self.get_node_stats(node_name)
+        return node_stats
+
+    def get_cluster_resources(self):
+        """Retrieve the node and guest resources of the whole cluster in a single request."""
+        return self.proxmox.cluster.resources.get()
+
+    @staticmethod
+    def get_node_usage_from_resources(resources):
+        """Build node usage stats in GB from a /cluster/resources response."""
+        node_stats = {}
+        for resource in resources:
+            if resource.get('type') != 'node':
+                continue
+
+            node_name = resource['node']
+            if resource.get('status', 'online') != 'online':
+                print(f"Skipping node {node_name} because it is {resource.get('status')}")
+                continue
+
+            # Shape the resource like a node status response so both paths share the same parsing
+            status = {'cpu': resource.get('cpu', 0), 'cpuinfo': {'cpus': resource.get('maxcpu', 0)}}
+            if resource.get('maxmem'):
+                status['memory'] = {'total': resource['maxmem'], 'used': resource.get('mem', 0)}
+            node_stats[node_name] = ProxmoxManager.parse_node_status(node_name, status)
         return node_stats
 
+    @staticmethod
+    def get_cpu_cores_used(status):
+        """Convert the CPU usage fraction of a VM status or resource into cores, using 'cpus' or 'maxcpu' as the core count."""
+        return status.get('cpu', 0) * status.get('cpus', status.get('maxcpu', 0))
+
+    @staticmethod
+    def get_powered_on_vms_from_resources(resources):
+        """Group the powered-on VMs of a /cluster/resources response by node, with their memory usage in GB."""
+        vms_by_node = {}
+        for resource in resources:
+            if resource.get('type') != 'qemu' or resource.get('status') != 'running':
+                continue
+            vms_by_node.setdefault(resource['node'], []).append({
+                'vmid': resource['vmid'],
+                'memory_used': resource.get('mem', 0) / 1073741824,  # Convert from bytes to GB
+                'cpu_used': ProxmoxManager.get_cpu_cores_used(resource)
+            })
+        return vms_by_node
+
     def group_nodes_by_cpu(self, node_stats):
         """Group nodes by their CPU model and core count."""
         groups = {}
@@ -110,7 +187,8 @@ class ProxmoxManager:
                     
                     powered_on_vms.append({
                         'vmid': vmid,
-                        'memory_used': memory_used_gb  # Memory usage in GB
+                        'memory_used': memory_used_gb,  # Memory usage in GB
+                        'cpu_used': self.get_cpu_cores_used(vm_status)  # CPU usage in cores
                     })
             except Exception as e:
                 print(f"Failed to retrieve status for VM {vmid} on node {node}: {e}")
@@ -118,6 +196,204 @@ class ProxmoxManager:
         # Return the list of powered-on VMs
         return powered_on_vms
 
+    def get_vm_status(self, node, vmid):
+        """Retrieve the current status of a VM, or None if the request fails."""
+        try:
+            return self.proxmox.nodes(node).qemu(vmid).status.current.get()
+        except Exception as e:
+            print(f"Failed to retrieve status for VM {vmid} on node {node}: {e}")
+            return None
+
+    def get_vm_list(self, node):
+        """Retrieve the VMs on a node, or an empty list if the request fails."""
+        try:
+            return self.proxmox.nodes(node).qemu.get()
+        except Exception as e:
+            print(f"Failed to retrieve VMs for node {node}: {e}")
+            return []
+
+    def get_vm_config(self, node, vmid):
+        """Retrieve the configuration of a VM, or None if the request fails."""
+        try:
+            return self.proxmox.nodes(node).qemu(vmid).config.get()
+        except Exception as e:
+            print(f"Failed to retrieve config for VM {vmid} on node {node}: {e}")
+            return None
+
+    @staticmethod
+    def parse_local_disk_size(config, shared_storages):
+        """Sum the size in GB of the disks in a VM config that are not on shared storage (CD-ROMs excluded)."""
+        units = {'': 1 / 1073741824, 'K': 1 / 1048576, 'M': 1 / 1024, 'G': 1, 'T': 1024}  # Factors to GB
+        total = 0
+        for key, value in config.items():
+            if not re.fullmatch(r'(ide|sata|scsi|virtio|efidisk|tpmstate)\d+', key) or 'media=cdrom' in str(value):
+                continue
+            storage = str(value).split(':', 1)[0]
+            size = re.search(r'(?:^|,)size=(\d+(?:\.\d+)?)([KMGT]?)', str(value))
+            if storage != 'none' and storage not in shared_storages and size:
+                total += float(size.group(1)) * units[size.group(2)]
+        return total
+
+    def get_local_disk_sizes(self, vms_by_node):
+        """
+        Collect how much disk each VM has on local storage, which a live migration has to copy.
+
+        :param vms_by_node: Powered-on VMs keyed by node name, as returned by get_inventory().
+        :return: Dict of vmid -> GB of disks on local storage.
+        """
+        storages = self.proxmox.cluster.resources.get(type='storage')
+        shared_storages = {storage['storage'] for storage in storages if storage.get('shared')}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            config_futures = [(vm['vmid'], executor.submit(self.get_vm_config, node, vm['vmid'])) for node, vms in vms_by_node.items() for vm in vms]
+            local_disks = {}
+            for vmid, future in config_futures:
+                config = future.result()
+                if config is not None:
+                    local_disks[vmid] = self.parse_local_disk_size(config, shared_storages)
+        return local_disks
+
+    @staticmethod
+    def is_portable_config(config):
+        """Check if a VM config uses a generic CPU type that every node can run, as opposed to passing the host CPU through."""
+        cpu = str(config.get('cpu', ''))
+        cpu_type = next((part.split('=', 1)[1] for part in cpu.split(',') if part.startswith('cputype=')), cpu.split(',', 1)[0])
+        return cpu_type != 'host'
+
+    def get_portable_vms(self, vms_by_node):
+        """
+        Collect the VMs that can migrate between nodes with different CPU models.
+
+        :param vms_by_node: Powered-on VMs keyed by node name, as returned by get_inventory().
+        :return: Set of vmids whose config does not use the 'host' CPU type.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            config_futures = [(vm['vmid'], executor.submit(self.get_vm_config, node, vm['vmid'])) for node, vms in vms_by_node.items() for vm in vms]
+            return {vmid for vmid, future in config_futures if future.result() is not None and self.is_portable_config(future.result())}
+
+    def get_inventory_per_node(self, node_names):
+        """
+        Collect node usage and powered-on VMs with per-node queries run on a bounded thread pool.
+
+        All requests share the API session, and each node's VM list is fetched exactly once.
+
+        :param node_names: Names of the nodes to query.
+        :return: Tuple of (node_stats, vms_by_node).
+        """
+        node_stats = {}
+        vms_by_node = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Query the status and VM list of every node concurrently
+            status_futures = {node: executor.submit(self.get_node_stats, node) for node in node_names}
+            vm_list_futures = {node: executor.submit(self.get_vm_list, node) for node in node_names}
+
+            # Then query the status of the VMs concurrently
+            vm_status_futures = []
+            for node in node_names:
+                vm_list = vm_list_futures[node].result()
+                vmids = [vm['vmid'] for vm in vm_list]
+                cached_vmids = self.cache.get_guests(node) if self.cache is not None else None
+
+                if cached_vmids is None:
+                    # Full refresh: query the current status of every VM
+                    for vmid in vmids:
+                        vm_status_futures.append((node, vmid, executor.submit(self.get_vm_status, node, vmid)))
+                    if self.cache is not None:
+                        self.cache.put_guests(node, vmids)
+                else:
+                    # Delta refresh: the VM list already carries the running state and memory of known VMs,
+                    # so only newly added VMs need their own status request
+                    added, removed = self.cache.update_guests(node, vmids)
+                    for vm in vm_list:
+                        if vm['vmid'] in added:
+                            vm_status_futures.append((node, vm['vmid'], executor.submit(self.get_vm_status, node, vm['vmid'])))
+                        else:
+                            vm_status_futures.append((node, vm['vmid'], vm))
+
+            for node in node_names:
+                try:
+                    node_stats[node] = status_futures[node].result()
+                    if self.cache is not None:
+                        self.cache.put_static(node, node_stats[node]['max_memory'], node_stats[node]['cpu_info'])
+                except Exception as e:
+                    print(f"Failed to retrieve status for node {node}: {e}")
+                vms_by_node[node] = []
+
+            for node, vmid, future in vm_status_futures:
+                vm_status = future.result() if isinstance(future, Future) else future
+
+                # Only consider powered-on (running) VMs
+                if vm_status and vm_status['status'] == 'running':
+                    vms_by_node[node].append({
+                        'vmid': vmid,
+                        'memory_used': vm_status['mem'] / 1073741824,  # Convert from bytes to GB
+                        'cpu_used': self.get_cpu_cores_used(vm_status)
+                    })
+
+        return node_stats, vms_by_node
+
+    def get_inventory(self, host_names=None, use_cluster_resources=True):
+        """
+        Collect node usage and powered-on VMs for the cluster.
+
+        The single /cluster/resources request is used when possible; otherwise the nodes are queried
+        individually on a thread pool.
+
+        :param host_names: List of host names to include. If None, include all hosts.
+        :param use_cluster_resources: Whether to try the /cluster/resources endpoint first.
+        :return: Tuple of (node_stats, vms_by_node).
+        """
+        if use_cluster_resources:
+            try:
+                resources = self.get_cluster_resources()
+            except Exception as e:
+                print(f"Failed to retrieve cluster resources, falling back to per-node queries: {e}")
+            else:
+                node_stats = self.get_node_usage_from_resources(resources)
+                vms_by_node = self.get_powered_on_vms_from_resources(resources)
+                if host_names:
+                    node_stats = {node: stats for node, stats in node_stats.items() if node in host_names}
+                if self.fill_cpu_info(node_stats) and self.cache is not None:
+                    self.cache.save()
+                return node_stats, {node: vms_by_node.get(node, []) for node in node_stats}
+
+        node_names = [node['node'] for node in self.proxmox.nodes.get()]
+        if host_names:
+            node_names = [node for node in node_names if node in host_names]
+        inventory = self.get_inventory_per_node(node_names)
+        if self.cache is not None:
+            self.cache.save()
+        return inventory
+
+    def fill_cpu_info(self, node_stats):
+        """
+        Fill in the CPU details that a /cluster/resources response lacks, such as the CPU model.
+
+        The CPU model is only reported by the node status request, so it is fetched concurrently for
+        nodes without fresh cached static facts and taken from the cache for the others. Nodes whose
+        status cannot be fetched keep an empty model.
+
+        :return: True if static facts were fetched from the API, False if all were served from the cache.
+        """
+        static_facts = {node: self.cache.get_static(node) if self.cache is not None else None for node in node_stats}
+        stale_nodes = [node for node, static in static_facts.items() if static is None]
+        if stale_nodes:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {node: executor.submit(self.get_node_stats, node) for node in stale_nodes}
+                for node, future in futures.items():
+                    try:
+                        stats = future.result()
+                        if self.cache is not None:
+                            self.cache.put_static(node, stats['max_memory'], stats['cpu_info'])
+                        static_facts[node] = stats
+                    except Exception as e:
+                        print(f"Failed to retrieve status for node {node}: {e}")
+
+        for node, stats in node_stats.items():
+            if static_facts[node] is not None:
+                stats['cpu_info'] = static_facts[node]['cpu_info']
+        return bool(stale_nodes)
+
     def calculate_balance_percentage(self, group, node_stats, avg_memory):
         """Calculate how close the group is to being balanced in terms of memory utilization."""
         total_difference = 0
@@ -158,43 +434,58 @@ class ProxmoxManager:
             vm_memory_list = [f"{vm[1]:.2f}" for vm in powered_on_vms]  # Format as 'used/allocated'
             print(", ".join(vm_memory_list))  # Join and print the memory usage separated by commas
 
-    def get_buckets(self, host_names=None):
+    @staticmethod
+    def build_buckets(node_stats, vms_by_node, estimated_loads=None):
         """
-        Get buckets for the specified host names, sorted by node name.
-        
-        :param host_names: List of host names to include. If None, include all hosts.
+        Build buckets from collected node stats and powered-on VMs, sorted by node name.
+
+        :param node_stats: Node usage stats keyed by node name.
+        :param vms_by_node: Powered-on VMs keyed by node name.
+        :param estimated_loads: Optional vmid -> smoothed memory in GB used as the VM loads instead of the current sample.
         :return: List of buckets with VMs and static items.
         """
-        # Fetch node usage stats from Proxmox
-        node_stats = self.get_node_usage()
-
-        # Filter the node stats based on the provided host names
-        if host_names:
-            node_stats = {node: stats for node, stats in node_stats.items() if node in host_names}
-
         # Sort the nodes by name
         sorted_node_names = sorted(node_stats.keys())
 
         # Create buckets with initial loads and include hostnames
         buckets_initial = []
         for i, node in enumerate(sorted_node_names):
-            # Initialize the bucket with the node's capacity and hostname
-            bucket = Bucket(i, node_stats[node]['max_memory'], hostname=node)
-            
-            # Add static item for system memory that cannot be moved
-            system_memory_used = node_stats[node]['memory_used'] - sum([vm['memory_used'] for vm in self.get_powered_on_vms(node)])
-            static_item = Item(f"{node}-static", bucket, system_memory_used, movable=False)
+            # Initialize the bucket with the node's capacity, core count and hostname
+            cpu_count = node_stats[node]['cpu_info'].get('cpus', 0)
+            bucket = Bucket(i, node_stats[node]['max_memory'], hostname=node, resource_capacities={'cpu': cpu_count} if cpu_count else None)
+            powered_on_vms = vms_by_node.get(node, [])
+
+            # Add static item for system memory and CPU that cannot be moved
+            system_memory_used = node_stats[node]['memory_used'] - sum([vm['memory_used'] for vm in powered_on_vms])
+            system_cpu_used = max(0, node_stats[node]['cpu'] * cpu_count - sum([vm.get('cpu_used', 0) for vm in powered_on_vms]))
+            static_item = Item(f"{node}-static", bucket, system_memory_used, movable=False, resources={'cpu': system_cpu_used})
             bucket.add_item(static_item)
 
             # Add dynamic items for each powered-on VM
-            powered_on_vms = self.get_powered_on_vms(node)
             for vm in powered_on_vms:
                 vmid = vm['vmid']
                 memory_used = vm['memory_used']  # VM memory used in GB
-                dynamic_item = Item(vmid, bucket, memory_used, movable=True)
+                if estimated_loads is not None and estimated_loads.get(vmid) is not None:
+                    # The static item was derived from the current samples, so an estimate that would overfill the node falls back to the sample
+                    if bucket.get_total_load() + estimated_loads[vmid] <= bucket.capacity:
+                        memory_used = estimated_loads[vmid]
+                dynamic_item = Item(vmid, bucket, memory_used, movable=True, resources={'cpu': vm.get('cpu_used', 0)})
                 bucket.add_item(dynamic_item)
 
             # Append the bucket to the initial list
             buckets_initial.append(bucket)
 
-        return buckets_initial
\ No newline at end of file
+        return buckets_initial
+
+    def get_buckets(self, host_names=None, use_cluster_resources=True, estimator=None):
+        """
+        Get buckets for the specified host names, sorted by node name.
+        
+        :param host_names: List of host names to include. If None, include all hosts.
+        :param use_cluster_resources: Whether to collect the inventory from the single /cluster/resources request.
+        :param estimator: Optional LoadEstimator that is fed the VM memory samples and supplies smoothed VM loads.
+        :return: List of buckets with VMs and static items.
+        """
+        node_stats, vms_by_node = self.get_inventory(host_names, use_cluster_resources)
+        estimated_loads = estimator.update_inventory(vms_by_node) if estimator is not None else None
+        return self.build_buckets(node_stats, vms_by_node, estimated_loads)
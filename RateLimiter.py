@@ -0,0 +1,46 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        """
+        Initialize an asyncio token bucket rate limiter.
+
+        :param rate: Maximum sustained number of acquisitions per second. None or 0 disables limiting.
+        :param burst: Number of acquisitions allowed back-to-back before the rate applies (defaults to one second's worth).
+        """
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, rate or 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a request may be sent."""
+        if not self.rate:
+            return
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
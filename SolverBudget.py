@@ -0,0 +1,63 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+class SolverBudget:
+    def __init__(self, deadline=None, max_moves=None, progress=None):
+        """
+        Initialize the limits an anytime balancer run must respect.
+
+        :param deadline: time.monotonic() timestamp by which the balancer must return, or None for no deadline.
+        :param max_moves: Maximum number of moves the returned plan may contain, or None for no limit.
+        :param progress: Optional callable invoked as progress(score, move_count) while the balancer runs.
+        """
+        self.deadline = deadline
+        self.max_moves = max_moves
+        self.progress = progress
+
+    @classmethod
+    def from_seconds(cls, seconds, max_moves=None, progress=None):
+        """Create a budget whose deadline is the given number of seconds from now."""
+        return cls(time.monotonic() + seconds, max_moves, progress)
+
+    def expired(self):
+        """Check if the deadline has passed."""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self):
+        """Return the seconds left before the deadline, or None without a deadline."""
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def moves_exhausted(self, move_count):
+        """Check if the plan has reached the maximum number of moves."""
+        return self.max_moves is not None and move_count >= self.max_moves
+
+    def moves_left(self, move_count):
+        """Return how many more moves the plan may take, or None without a move limit."""
+        return None if self.max_moves is None else max(0, self.max_moves - move_count)
+
+    def exceeds_moves(self, move_count):
+        """Check if a finished plan has more moves than allowed."""
+        return self.max_moves is not None and move_count > self.max_moves
+
+    def should_stop(self, move_count):
+        """Check if the balancer has to stop because of the deadline or the move limit."""
+        return self.moves_exhausted(move_count) or self.expired()
+
+    def report(self, score, move_count):
+        """Pass the current score and plan size to the progress callback, if any."""
+        if self.progress is not None:
+            self.progress(score, move_count)
@@ -0,0 +1,221 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+from IndexedPriorityQueue import IndexedPriorityQueue
+from ItemLoadIndex import ItemLoadIndex
+from SolverBudget import SolverBudget
+
+class SwapBalancer:
+    def __init__(self, buckets, max_iterations=1000, patience=50, tabu_tenure=10, candidate_buckets=4, candidate_items=6, tolerance=0.01, history=None):
+        """
+        Initialize a tabu search balancer that exchanges VMs between nodes, for clusters too full for one-way moves.
+
+        Every iteration applies the best non-tabu move, 1-for-1 swap or 2-for-1 swap between the most overfilled and most underfilled buckets, even if it
+        makes the balance worse, and the plan is rolled back to the best state found. Each item migrates at most once per plan, and a swap is only
+        taken if one of its directions can complete first without overcommitting a node, so WaveScheduler can order the plan.
+
+        :param buckets: List of buckets to balance.
+        :param max_iterations: Maximum number of moves and swaps to apply.
+        :param patience: Number of iterations without a new best state before the search stops.
+        :param tabu_tenure: Number of iterations during which load cannot flow back between the two buckets of an exchange, unless it leads to a new best state.
+        :param candidate_buckets: Number of most overfilled and most underfilled buckets paired up in every iteration.
+        :param candidate_items: Number of items, spread over each bucket's load order, that anchor the swap candidates.
+        :param tolerance: Fraction of its target by which a bucket may deviate before it is balanced, as in BucketBalancer.
+        :param history: Optional MoveHistoryStore whose cool-downs and migration limits from earlier runs the exchanges have to respect.
+        """
+        self.buckets = buckets
+        self.max_iterations = max_iterations
+        self.patience = patience
+        self.tabu_tenure = tabu_tenure
+        self.candidate_buckets = candidate_buckets
+        self.candidate_items = candidate_items
+        self.tolerance = tolerance
+        self.history = history
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
+
+    def get_targets(self):
+        """Calculate the capacity-proportional target load of every bucket."""
+        total_capacity = sum(bucket.capacity for bucket in self.buckets)
+        total_load = sum(bucket.get_total_load() for bucket in self.buckets)
+        return {bucket.id: bucket.capacity / total_capacity * total_load for bucket in self.buckets}
+
+    def get_delta(self, source_excess, destination_excess, load):
+        """Return the change of the squared distance from the targets when a net load moves from the source to the destination, in O(1)."""
+        return 2 * load * (destination_excess - source_excess) + 2 * load * load
+
+    def is_feasible(self, source, destination, outgoing, incoming):
+        """
+        Check that an exchange fits once finished and that one of its directions fits before the other one has freed any memory.
+
+        :param outgoing: Total load of the items moving from source to destination.
+        :param incoming: Total load of the items moving from destination to source.
+        """
+        net = outgoing - incoming
+        if destination.get_total_load() + net > destination.capacity or source.get_total_load() - net > source.capacity:
+            return False
+        return destination.get_total_load() + outgoing <= destination.capacity or source.get_total_load() + incoming <= source.capacity
+
+    def get_candidates(self, source_index, destination_index, gap):
+        """
+        Yield (outgoing items, incoming items) exchanges whose net load is close to the gap, found by bisecting the load indexes.
+
+        :param gap: Ideal net load to move from the source to the destination.
+        """
+        # Move: the single item closest to the gap
+        for item in itertools.islice(source_index.nearest(gap), 2):
+            yield (item,), ()
+
+        source_anchors = source_index.spread(self.candidate_items)
+        destination_anchors = destination_index.spread(self.candidate_items)
+        for incoming in destination_anchors:
+            # 1-for-1: an outgoing item larger than the incoming one by the gap
+            for item in itertools.islice(source_index.nearest(incoming.load + gap), 2):
+                yield (item,), (incoming,)
+            # 2-for-1: two outgoing items that together exceed the incoming one by the gap
+            for outgoing in source_anchors:
+                for item in itertools.islice(source_index.nearest(incoming.load + gap - outgoing.load), 2):
+                    if item is not outgoing:
+                        yield (outgoing, item), (incoming,)
+                        break
+        for outgoing in source_anchors:
+            # 1-for-2: two incoming items that together fall short of the outgoing one by the gap
+            for incoming in destination_anchors:
+                for item in itertools.islice(destination_index.nearest(outgoing.load - gap - incoming.load), 2):
+                    if item is not incoming:
+                        yield (outgoing,), (incoming, item)
+                        break
+
+    def apply_exchange(self, source, destination, outgoing, incoming):
+        """Swap the items between the two buckets, removing both sides first so neither bucket overflows in between."""
+        for item in outgoing:
+            source.remove_item(item)
+        for item in incoming:
+            destination.remove_item(item)
+        for item in outgoing:
+            destination.add_item(item)
+        for item in incoming:
+            source.add_item(item)
+
+    def update_bucket_queues(self, bucket, excess, target, position, overfilled, underfilled):
+        """Place a bucket in the overfilled or underfilled queue depending on its distance from the target, or in neither if it is within tolerance."""
+        overfilled.remove(bucket.id)
+        underfilled.remove(bucket.id)
+        if abs(excess) <= target * self.tolerance:
+            return
+        if excess > 0:
+            overfilled.push(bucket.id, (-excess, position))
+        elif excess < 0:
+            underfilled.push(bucket.id, (excess, position))
+
+    def balance_buckets(self):
+        """
+        Balance the buckets with a tabu search over moves and swaps, without a maximum average load.
+
+        :return: List of moves in the balancer format ({'from', 'to', 'items'}); a swap is two moves in opposite directions.
+        """
+        targets = self.get_targets()
+        buckets_by_id = {bucket.id: bucket for bucket in self.buckets}
+        positions = {bucket.id: position for position, bucket in enumerate(self.buckets)}
+        item_indexes = {bucket.id: ItemLoadIndex([item for item in bucket.items if item.movable]) for bucket in self.buckets}
+        excess = {bucket.id: bucket.get_total_load() - targets[bucket.id] for bucket in self.buckets}
+
+        overfilled = IndexedPriorityQueue()
+        underfilled = IndexedPriorityQueue()
+        for bucket in self.buckets:
+            self.update_bucket_queues(bucket, excess[bucket.id], targets[bucket.id], positions[bucket.id], overfilled, underfilled)
+
+        score = sum(value * value for value in excess.values())
+        best_score, best_length = score, 0
+        exchanges = []  # (source, destination, outgoing items, incoming items) in the order they were applied
+        tabu = {}  # (from bucket id, to bucket id) -> iteration until which that direction is tabu
+        moved_count = 0
+
+        for iteration in range(self.max_iterations):
+            if len(exchanges) - best_length >= self.patience:
+                break  # No new best state for a while
+            if not overfilled or not underfilled or self.budget.should_stop(moved_count):
+                break
+
+            best = None
+            for source_id, _ in overfilled.smallest(self.candidate_buckets):
+                for destination_id, _ in underfilled.smallest(self.candidate_buckets):
+                    source, destination = buckets_by_id[source_id], buckets_by_id[destination_id]
+                    gap = (excess[source_id] - excess[destination_id]) / 2
+                    for outgoing, incoming in self.get_candidates(item_indexes[source_id], item_indexes[destination_id], gap):
+                        outgoing_load = sum(item.load for item in outgoing)
+                        incoming_load = sum(item.load for item in incoming)
+                        delta = self.get_delta(excess[source_id], excess[destination_id], outgoing_load - incoming_load)
+                        if best is not None and delta >= best[0]:
+                            continue
+                        if self.budget.exceeds_moves(moved_count + len(outgoing) + len(incoming)):
+                            continue
+                        # Load may not flow back along a recent exchange unless that reaches a new best state
+                        if tabu.get((destination_id, source_id), -1) >= iteration and score + delta >= best_score - 1e-9:
+                            continue
+                        if not self.is_feasible(source, destination, outgoing_load, incoming_load):
+                            continue
+                        if self.history is not None and not (all(self.history.may_move(item.id, source.hostname, destination.hostname) for item in outgoing)
+                                                             and all(self.history.may_move(item.id, destination.hostname, source.hostname) for item in incoming)):
+                            continue  # Moved too recently or too often in earlier runs
+                        best = (delta, source, destination, outgoing, incoming)
+            if best is None:
+                break  # Every candidate is tabu, infeasible or over the move limit
+
+            delta, source, destination, outgoing, incoming = best
+            self.apply_exchange(source, destination, outgoing, incoming)
+            for item in outgoing + incoming:
+                # Each item migrates at most once per plan
+                item_indexes[source.id].remove(item)
+                item_indexes[destination.id].remove(item)
+            net = sum(item.load for item in outgoing) - sum(item.load for item in incoming)
+            excess[source.id] -= net
+            excess[destination.id] += net
+            for bucket in (source, destination):
+                self.update_bucket_queues(bucket, excess[bucket.id], targets[bucket.id], positions[bucket.id], overfilled, underfilled)
+            tabu[(source.id, destination.id)] = iteration + self.tabu_tenure
+
+            score += delta
+            moved_count += len(outgoing) + len(incoming)
+            exchanges.append((source, destination, outgoing, incoming))
+            if score < best_score - 1e-9:
+                best_score, best_length = score, len(exchanges)
+            self.budget.report(best_score, moved_count)
+
+        # Roll back the exchanges made after the best state, newest first, so every undo returns to a state already visited
+        for source, destination, outgoing, incoming in reversed(exchanges[best_length:]):
+            self.apply_exchange(destination, source, outgoing, incoming)
+
+        moves = []
+        for source, destination, outgoing, incoming in exchanges[:best_length]:
+            moves.append({'from': source.id, 'to': destination.id, 'items': list(outgoing)})
+            if incoming:
+                moves.append({'from': destination.id, 'to': source.id, 'items': list(incoming)})
+        return moves
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """
+        Anytime entry point: balance the buckets within a deadline and move limit.
+
+        :param deadline: time.monotonic() timestamp by which the plan must be returned, or None.
+        :param max_moves: Maximum number of migrated items in the returned plan, or None.
+        :param progress: Optional callable invoked as progress(score, move_count), where score is the best squared distance from the targets so far.
+        :return: The moves found before the deadline or move limit was reached.
+        """
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
@@ -13,10 +13,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from SolverBudget import SolverBudget
+
 class BucketBalancer:
     def __init__(self, buckets):
         self.buckets = buckets
         self.tolerance = 0.10  # +/- 5% tolerance
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
 
     def get_total_load(self):
         """Calculate the total load across all buckets."""
@@ -46,6 +49,10 @@ class BucketBalancer:
         # Sort items in decreasing order by their load
         all_items.sort(key=lambda item: item.load, reverse=True)
 
+        # Remember the current placement so an interrupted or oversized plan can be undone
+        original_items = {bucket.id: list(bucket.items) for bucket in self.buckets}
+        original_bucket = {item.id: bucket.id for bucket in self.buckets for item in bucket.items}
+
         # Clear buckets to reassign items using first-fit decreasing
         for bucket in self.buckets:
             bucket.items = []
@@ -53,7 +60,11 @@ class BucketBalancer:
         moves = []
 
         # Assign each item to the first bucket that can fit it within tolerance
+        interrupted = False
         for item in all_items:
+            if self.budget.expired():
+                interrupted = True
+                break  # A partial packing leaves items unplaced, so it is undone below
             for bucket in self.buckets:
                 bucket_load = bucket.get_total_load()
                 target_load = targets[bucket.id]
@@ -64,5 +75,21 @@ class BucketBalancer:
                     moves.append({'item': item.id, 'to_bucket': bucket.id})
                     break  # Move on to the next item once it's placed
 
+        # The packing only produces a plan once complete, so fall back to the original placement
+        # (the empty plan) if the deadline interrupted it or it migrates more items than allowed
+        migrations = sum(1 for move in moves if original_bucket[move['item']] != move['to_bucket'])
+        if interrupted or self.budget.exceeds_moves(migrations):
+            for bucket in self.buckets:
+                bucket.items = original_items[bucket.id]
+            return []
+
+        self.budget.report(sum(abs(bucket.get_total_load() - targets[bucket.id]) for bucket in self.buckets), migrations)
         return moves
 
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """Anytime entry point: balance within a time.monotonic() deadline and a limit on migrated items, reporting progress(score, move_count)."""
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
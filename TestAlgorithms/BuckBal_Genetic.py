@@ -13,20 +13,111 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import random
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from ClusterState import ClusterState
+from SolverBudget import SolverBudget
+
+# Constant arrays shared with the repair worker processes, set once by init_worker
+_worker_state = {}
+
+def init_worker(item_loads, capacities, initial_assignment, targets, tolerance):
+    """Store the constant repair and evaluation inputs in a worker process."""
+    _worker_state['item_loads'] = item_loads
+    _worker_state['capacities'] = capacities
+    _worker_state['initial_assignment'] = initial_assignment
+    _worker_state['targets'] = targets
+    _worker_state['tolerance'] = tolerance
+
+def evaluate_loads(loads, targets, tolerance):
+    """Compute the fitness of every chromosome from its (chromosomes x buckets) matrix of bucket loads."""
+    deviation = np.abs(loads - targets)
+    imbalance = np.where(deviation > targets * tolerance, deviation, 0).sum(axis=1)
+    return 1 / (1 + imbalance)  # Lower imbalance means better fitness
+
+def evaluate_population(population, item_loads, targets, tolerance):
+    """
+    Compute the fitness of every chromosome (row) of a population matrix.
+
+    All bucket loads are computed with a single bincount over the flattened population.
+    """
+    return evaluate_loads(population_loads(population, item_loads, len(targets)), targets, tolerance)
+
+def repair_population(population, rng, item_loads=None, capacities=None, initial_assignment=None, targets=None, tolerance=None, rounds=10):
+    """
+    Return over-capacity chromosomes to a feasible assignment, vectorized over the whole population, and score them.
+
+    Items in overloaded buckets are sent back to their initial bucket at random until every bucket fits;
+    chromosomes that are still infeasible after the given rounds are reset to the initial assignment.
+    The fitness comes from the bucket loads the last feasibility check computed.
+
+    :param rng: numpy Generator, or a seed for one in a worker process.
+    :return: Tuple of (population, fitness scores).
+    """
+    item_loads = _worker_state['item_loads'] if item_loads is None else item_loads
+    capacities = _worker_state['capacities'] if capacities is None else capacities
+    initial_assignment = _worker_state['initial_assignment'] if initial_assignment is None else initial_assignment
+    targets = _worker_state['targets'] if targets is None else targets
+    tolerance = _worker_state['tolerance'] if tolerance is None else tolerance
+    rng = np.random.default_rng(rng)
+
+    rows = np.arange(population.shape[0])[:, None]
+    for _ in range(rounds):
+        loads = population_loads(population, item_loads, len(capacities))
+        overloaded = loads > capacities
+        if not overloaded.any():
+            return population, evaluate_loads(loads, targets, tolerance)
+
+        # Genes sitting in an overloaded bucket of their own chromosome, excluding items already home
+        in_overloaded = overloaded[rows, population] & (population != initial_assignment)
+        send_home = in_overloaded & (rng.random(population.shape) < 0.5)
+        population = np.where(send_home, initial_assignment, population)
+
+    loads = population_loads(population, item_loads, len(capacities))
+    infeasible = (loads > capacities).any(axis=1)
+    population[infeasible] = initial_assignment
+    loads[infeasible] = population_loads(initial_assignment[None, :], item_loads, len(capacities))[0]
+    return population, evaluate_loads(loads, targets, tolerance)
+
+def population_loads(population, item_loads, bucket_count):
+    """Return a (chromosomes x buckets) matrix of bucket loads."""
+    chromosome_count = population.shape[0]
+    offsets = (np.arange(chromosome_count) * bucket_count)[:, None]
+    flat_loads = np.bincount((population + offsets).ravel(), weights=np.tile(item_loads, chromosome_count), minlength=chromosome_count * bucket_count)
+    return flat_loads.reshape(chromosome_count, bucket_count)
 
 class BucketBalancer:
-    def __init__(self, buckets, population_size=100, generations=25, mutation_rate=0.1):
+    def __init__(self, buckets, population_size=100, generations=25, mutation_rate=0.1, processes=None, seed=None):
+        """
+        Initialize the genetic balancer.
+
+        Chromosomes are rows of an integer matrix (chromosomes x items) holding the bucket index of every item.
+
+        :param buckets: List of buckets to balance.
+        :param population_size: Number of chromosomes per generation.
+        :param generations: Number of generations to evolve.
+        :param mutation_rate: Probability that a gene is reassigned to a random bucket.
+        :param processes: Number of worker processes to split capacity repair and fitness evaluation across, None or 1 to run in-process.
+        :param seed: Seed for the random number generator.
+        """
         self.buckets = buckets
         self.population_size = population_size
         self.generations = generations
         self.mutation_rate = mutation_rate
+        self.processes = processes
         self.tolerance = 0.05  # +/- 5% tolerance
-        self.population = []
+        self.rng = np.random.default_rng(seed)
+        self.state = ClusterState.from_buckets(buckets)
+        self.initial_assignment = self.state.assignment.copy()
+        self.targets = self.state.get_targets()
+        self.movable_columns = np.flatnonzero(self.state.item_movable)
+        self.population = np.empty((0, self.state.item_count), dtype=np.int64)
+        self.executor = None
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
 
     def get_total_load(self):
         """Calculate the total load across all buckets."""
-        return sum(bucket.get_total_load() for bucket in self.buckets)
+        return float(self.state.item_loads.sum())
 
     def target_load(self, bucket_capacity, total_capacity, total_load):
         """Calculate the target load for a bucket based on its capacity and total system load."""
@@ -36,92 +127,110 @@ class BucketBalancer:
         """Check if a bucket's load is within the +/- 5% tolerance."""
         return abs(bucket_load - target_load) <= target_load * self.tolerance
 
-    def can_add_item(self, bucket, item):
-        """Check if adding an item to the bucket will exceed its capacity."""
-        return bucket.get_total_load() + item.load <= bucket.capacity
+    def repair(self, population):
+        """
+        Return over-capacity chromosomes to a feasible assignment and score them, split across the process pool if there is one.
+
+        :return: Tuple of (population, fitness scores).
+        """
+        if self.executor is not None and population.shape[0] > 1:
+            chunks = np.array_split(population, min(self.processes, population.shape[0]))
+            seeds = self.rng.integers(0, 2**32, size=len(chunks))
+            results = list(self.executor.map(repair_population, chunks, seeds))
+            return np.concatenate([chunk for chunk, _ in results]), np.concatenate([scores for _, scores in results])
+        return repair_population(population, self.rng, self.state.item_loads, self.state.capacities, self.initial_assignment, self.targets, self.tolerance)
 
     def initialize_population(self):
-        """Initialize a random population of item distributions based on current bucket items."""
-        items = [item for bucket in self.buckets for item in bucket.items]  # Flatten all items in all buckets
-        for _ in range(self.population_size):
-            distribution = []
-            for item in items:
-                bucket = random.choice(self.buckets)
-                while not self.can_add_item(bucket, item):
-                    bucket = random.choice(self.buckets)  # Ensure the item can fit in the chosen bucket
-                distribution.append(bucket)
-            self.population.append(distribution)
+        """Initialize a random population of item distributions, keeping unmovable items in place, and return its fitness scores."""
+        population = np.tile(self.initial_assignment, (self.population_size, 1))
+        random_genes = self.rng.integers(0, self.state.bucket_count, size=(self.population_size, self.movable_columns.size))
+        population[:, self.movable_columns] = random_genes
+        population[0] = self.initial_assignment  # Always keep the current placement as a candidate
+        self.population, fitness_scores = self.repair(population)
+        return fitness_scores
 
     def fitness(self, distribution):
         """Evaluate the fitness of a distribution (how balanced the loads are)."""
-        total_capacity = sum(bucket.capacity for bucket in self.buckets)
-        total_load = self.get_total_load()
-        targets = {bucket.id: self.target_load(bucket.capacity, total_capacity, total_load) for bucket in self.buckets}
-
-        # Calculate the total imbalance across all buckets
-        imbalance = 0
-        for bucket in self.buckets:
-            bucket_load = sum(item.load for item, assigned_bucket in zip([item for bucket in self.buckets for item in bucket.items], distribution) if assigned_bucket == bucket)
-            if not self.is_within_tolerance(bucket_load, targets[bucket.id]):
-                imbalance += abs(bucket_load - targets[bucket.id])
-
-        return 1 / (1 + imbalance)  # Lower imbalance means better fitness
-
-    def selection(self):
-        """Select two parents based on fitness (higher fitness -> higher chance of selection)."""
-        fitness_scores = [(self.fitness(chromosome), chromosome) for chromosome in self.population]
-        fitness_scores.sort(reverse=True, key=lambda x: x[0])
-        return random.choices(fitness_scores, weights=[score[0] for score in fitness_scores], k=2)
-
-    def crossover(self, parent1, parent2):
-        """Create offspring by crossover between two parents."""
-        crossover_point = random.randint(0, len(parent1) - 1)
-        child1 = parent1[:crossover_point] + parent2[crossover_point:]
-        child2 = parent2[:crossover_point] + parent1[crossover_point:]
-        return child1, child2
-
-    def mutate(self, chromosome):
-        """Randomly mutate a chromosome by changing the bucket of some items."""
-        items = [item for bucket in self.buckets for item in bucket.items]  # Flatten all items
-        for i, item in enumerate(items):
-            if random.random() < self.mutation_rate:
-                new_bucket = random.choice(self.buckets)
-                while not self.can_add_item(new_bucket, item):  # Ensure the item can fit in the new bucket
-                    new_bucket = random.choice(self.buckets)
-                chromosome[i] = new_bucket
+        return float(evaluate_population(np.asarray(distribution, dtype=np.int64)[None, :], self.state.item_loads, self.targets, self.tolerance)[0])
+
+    def eligible_fitness(self, population, fitness_scores):
+        """Return the fitness scores with chromosomes that move more items than the move limit allows masked out."""
+        if self.budget.max_moves is None:
+            return fitness_scores
+        move_counts = (population != self.initial_assignment).sum(axis=1)
+        return np.where(move_counts <= self.budget.max_moves, fitness_scores, -1.0)
+
+    def selection(self, fitness_scores, pair_count):
+        """Select parent pairs based on fitness (higher fitness -> higher chance of selection)."""
+        probabilities = fitness_scores / fitness_scores.sum()
+        return self.rng.choice(len(fitness_scores), size=(pair_count, 2), p=probabilities)
+
+    def crossover(self, parents1, parents2):
+        """Create offspring by single point crossover of every parent pair at once."""
+        points = self.rng.integers(0, parents1.shape[1], size=(parents1.shape[0], 1))
+        before_point = np.arange(parents1.shape[1]) < points
+        return np.where(before_point, parents1, parents2), np.where(before_point, parents2, parents1)
+
+    def mutate(self, population):
+        """Randomly move genes of movable items to another bucket."""
+        mutations = self.rng.random((population.shape[0], self.movable_columns.size)) < self.mutation_rate
+        columns = population[:, self.movable_columns]
+        random_genes = self.rng.integers(0, self.state.bucket_count, size=columns.shape)
+        population[:, self.movable_columns] = np.where(mutations, random_genes, columns)
+        return population
 
     def evolve(self):
-        """Evolve the population over generations to find the best distribution."""
-        self.initialize_population()
-
-        i = 0
-        for generation in range(self.generations):
-            new_population = []
-
-            i += 1
-
-            print(i)
-        
-            # Selection and Crossover
-            for _ in range(self.population_size // 2):
-                parent1, parent2 = self.selection()
-                child1, child2 = self.crossover(parent1[1], parent2[1])
-                new_population.extend([child1, child2])
+        """Evolve the population over generations and return the best distribution found."""
+        if self.processes and self.processes > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes, initializer=init_worker,
+                                                initargs=(self.state.item_loads, self.state.capacities, self.initial_assignment, self.targets, self.tolerance))
+
+        try:
+            fitness_scores = self.initialize_population()
+            # The initial assignment is always in the first population, so an eligible best exists
+            eligible_scores = self.eligible_fitness(self.population, fitness_scores)
+            best_index = int(eligible_scores.argmax())
+            best_solution, best_fitness = self.population[best_index].copy(), eligible_scores[best_index]
+            self.report_best(best_solution, best_fitness)
+
+            for generation in range(self.generations):
+                if self.budget.expired():
+                    break  # Return the best distribution found so far
+                # Selection and Crossover
+                parents = self.selection(fitness_scores, max(1, self.population_size // 2))
+                children1, children2 = self.crossover(self.population[parents[:, 0]], self.population[parents[:, 1]])
+
+                # Mutation and capacity repair
+                self.population, fitness_scores = self.repair(self.mutate(np.concatenate([children1, children2])))
+
+                # Keep the best distribution seen in any generation
+                eligible_scores = self.eligible_fitness(self.population, fitness_scores)
+                best_index = int(eligible_scores.argmax())
+                if eligible_scores[best_index] > best_fitness:
+                    best_solution, best_fitness = self.population[best_index].copy(), eligible_scores[best_index]
+                self.report_best(best_solution, best_fitness)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
 
-            # Mutation
-            for chromosome in new_population:
-                self.mutate(chromosome)
-
-            self.population = new_population
-
-        # Return the best solution
-        best_solution = max(self.population, key=lambda x: self.fitness(x))
         return best_solution
 
+    def report_best(self, best_solution, best_fitness):
+        """Report the imbalance and move count of the best distribution to the progress callback."""
+        if self.budget.progress is not None:
+            self.budget.report(1 / best_fitness - 1, self.state.items_moved(best_solution, self.initial_assignment).size)
+
     def apply_best_solution(self, best_solution):
-        """Apply the best solution back to the actual bucket item distribution."""
-        items = [item for bucket in self.buckets for item in bucket.items]
-        for item, assigned_bucket in zip(items, best_solution):
-            if item.bucket != assigned_bucket:
-                item.bucket.remove_item(item)  # Remove item from the current bucket
-                assigned_bucket.add_item(item)  # Add item to the new bucket
+        """Apply the best solution back to the actual bucket item distribution and return the moves."""
+        self.state.assignment = np.asarray(best_solution, dtype=np.int64).copy()
+        self.state.apply_to_buckets(self.buckets)
+        return self.state.get_moves(self.initial_assignment)
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """Anytime entry point: evolve until the time.monotonic() deadline, keep the best distribution within the move limit and return its moves."""
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.apply_best_solution(self.evolve())
+        finally:
+            self.budget = SolverBudget()
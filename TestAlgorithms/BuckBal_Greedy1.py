@@ -13,9 +13,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from SolverBudget import SolverBudget
+
 class BucketBalancer:
     def __init__(self, buckets):
         self.buckets = buckets
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
 
     def get_total_load(self):
         """Calculate the total load across all buckets."""
@@ -34,7 +37,11 @@ class BucketBalancer:
         targets = {bucket.id: self.target_load(bucket.capacity, total_capacity, total_load) for bucket in self.buckets}
 
         moves = []
+        migrations = 0  # Moves can carry several items, so the move limit counts items
         for _ in range(1000):  # Max iterations
+            if self.budget.should_stop(migrations):
+                break  # Every prefix of the plan is feasible, so the moves so far are returned
+
             # Cache the load for each bucket to avoid recalculating repeatedly
             bucket_loads = {bucket.id: bucket.get_total_load() for bucket in self.buckets}
 
@@ -48,7 +55,11 @@ class BucketBalancer:
                 break  # No more buckets to balance
 
             for source in overfilled:
+                if self.budget.should_stop(migrations):
+                    break
                 for destination in underfilled:
+                    if self.budget.should_stop(migrations):
+                        break
                     # Calculate how much can be moved
                     move_amount = min(bucket_loads[source.id] - targets[source.id],
                                       targets[destination.id] - bucket_loads[destination.id])
@@ -62,6 +73,12 @@ class BucketBalancer:
                             items_to_move.append(item)
                             current_move_size += item.load
 
+                    # Stay within the move limit
+                    moves_left = self.budget.moves_left(migrations)
+                    if moves_left is not None and len(items_to_move) > moves_left:
+                        items_to_move = items_to_move[:moves_left]
+                        current_move_size = sum(item.load for item in items_to_move)
+
                     # Only perform the move if we have items to move
                     if items_to_move:
                         # Simulate the move
@@ -75,6 +92,8 @@ class BucketBalancer:
                         # Update cached load values after the move
                         bucket_loads[source.id] -= current_move_size
                         bucket_loads[destination.id] += current_move_size
+                        migrations += len(items_to_move)
+                        self.budget.report(sum(abs(bucket_loads[b.id] - targets[b.id]) for b in self.buckets), migrations)
 
                     # Recalculate overfilled and underfilled buckets
                     overfilled = sorted([bucket for bucket in self.buckets if bucket_loads[bucket.id] > targets[bucket.id]],
@@ -86,3 +105,11 @@ class BucketBalancer:
                         break  # No more buckets to balance
 
         return moves
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """Anytime entry point: balance within a time.monotonic() deadline and a limit on migrated items, reporting progress(score, move_count)."""
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
@@ -13,11 +13,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from SolverBudget import SolverBudget
+
 class BucketBalancer:
     def __init__(self, buckets):
         self.buckets = buckets
         self.tolerance = 0.025  # +/- 5% tolerance
         self.move_history = {}  # Track recent moves to avoid oscillation
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
 
     def get_total_load(self):
         """Calculate the total load across all buckets."""
@@ -78,6 +81,8 @@ class BucketBalancer:
 
             if not overfilled or not underfilled:
                 break  # No more buckets to balance
+            if self.budget.should_stop(len(moves)):
+                break  # Every prefix of the plan is feasible, so the moves so far are returned
 
             # Sort overfilled by most overfilled and underfilled by most underfilled
             overfilled.sort(key=lambda b: bucket_loads[b.id] - targets[b.id], reverse=True)
@@ -102,5 +107,14 @@ class BucketBalancer:
                 # Update cached load values after the move
                 bucket_loads[source.id] -= smallest_item.load
                 bucket_loads[destination.id] += smallest_item.load
+                self.budget.report(sum(abs(bucket_loads[b.id] - targets[b.id]) for b in self.buckets), len(moves))
+
+        return moves
 
-        return moves
\ No newline at end of file
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """Anytime entry point: balance within a time.monotonic() deadline and a limit on migrated items, reporting progress(score, move_count)."""
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
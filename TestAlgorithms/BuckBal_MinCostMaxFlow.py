@@ -13,12 +13,24 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import bisect
 import networkx as nx
+from SolverBudget import SolverBudget
 
 class BucketBalancer:
-    def __init__(self, buckets):
+    def __init__(self, buckets, resolution=0.01):
+        """
+        Initialize the min-cost flow balancer.
+
+        :param buckets: List of buckets to balance.
+        :param resolution: Load represented by one unit of flow; flows are solved in integer units.
+        """
         self.buckets = buckets
         self.tolerance = 0.05  # +/- 5% tolerance
+        self.resolution = resolution
+        self.network = None  # Flow network kept between runs
+        self.bucket_roles = {}  # Bucket id -> ('donor' | 'receiver' | None, source/sink edge capacity) in self.network
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
 
     def get_total_load(self):
         """Calculate the total load across all buckets."""
@@ -27,83 +39,139 @@ class BucketBalancer:
     def get_average_load(self):
         """Calculate the average load per bucket."""
         total_load = self.get_total_load()
-        total_capacity = sum(bucket.capacity for bucket in self.buckets)
         return total_load / len(self.buckets)  # Average load per bucket
 
-    def build_flow_network(self):
-        """Build a flow network where nodes are buckets, and edges represent moves."""
-        G = nx.DiGraph()
-
-        average_load = self.get_average_load()
-
-        source = "source"
-        sink = "sink"
-        G.add_node(source)
-        G.add_node(sink)
+    def get_bucket_role(self, bucket, average_load):
+        """Classify a bucket as a donor or receiver of load and return the flow it can send or take."""
+        current_load = bucket.get_total_load()
+        lower_bound = average_load * (1 - self.tolerance)
+        upper_bound = average_load * (1 + self.tolerance)
 
-        # Add nodes for each bucket and their connections
-        for bucket in self.buckets:
-            current_load = bucket.get_total_load()
-            lower_bound = average_load * (1 - self.tolerance)
-            upper_bound = average_load * (1 + self.tolerance)
+        # A donor can send its surplus above the upper bound, but never more than it can actually move
+        if current_load > upper_bound:
+            surplus = min(current_load - upper_bound, bucket.get_movable_load())
+            return ('donor', int(surplus / self.resolution))
 
-            # If a bucket is underfilled, connect it to the source
-            if current_load < lower_bound:
-                G.add_edge(source, bucket.id, capacity=lower_bound - current_load, weight=0)
+        # A receiver can take its deficit below the lower bound, but never more than its free capacity
+        if current_load < lower_bound:
+            deficit = min(lower_bound - current_load, bucket.capacity - current_load)
+            return ('receiver', int(deficit / self.resolution))
 
-            # If a bucket is overfilled, connect it to the sink
-            if current_load > upper_bound:
-                G.add_edge(bucket.id, sink, capacity=current_load - upper_bound, weight=0)
+        return (None, 0)
 
-            # Add edges between buckets to allow redistribution of items
-            for other_bucket in self.buckets:
-                if bucket != other_bucket:
-                    G.add_edge(bucket.id, other_bucket.id, capacity=float('inf'), weight=1)  # Cost is 1 per move
-
-        return G, source, sink
+    def build_flow_network(self):
+        """
+        Build or update a sparse flow network where only donor buckets connect to receiver buckets.
+
+        The network is kept between runs; only buckets whose role or flow limit changed have their edges updated.
+        """
+        if self.network is None:
+            self.network = nx.DiGraph()
+            self.network.add_node("source")
+            self.network.add_node("sink")
+            self.bucket_roles = {}
+
+        G = self.network
+        average_load = self.get_average_load()
+        roles = {bucket.id: self.get_bucket_role(bucket, average_load) for bucket in self.buckets}
+
+        for bucket_id, (role, limit) in roles.items():
+            old_role, old_limit = self.bucket_roles.get(bucket_id, (None, 0))
+            if role == old_role and limit == old_limit:
+                continue
+
+            if role != old_role:
+                # Drop the edges of the old role and connect the bucket to the opposite side of its new role
+                if G.has_node(bucket_id):
+                    G.remove_node(bucket_id)
+                if role == 'donor':
+                    G.add_edges_from(((bucket_id, other_id) for other_id, (other_role, _) in roles.items() if other_role == 'receiver'), weight=1)
+                elif role == 'receiver':
+                    G.add_edges_from(((other_id, bucket_id) for other_id, (other_role, _) in roles.items() if other_role == 'donor'), weight=1)
+
+            # Donor -> receiver edges are uncapacitated; each bucket's limit sits on its source or sink edge
+            if role == 'donor':
+                G.add_edge("source", bucket_id, capacity=limit, weight=0)
+            elif role == 'receiver':
+                G.add_edge(bucket_id, "sink", capacity=limit, weight=0)
+
+        self.bucket_roles = roles
+        return G, "source", "sink"
 
     def balance_buckets(self):
-        """Solve the Min-Cost Max-Flow problem and move items between buckets accordingly."""
-        G, source, sink = self.build_flow_network()
+        """Solve the Min-Cost Max-Flow problem and turn the flow into concrete item moves."""
+        if self.budget.expired():
+            return []  # The flow is solved in one step, so there is no partial plan to return
 
-        try:
-            flow_dict = nx.max_flow_min_cost(G, source, sink)
-            cost = nx.cost_of_flow(G, flow_dict)
-
-            print(f"Total cost (number of moves): {cost}")
-            print("Flow distribution:")
+        G, source, sink = self.build_flow_network()
 
-            for u, flow in flow_dict.items():
-                for v, f in flow.items():
-                    if f > 0 and u != "source" and v != "sink":
-                        print(f"Move {f} units from Bucket {u} to Bucket {v}")
-                        self.move_items_between_buckets(u, v, f)
+        # Every donor reaches every receiver, so the maximum flow is simply the smaller side's total
+        flow_value = min(sum(capacity for _, _, capacity in G.out_edges(source, data='capacity')),
+                         sum(capacity for _, _, capacity in G.in_edges(sink, data='capacity')))
+        if flow_value == 0:
+            return []
+        G.nodes[source]['demand'] = -flow_value
+        G.nodes[sink]['demand'] = flow_value
 
-            return flow_dict
+        try:
+            cost, flow_dict = nx.network_simplex(G)
         except nx.NetworkXUnfeasible:
             print("No valid flow can satisfy all demands. Please check the capacities and loads.")
-            return None
-
-    def move_items_between_buckets(self, source_id, destination_id, amount_to_move):
-        """Move items between two buckets based on the flow amount."""
+            return []
+
+        # Turning the flow into items is incremental, so stop at the deadline or move limit with the moves made so far
+        moves = []
+        for u, flow in flow_dict.items():
+            if u in (source, sink):
+                continue
+            for v, units in sorted(flow.items(), key=lambda entry: entry[1], reverse=True):
+                if self.budget.should_stop(len(moves)):
+                    break
+                if units > 0 and v != sink:
+                    moves.extend(self.move_items_between_buckets(u, v, units * self.resolution, self.budget.moves_left(len(moves))))
+            if self.budget.progress is not None:
+                average_load = self.get_average_load()
+                self.budget.report(sum(abs(bucket.get_total_load() - average_load) for bucket in self.buckets), len(moves))
+
+        print(f"Total flow cost: {cost} units, {len(moves)} item moves")
+        return moves
+
+    def move_items_between_buckets(self, source_id, destination_id, amount_to_move, max_moves=None):
+        """
+        Move concrete movable items between two buckets to cover a flow amount.
+
+        The largest item that still fits in the remaining amount and in the destination's free capacity is moved each step,
+        up to max_moves items if given.
+
+        :return: List of moves in the balancer format.
+        """
         source_bucket = next(b for b in self.buckets if b.id == source_id)
         destination_bucket = next(b for b in self.buckets if b.id == destination_id)
 
-        moved_amount = 0
-        items_to_move = []
-
-        # Select items from source to move to destination
-        for item in source_bucket.items:
-            if moved_amount + item.load <= amount_to_move:
-                items_to_move.append(item)
-                moved_amount += item.load
+        candidates = sorted((item for item in source_bucket.items if item.movable), key=lambda item: item.load)
+        candidate_loads = [item.load for item in candidates]
 
-            if moved_amount >= amount_to_move:
+        moves = []
+        remaining = amount_to_move
+        while candidates and (max_moves is None or len(moves) < max_moves):
+            limit = min(remaining, destination_bucket.capacity - destination_bucket.get_total_load())
+            position = bisect.bisect_right(candidate_loads, limit) - 1
+            if position < 0:
                 break
 
-        # Perform the move: remove items from source and add to destination
-        for item in items_to_move:
+            item = candidates.pop(position)
+            del candidate_loads[position]
             source_bucket.remove_item(item)
             destination_bucket.add_item(item)
+            moves.append({'from': source_bucket.id, 'to': destination_bucket.id, 'items': [item]})
+            remaining -= item.load
 
-        print(f"Moved {moved_amount} units from Bucket {source_bucket.id} to Bucket {destination_bucket.id}")
+        return moves
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """Anytime entry point: solve the flow unless the time.monotonic() deadline has passed and convert it into at most max_moves item moves."""
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
@@ -0,0 +1,186 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import os
+import random
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from Bucket import Bucket
+from ClusterState import ClusterState
+from Item import Item
+from SolverBudget import SolverBudget
+from TestAlgorithms.BuckBal_SimulatedAnnealing import BucketBalancer as AnnealingBalancer
+
+def run_chain(capacities, item_loads, item_movable, assignment, home, schedule, temperature, move_penalty, tolerance, deadline, seed, max_moves=None):
+    """
+    Run one annealing chain until its deadline in a worker process.
+
+    Items are rebuilt with their index as id so the assignment can be read back from the buckets.
+    With max_moves, the chain takes at most as many moves as keep the number of displaced items within it.
+
+    :return: Tuple of (assignment, temperature, proposals).
+    """
+    buckets = [Bucket(index, capacity) for index, capacity in enumerate(capacities)]
+    bucket_items = [[] for _ in buckets]
+    for index, (load, movable, bucket_index) in enumerate(zip(item_loads, item_movable, assignment)):
+        bucket_items[bucket_index].append(Item(index, buckets[bucket_index], load, movable=movable))
+    for bucket, items in zip(buckets, bucket_items):
+        bucket.items = items  # The state is feasible, so skip add_item's per-item capacity check
+
+    initial_temp, cooling_rate, min_temp = schedule
+    annealer = AnnealingBalancer(buckets, tolerance=tolerance, initial_temp=temperature, cooling_rate=cooling_rate, min_temp=min_temp,
+                                 move_penalty=move_penalty, deadline=deadline, seed=seed, home=dict(enumerate(home)), epoch_length=1)
+    if max_moves is None:
+        annealer.balance_buckets()
+    else:
+        displaced = sum(1 for bucket_index, home_index in zip(assignment, home) if bucket_index != home_index)
+        annealer.balance(max_moves=max(0, max_moves - displaced))
+
+    result = list(assignment)
+    for bucket in buckets:
+        for item in bucket.items:
+            result[item.id] = bucket.id
+    return result, annealer.temperature, annealer.proposals
+
+class BucketBalancer:
+    def __init__(self, buckets, chains=None, time_budget=10.0, exchange_interval=1.0, schedules=None, move_penalty=None, tolerance=0.05, seed=None, patience=3, min_improvement=0.01):
+        """
+        Initialize a multi-start annealing driver that runs independent chains in a process pool.
+
+        Chains run for exchange_interval seconds at a time. Between rounds, chains at adjacent temperatures swap
+        states with the replica exchange acceptance rule and the worst chain restarts from the best state found so far.
+        The run stops early once the best score has not improved by min_improvement for patience exchange intervals.
+
+        :param buckets: List of buckets to balance.
+        :param chains: Number of chains, defaults to the number of CPU cores.
+        :param time_budget: Wall-clock seconds for the whole run.
+        :param exchange_interval: Seconds between state exchanges.
+        :param schedules: List of (initial_temp, cooling_rate, min_temp) per chain, cooling after every proposal, defaults to a spread of temperatures.
+        :param move_penalty: Score added for every item that ends up away from its original bucket, defaults to twice the mean item load.
+        :param tolerance: Load tolerance passed to the chains.
+        :param seed: Seed for the chain seeds and the exchanges.
+        :param patience: Number of exchange intervals without improvement of the best score before stopping, or None to use the whole budget.
+        :param min_improvement: Fraction by which the best score must drop to count as an improvement.
+        """
+        self.buckets = buckets
+        self.chains = chains or os.cpu_count() or 1
+        self.time_budget = time_budget
+        self.exchange_interval = exchange_interval
+        self.tolerance = tolerance
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self.random = random.Random(seed)
+        self.state = ClusterState.from_buckets(buckets)
+        self.targets = self.state.get_targets()
+        self.move_penalty = self.default_move_penalty() if move_penalty is None else move_penalty
+        self.schedules = schedules or self.default_schedules()
+        self.proposals = 0
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
+
+    def default_move_penalty(self):
+        """Penalise a move by twice the mean item load, the most an average item can take off the imbalance of its two buckets."""
+        return 2 * float(self.state.item_loads.mean()) if self.state.item_count else 0.0
+
+    def default_schedules(self):
+        """Spread the chains from hot to cold, scaled to the mean item load, with slow cooling."""
+        scale = float(self.state.item_loads.mean()) if self.state.item_count else 1.0
+        return [(scale * 0.5 ** chain, 0.99999, scale * 1e-4) for chain in range(self.chains)]
+
+    def get_score(self, assignment):
+        """Combined score of an assignment: load imbalance plus the move penalty for every displaced item."""
+        imbalance = np.abs(self.state.get_bucket_loads(assignment) - self.targets).sum()
+        moved = np.count_nonzero(assignment != self.state.assignment)
+        return float(imbalance + self.move_penalty * moved)
+
+    def exchange(self, assignments, scores, temperatures):
+        """Swap states between adjacent temperatures, then restart the worst chain from the best state."""
+        order = sorted(range(len(temperatures)), key=lambda chain: temperatures[chain], reverse=True)
+        for hotter, colder in zip(order, order[1:]):
+            if temperatures[hotter] <= 0 or temperatures[colder] <= 0:
+                continue
+            exponent = (scores[hotter] - scores[colder]) * (1 / temperatures[hotter] - 1 / temperatures[colder])
+            if exponent >= 0 or self.random.random() < math.exp(exponent):
+                assignments[hotter], assignments[colder] = assignments[colder], assignments[hotter]
+                scores[hotter], scores[colder] = scores[colder], scores[hotter]
+
+        best = min(range(len(scores)), key=lambda chain: scores[chain])
+        worst = max(range(len(scores)), key=lambda chain: scores[chain])
+        assignments[worst] = assignments[best].copy()
+        scores[worst] = scores[best]
+
+    def balance_buckets(self):
+        """Run the chains within the time budget and apply the plan with the best combined score."""
+        deadline = time.monotonic() + self.time_budget
+        if self.budget.deadline is not None:
+            deadline = min(deadline, self.budget.deadline)
+        initial_assignment = self.state.assignment.copy()
+        capacities = self.state.capacities.tolist()
+        item_loads = self.state.item_loads.tolist()
+        item_movable = self.state.item_movable.tolist()
+        home = initial_assignment.tolist()
+
+        assignments = [initial_assignment.copy() for _ in range(self.chains)]
+        scores = [self.get_score(initial_assignment)] * self.chains
+        temperatures = [schedule[0] for schedule in self.schedules]
+        best_assignment, best_score = initial_assignment.copy(), scores[0]
+        stale_rounds, reference_score = 0, best_score
+
+        with ProcessPoolExecutor(max_workers=self.chains) as executor:
+            while time.monotonic() < deadline:
+                round_deadline = min(deadline, time.monotonic() + self.exchange_interval)
+                futures = [
+                    executor.submit(run_chain, capacities, item_loads, item_movable, assignments[chain].tolist(), home, self.schedules[chain],
+                                    temperatures[chain], self.move_penalty, self.tolerance, round_deadline, self.random.getrandbits(32), self.budget.max_moves)
+                    for chain in range(self.chains)
+                ]
+
+                for chain, future in enumerate(futures):
+                    assignment, temperatures[chain], proposals = future.result()
+                    assignments[chain] = np.asarray(assignment, dtype=np.int64)
+                    scores[chain] = self.get_score(assignments[chain])
+                    self.proposals += proposals
+                    # Only plans within the move limit can become the result; the initial placement always is
+                    if self.budget.exceeds_moves(np.count_nonzero(assignments[chain] != initial_assignment)):
+                        continue
+                    if scores[chain] < best_score:
+                        best_assignment, best_score = assignments[chain].copy(), scores[chain]
+
+                # Chains that have cooled down completely restart hot from the shared state
+                for chain, schedule in enumerate(self.schedules):
+                    if temperatures[chain] <= schedule[2]:
+                        temperatures[chain] = schedule[0]
+
+                self.exchange(assignments, scores, temperatures)
+                self.budget.report(best_score, int(np.count_nonzero(best_assignment != initial_assignment)))
+                if best_score < reference_score * (1 - self.min_improvement):
+                    stale_rounds, reference_score = 0, best_score
+                else:
+                    stale_rounds += 1
+                if self.patience is not None and stale_rounds >= self.patience:
+                    break  # The chains have stopped finding better plans, including when they have used up the move limit
+
+        self.state.assignment = best_assignment
+        self.state.apply_to_buckets(self.buckets)
+        return self.state.get_moves(initial_assignment)
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """Anytime entry point: run the chains until the time budget or time.monotonic() deadline, whichever comes first, and apply the best plan within the move limit."""
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
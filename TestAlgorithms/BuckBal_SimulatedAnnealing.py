@@ -15,14 +15,39 @@
 
 import random
 import math
+import time
+from SolverBudget import SolverBudget
 
 class BucketBalancer:
-    def __init__(self, buckets, tolerance=0.05, initial_temp=1000, cooling_rate=0.99, min_temp=1):
+    def __init__(self, buckets, tolerance=0.05, initial_temp=1000, cooling_rate=0.99, min_temp=1, move_penalty=0.0, deadline=None, max_proposals=None, seed=None, home=None, epoch_length=None):
+        """
+        Initialize the simulated annealing balancer.
+
+        :param buckets: List of buckets to balance.
+        :param tolerance: Load tolerance around each bucket's target.
+        :param initial_temp: Starting temperature.
+        :param cooling_rate: Factor applied to the temperature after every epoch of proposals.
+        :param min_temp: Temperature at which the annealing stops.
+        :param move_penalty: Score added for every item that ends up away from its original bucket.
+        :param deadline: time.monotonic() timestamp after which the annealing stops, or None.
+        :param max_proposals: Maximum number of proposals to evaluate, or None.
+        :param seed: Seed for the random number generator.
+        :param home: Item id -> original bucket id used by move_penalty, defaults to the placement when balancing starts.
+        :param epoch_length: Proposals per epoch, by default spread so the schedule spans max_proposals, or else the number of movable items.
+        """
         self.buckets = buckets
         self.tolerance = tolerance  # +/- 5% tolerance
         self.temperature = initial_temp
         self.cooling_rate = cooling_rate
         self.min_temp = min_temp
+        self.move_penalty = move_penalty
+        self.deadline = deadline
+        self.max_proposals = max_proposals
+        self.random = random.Random(seed)
+        self.home = home
+        self.epoch_length = epoch_length
+        self.proposals = 0
+        self.budget = SolverBudget(deadline)  # balance() can replace it with a move limit and progress callback
 
     def get_total_load(self):
         """Calculate the total load across all buckets."""
@@ -43,61 +68,130 @@ class BucketBalancer:
             score += abs(bucket_loads[bucket_id] - targets[bucket_id])
         return score
 
+    def get_move_delta(self, load, source_load, source_target, destination_load, destination_target):
+        """Change in balance score from moving a load between two buckets; only the two touched terms change."""
+        return (abs(source_load - load - source_target) - abs(source_load - source_target)
+                + abs(destination_load + load - destination_target) - abs(destination_load - destination_target))
+
     def cool_down(self):
         """Reduce the temperature according to the cooling rate."""
         self.temperature *= self.cooling_rate
 
+    def get_epoch_length(self):
+        """Return the number of proposals between two cool-downs, so larger clusters get proportionally more proposals per temperature."""
+        if self.epoch_length is not None:
+            return max(1, self.epoch_length)
+        if self.max_proposals is not None and 0 < self.min_temp < self.temperature and 0 < self.cooling_rate < 1:
+            steps = math.ceil(math.log(self.min_temp / self.temperature) / math.log(self.cooling_rate))
+            return max(1, self.max_proposals // steps)
+        return max(1, sum(1 for bucket in self.buckets for item in bucket.items if item.movable))
+
     def accept_move(self, current_score, new_score):
         """Determine whether to accept a worse solution."""
-        if new_score < current_score:
+        return self.accept_delta(new_score - current_score)
+
+    def accept_delta(self, delta):
+        """Determine whether to accept a change in score, accepting worse changes with a temperature based probability."""
+        if delta < 0:
             return True
-        else:
-            # Accept worse solution with a probability based on temperature
-            return random.random() < math.exp((current_score - new_score) / self.temperature)
+        return self.random.random() < math.exp(-delta / self.temperature)
+
+    def out_of_time(self):
+        """Check the proposal budget and, every 1024 proposals, the deadline."""
+        if self.max_proposals is not None and self.proposals >= self.max_proposals:
+            return True
+        return self.budget.deadline is not None and self.proposals % 1024 == 0 and time.monotonic() >= self.budget.deadline
 
     def balance_buckets(self):
         """Balance the load between buckets using simulated annealing."""
         total_capacity = sum(bucket.capacity for bucket in self.buckets)
         total_load = self.get_total_load()  # Get the total system load
 
-        # Calculate the target load for each bucket
-        targets = {bucket.id: self.target_load(bucket.capacity, total_capacity, total_load) for bucket in self.buckets}
-
-        # Initial state
-        bucket_loads = {bucket.id: bucket.get_total_load() for bucket in self.buckets}
-        current_score = self.get_balance_score(bucket_loads, targets)
+        # Cache the targets, loads and original placement by bucket index
+        targets = [self.target_load(bucket.capacity, total_capacity, total_load) for bucket in self.buckets]
+        bucket_loads = [bucket.get_total_load() for bucket in self.buckets]
+        start = {item.id: index for index, bucket in enumerate(self.buckets) for item in bucket.items}
+        if self.home is None:
+            home = start
+        else:
+            bucket_indexes = {bucket.id: index for index, bucket in enumerate(self.buckets)}
+            home = {item_id: bucket_indexes[bucket_id] for item_id, bucket_id in self.home.items()}
+        if not any(item.movable for bucket in self.buckets for item in bucket.items):
+            return []
+
+        current_score = sum(abs(load - target) for load, target in zip(bucket_loads, targets))
+        best_score = current_score
+        displaced = 0
+        best_displaced = 0
+
+        # Only the moves made since the best state are kept, so they can be undone at the end
+        trail = []
+        bucket_count = len(self.buckets)
+        epoch_length = self.get_epoch_length()
+        while self.temperature > self.min_temp and not self.out_of_time():
+            self.proposals += 1
+            if self.proposals % 1024 == 0:
+                self.budget.report(best_score, best_displaced)
+            # Count every proposal, including infeasible ones, towards the epoch, so the loop ends even when no move is possible
+            if self.proposals % epoch_length == 0:
+                self.cool_down()
 
-        moves = []
-        while self.temperature > self.min_temp:
             # Generate a neighboring solution by randomly moving an item
-            source = random.choice([b for b in self.buckets if b.items])  # Pick a random non-empty bucket
-            destination = random.choice(self.buckets)  # Pick any bucket (could be the same)
-            if source == destination:
+            source_index = self.random.randrange(bucket_count)
+            destination_index = self.random.randrange(bucket_count)  # Pick any bucket (could be the same)
+            source = self.buckets[source_index]
+            if source_index == destination_index or not source.items:
                 continue
 
-            # Move a random item
-            random_item = random.choice(source.items)
+            random_item = self.random.choice(source.items)
+            destination = self.buckets[destination_index]
 
-            # Check if destination bucket has enough capacity for the item
-            if destination.get_total_load() + random_item.load <= destination.capacity:
-                source.remove_item(random_item)
-                destination.add_item(random_item)
+            # Check the item may move and that destination bucket has enough capacity for it
+            if not random_item.movable or bucket_loads[destination_index] + random_item.load > destination.capacity:
+                continue
 
-                # Calculate the new bucket loads and the new balance score
-                new_bucket_loads = {bucket.id: bucket.get_total_load() for bucket in self.buckets}
-                new_score = self.get_balance_score(new_bucket_loads, targets)
-
-                # Decide whether to accept the move
-                if self.accept_move(current_score, new_score):
-                    moves.append({'from': source.id, 'to': destination.id, 'items': [random_item]})
-                    bucket_loads = new_bucket_loads
-                    current_score = new_score
-                else:
-                    # Revert the move
-                    destination.remove_item(random_item)
-                    source.add_item(random_item)
-
-                # Cool down the temperature
-                self.cool_down()
+            # Keep the number of displaced items within the move limit
+            item_start = start[random_item.id]
+            displaced_change = (destination_index != item_start) - (source_index != item_start)
+            if displaced_change > 0 and self.budget.moves_exhausted(displaced):
+                continue
+
+            # Score the proposal from the two bucket terms that change, without touching the buckets
+            delta = self.get_move_delta(random_item.load, bucket_loads[source_index], targets[source_index], bucket_loads[destination_index], targets[destination_index])
+            if self.move_penalty:
+                item_home = home[random_item.id]
+                delta += self.move_penalty * ((destination_index != item_home) - (source_index != item_home))
 
-        return moves
+            # Only mutate the state once the move is accepted
+            if self.accept_delta(delta):
+                source.remove_item(random_item)
+                destination.add_item(random_item)
+                bucket_loads[source_index] -= random_item.load
+                bucket_loads[destination_index] += random_item.load
+                current_score += delta
+                displaced += displaced_change
+                trail.append((random_item, source_index, destination_index))
+
+                if current_score < best_score:
+                    best_score = current_score
+                    best_displaced = displaced
+                    trail.clear()
+
+        # Undo the moves made after the best state was reached
+        for item, source_index, destination_index in reversed(trail):
+            self.buckets[destination_index].remove_item(item)
+            self.buckets[source_index].add_item(item)
+
+        self.budget.report(best_score, best_displaced)
+
+        # Return one move per displaced item, from its starting bucket to its final one
+        return [{'from': self.buckets[start[item.id]].id, 'to': bucket.id, 'items': [item]}
+                for index, bucket in enumerate(self.buckets) for item in bucket.items if start[item.id] != index]
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """Anytime entry point: anneal until the time.monotonic() deadline or move limit and return the moves up to the best state."""
+        self.budget = SolverBudget(self.deadline if deadline is None else deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget(self.deadline)
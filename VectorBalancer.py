@@ -0,0 +1,188 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+from ClusterState import ClusterState
+from SolverBudget import SolverBudget
+
+class VectorBalancer:
+    def __init__(self, buckets, dimensions=('memory', 'cpu'), weights=None, max_iterations=10000, source_candidates=4, history=None):
+        """
+        Initialize the multi-dimensional balancer.
+
+        :param buckets: List of buckets to balance; items carry their non-memory usage in Item.resources and buckets their capacities in Bucket.resource_capacities.
+        :param dimensions: Resource names to balance, where 'memory' is the item load and bucket capacity.
+        :param weights: Optional weight per dimension, e.g. {'memory': 1.0, 'cpu': 0.5}; unlisted dimensions weigh 1.
+        :param max_iterations: Maximum number of single-item moves to evaluate and apply.
+        :param source_candidates: Number of most deviating buckets whose items are considered in every iteration.
+        :param history: Optional MoveHistoryStore whose cool-downs and migration limits from earlier runs the moves have to respect.
+        """
+        self.buckets = buckets
+        self.dimensions = list(dimensions)
+        self.state = ClusterState.from_buckets(buckets, self.dimensions)
+        weights = weights or {}
+        self.weights = np.array([weights.get(name, 1.0) for name in self.dimensions], dtype=np.float64)
+        self.max_iterations = max_iterations
+        self.source_candidates = source_candidates
+        self.history = history
+        self.allowed_destinations = {}  # Item index -> allowed destination mask, for items with a move history
+        self.budget = SolverBudget()  # No deadline or move limit unless balance() sets one
+
+        # A dimension only counts towards the imbalance if every bucket reports a capacity for it
+        capacities = self.state.resource_capacities
+        balanced = np.all(np.isfinite(capacities) & (capacities > 0), axis=0)
+        self.weights = np.where(balanced, self.weights, 0.0)
+        self.inverse_capacities = np.where(np.isfinite(capacities) & (capacities > 0), 1.0 / np.where(capacities > 0, capacities, 1.0), 0.0)
+        totals = self.state.item_resources.sum(axis=0)
+        total_capacities = np.where(balanced, capacities, 0.0).sum(axis=0)
+        self.target_utilization = np.divide(totals, total_capacities, out=np.zeros_like(totals), where=total_capacities > 0)
+
+    def get_utilization(self, resource_loads=None):
+        """Return the (buckets x dimensions) utilization of every resource."""
+        resource_loads = self.state.get_resource_loads() if resource_loads is None else resource_loads
+        return resource_loads * self.inverse_capacities
+
+    def get_bucket_imbalance(self, resource_loads=None):
+        """Return the weighted squared deviation of every bucket's utilization from the cluster-wide utilization."""
+        deviation = self.get_utilization(resource_loads) - self.target_utilization
+        return (deviation * deviation) @ self.weights
+
+    def get_imbalance(self, resource_loads=None):
+        """Return the total weighted multi-dimensional imbalance of the cluster."""
+        return float(self.get_bucket_imbalance(resource_loads).sum())
+
+    def get_allowed_destinations(self, initial_assignment):
+        """
+        Return the destinations every item with a move history may end up on, given where it started.
+
+        An item may always return to its initial bucket, since the plan then does not migrate it at all.
+
+        :param initial_assignment: Bucket index of every item before balancing.
+        :return: Dict of item index to a boolean mask over the buckets.
+        """
+        allowed_destinations = {}
+        if self.history is None:
+            return allowed_destinations
+        state = self.state
+        for item_index, item in enumerate(state.items):
+            if not state.item_movable[item_index] or self.history.get_entry(item.id) is None:
+                continue
+            source = initial_assignment[item_index]
+            source_hostname = state.hostnames[source]
+            allowed_destinations[item_index] = np.array([
+                bucket_index == source or self.history.may_move(item.id, source_hostname, hostname)
+                for bucket_index, hostname in enumerate(state.hostnames)
+            ])
+        return allowed_destinations
+
+    def find_best_move(self, resource_loads):
+        """
+        Evaluate every movable item of the most deviating buckets against every other bucket at once.
+
+        :param resource_loads: Current (buckets x dimensions) resource usage.
+        :return: (delta, item_index, bucket_index) of the move that lowers the imbalance the most, or None if no feasible move lowers it.
+        """
+        state = self.state
+        deviation = self.get_utilization(resource_loads) - self.target_utilization
+        bucket_imbalance = (deviation * deviation) @ self.weights
+        free = state.resource_capacities - resource_loads
+
+        best = None
+        for source in np.argsort(-bucket_imbalance)[:self.source_candidates]:
+            item_indexes = np.flatnonzero((state.assignment == source) & state.item_movable)
+            if len(item_indexes) == 0:
+                continue
+            resources = state.item_resources[item_indexes]  # (k x D)
+
+            # Imbalance change of the source bucket for each item, (k,)
+            source_after = deviation[source] - resources * self.inverse_capacities[source]
+            source_delta = (source_after * source_after) @ self.weights - bucket_imbalance[source]
+
+            # Imbalance change of every destination bucket for each item, (k x B)
+            destination_after = deviation[None, :, :] + resources[:, None, :] * self.inverse_capacities[None, :, :]
+            destination_delta = (destination_after * destination_after) @ self.weights - bucket_imbalance[None, :]
+
+            # Every dimension has to fit on the destination
+            fits = np.all(resources[:, None, :] <= free[None, :, :], axis=2)
+            fits[:, source] = False
+            if self.allowed_destinations:
+                for row, item_index in enumerate(item_indexes.tolist()):
+                    if item_index in self.allowed_destinations:
+                        fits[row] &= self.allowed_destinations[item_index]
+
+            delta = np.where(fits, source_delta[:, None] + destination_delta, np.inf)
+            position = np.unravel_index(np.argmin(delta), delta.shape)
+            if best is None or delta[position] < best[0]:
+                best = (float(delta[position]), int(item_indexes[position[0]]), int(position[1]))
+
+        if best is None or best[0] >= -1e-12:
+            return None
+        return best
+
+    def balance_buckets(self):
+        """
+        Balance the buckets across all dimensions by repeatedly applying the single move that lowers the weighted imbalance the most.
+
+        :return: List of moves in the balancer format ({'from', 'to', 'items'}).
+        """
+        state = self.state
+        initial_assignment = state.assignment.copy()
+        resource_loads = state.get_resource_loads()
+        self.allowed_destinations = self.get_allowed_destinations(initial_assignment)
+
+        # Keep the number of displaced items and the imbalance up to date per move instead of rescanning every item
+        moved = 0
+        imbalance = self.get_imbalance(resource_loads)
+        for _ in range(self.max_iterations):
+            if self.budget.should_stop(moved):
+                break
+
+            move = self.find_best_move(resource_loads)
+            if move is None:
+                break
+
+            delta, item_index, destination = move
+            source = state.assignment[item_index]
+            initial = initial_assignment[item_index]
+            # Moving an item back to its original bucket can shorten the plan instead of growing it
+            moved_change = int(destination != initial) - int(source != initial)
+            if self.budget.exceeds_moves(moved + moved_change):
+                break
+
+            resource_loads[source] -= state.item_resources[item_index]
+            resource_loads[destination] += state.item_resources[item_index]
+            state.move_item(item_index, destination)
+            moved += moved_change
+            imbalance += delta
+            self.budget.report(imbalance, moved)
+
+        moves = state.get_moves(initial_assignment)
+        state.apply_to_buckets(self.buckets)
+        return moves
+
+    def balance(self, deadline=None, max_moves=None, progress=None):
+        """
+        Anytime entry point: balance the buckets within a deadline and move limit.
+
+        :param deadline: time.monotonic() timestamp by which the plan must be returned, or None.
+        :param max_moves: Maximum number of moves in the returned plan, or None.
+        :param progress: Optional callable invoked as progress(score, move_count), where score is the weighted multi-dimensional imbalance.
+        :return: The moves found before the deadline or move limit was reached.
+        """
+        self.budget = SolverBudget(deadline, max_moves, progress)
+        try:
+            return self.balance_buckets()
+        finally:
+            self.budget = SolverBudget()
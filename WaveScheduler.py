@@ -0,0 +1,125 @@
+# Copyright (C) 2025 Coela Can't
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+class WaveScheduler:
+    def __init__(self, buckets, moves, bandwidth=1.25, link_bandwidth=None, max_per_wave=None, applied=True, cost_model=None):
+        """
+        Initialize a scheduler that orders migrations into waves that can run in parallel.
+
+        While a VM live-migrates its memory is held on both nodes, so a wave only starts migrations whose targets
+        can hold the incoming memory on top of what they hold at the start of the wave.
+
+        :param buckets: Buckets the moves were planned on.
+        :param moves: Optimized moves ({'item_id', 'from', 'to'}) from MoveOptimizer.
+        :param bandwidth: Default migration bandwidth between two nodes, in load units (GB) per second.
+        :param link_bandwidth: Optional (from bucket id, to bucket id) -> bandwidth overriding the default per link.
+        :param max_per_wave: Maximum number of migrations per wave, or None.
+        :param applied: Whether the buckets already hold the moves' final placement, as they do after balancing.
+        :param cost_model: Optional MigrationCostModel estimating each migration's duration instead of memory over bandwidth.
+        """
+        self.buckets = buckets
+        self.moves = moves
+        self.bandwidth = bandwidth
+        self.link_bandwidth = link_bandwidth or {}
+        self.max_per_wave = max_per_wave
+        self.cost_model = cost_model
+        self.items = {item.id: item for bucket in buckets for item in bucket.items}
+        self.item_loads = {item_id: item.load for item_id, item in self.items.items()}
+        self.capacities = {bucket.id: bucket.capacity for bucket in buckets}
+        self.initial_loads = {bucket.id: bucket.get_total_load() for bucket in buckets}
+        if applied:
+            # Undo the moves to get the loads the migrations start from
+            for move in moves:
+                load = self.item_loads[move['item_id']]
+                self.initial_loads[move['from']] += load
+                self.initial_loads[move['to']] -= load
+        self.unscheduled = []  # Moves that could not be ordered without overcommitting a node
+
+    def get_duration(self, move):
+        """Estimate how long a migration takes on its link on its own."""
+        if self.cost_model is not None:
+            return self.cost_model.get_migration_time(self.items[move['item_id']], move['from'], move['to'])
+        bandwidth = self.link_bandwidth.get((move['from'], move['to']), self.bandwidth)
+        return self.item_loads[move['item_id']] / bandwidth
+
+    def get_wave_duration(self, wave):
+        """Estimate how long a wave runs: migrations on the same link share its bandwidth, so the busiest link decides."""
+        link_times = {}
+        for move in wave:
+            link = (move['from'], move['to'])
+            link_times[link] = link_times.get(link, 0) + self.get_duration(move)
+        return max(link_times.values(), default=0)
+
+    def get_makespan(self, waves):
+        """Estimate the total time to apply the waves one after another."""
+        return sum(self.get_wave_duration(wave) for wave in waves)
+
+    def find_temporary_host(self, move, loads):
+        """Find a third node that can hold the VM during a stalled migration, preferring the one with the most free memory."""
+        load = self.item_loads[move['item_id']]
+        candidates = [bucket_id for bucket_id in self.capacities
+                      if bucket_id not in (move['from'], move['to']) and loads[bucket_id] + load <= self.capacities[bucket_id]]
+        return max(candidates, key=lambda bucket_id: self.capacities[bucket_id] - loads[bucket_id], default=None)
+
+    def schedule(self):
+        """
+        Split the moves into waves that keep every node within its capacity while they run.
+
+        Longer migrations are placed first so migrations of similar length share a wave. When no remaining move fits,
+        e.g. two full nodes swapping VMs, one move is routed through a temporary host in two hops.
+
+        :return: List of waves, each a list of moves in the MoveOptimizer format.
+        """
+        loads = dict(self.initial_loads)
+        remaining = sorted(self.moves, key=self.get_duration, reverse=True)
+        self.unscheduled = []
+
+        waves = []
+        while remaining:
+            wave = []
+            incoming = {}  # Target bucket id -> memory reserved by migrations in this wave
+            deferred = []
+            for move in remaining:
+                load = self.item_loads[move['item_id']]
+                target = move['to']
+                fits = loads[target] + incoming.get(target, 0) + load <= self.capacities[target]
+                if fits and (self.max_per_wave is None or len(wave) < self.max_per_wave):
+                    wave.append(move)
+                    incoming[target] = incoming.get(target, 0) + load
+                else:
+                    deferred.append(move)
+
+            if not wave:
+                # Every remaining move waits on another one; send the smallest VM that can be parked through a temporary host
+                for move in sorted(deferred, key=lambda move: self.item_loads[move['item_id']]):
+                    temporary_host = self.find_temporary_host(move, loads)
+                    if temporary_host is not None:
+                        wave.append({'item_id': move['item_id'], 'from': move['from'], 'to': temporary_host})
+                        deferred[deferred.index(move)] = {'item_id': move['item_id'], 'from': temporary_host, 'to': move['to']}
+                        break
+                else:
+                    print(f"Unable to order {len(deferred)} moves without overcommitting a node; they are left out.")
+                    self.unscheduled = deferred
+                    break
+
+            # The wave's sources release their memory once it completes
+            for move in wave:
+                load = self.item_loads[move['item_id']]
+                loads[move['from']] -= load
+                loads[move['to']] += load
+            waves.append(wave)
+            remaining = deferred
+
+        return waves
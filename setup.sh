@@ -25,11 +25,11 @@
 #   - Install Python dependencies.
 #   - Move the entire repository to /opt/ProxmoxLoadBalancer.
 #   - Copy the systemd service and timer files to /etc/systemd/system.
-#   - Reload systemd and enable/start the timer.
+#   - Reload systemd and enable/start the timer, or with --daemon the resident daemon service instead.
 #
 # Usage:
 #   chmod +x setup.sh
-#   sudo ./setup.sh
+#   sudo ./setup.sh [--daemon]
 #
 
 # Check if the script is run as root
@@ -58,13 +58,21 @@ echo "Copying systemd service and timer files..."
 # Copy the systemd service and timer files to the proper location
 cp loadbalancer.service /etc/systemd/system/loadbalancer.service
 cp loadbalancer.timer /etc/systemd/system/loadbalancer.timer
+cp loadbalancer-daemon.service /etc/systemd/system/loadbalancer-daemon.service
 
 echo "Setting up systemd services..."
 # Reload systemd to register the new service and timer
 systemctl daemon-reload
 
-# Enable and start the timer to schedule the load balancer
-systemctl enable loadbalancer.timer
-systemctl start loadbalancer.timer
+if [[ "$1" == "--daemon" ]]; then
+  # Run the resident daemon instead of the periodic one-shot service
+  systemctl disable --now loadbalancer.timer 2>/dev/null
+  systemctl enable loadbalancer-daemon.service
+  systemctl start loadbalancer-daemon.service
+else
+  # Enable and start the timer to schedule the load balancer
+  systemctl enable loadbalancer.timer
+  systemctl start loadbalancer.timer
+fi
 
 echo "ProxmoxLoadBalancer setup is complete!"